@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the screenshot pipeline.
+
+The script starts a mock server (splash/tests/mockserver.py) and a Splash
+server, renders synthetic pages of the mock server with different
+screenshot options and writes results as JSON. Run it from the repository
+root::
+
+    python benchmark/screenshots.py -o results.json
+    python benchmark/screenshots.py --engines webkit --repeat 3 \\
+        --viewports 1024x768 --pages tall -o tall.json
+
+For each case the following is reported, averaged over ``--repeat``
+requests: wall time measured by the client, CPU time of the Splash process,
+time of rendering stages (rasterization in one step or tile-by-tile,
+QImage to Pillow conversion, raster scaling and encoding, taken from
+the /metrics endpoint) and peak RSS of the Splash process after the case.
+Peak RSS never decreases, so compare it between runs of the same case list.
+
+Render cases are followed by encoding cases: a raw screenshot of each page
+is fetched from Splash and encoded locally as PNG with every
+``--png-levels`` compression level.
+
+Compare two result files::
+
+    python benchmark/screenshots.py --compare old.json new.json
+"""
+import io
+import json
+import optparse
+import resource
+import sys
+import time
+import zlib
+
+import requests
+from PIL import Image
+
+import splash
+from splash.metrics import parse_samples
+from splash.png_stream import PngStreamWriter
+from splash.raw_image import raw_image_to_pil
+from splash.tests.utils import MockServer, SplashServer
+
+
+# Synthetic page heights. Tall pages rendered with render_all=1 are larger
+# than QPainter limit (32766px), so they are rendered tile-by-tile.
+PAGE_HEIGHTS = {
+    'short': 600,
+    'long': 4000,
+    'tall': 40000,
+}
+
+
+def get_metrics(splash_url):
+    """
+    Return a dict with Splash metrics which are relevant for the benchmark
+    """
+    samples = parse_samples(requests.get(splash_url + "metrics").text)
+    res = {}
+    for (name, labels), value in samples.items():
+        if name == 'splash_image_render_seconds_sum':
+            res[dict(labels)['stage']] = value
+        elif name == 'splash_image_encode_seconds_sum':
+            res['encode_' + dict(labels)['format']] = value
+        elif name in {'splash_cpu_seconds', 'splash_max_rss_bytes'}:
+            res[name] = value
+    return res
+
+
+def iter_render_cases(opts):
+    for engine in opts.engines:
+        for viewport in opts.viewports:
+            for page in opts.pages:
+                for render_all in (0, 1):
+                    for scale_method in opts.scale_methods:
+                        for fmt in opts.formats:
+                            yield {
+                                'engine': engine,
+                                'viewport': viewport,
+                                'page': page,
+                                'render_all': render_all,
+                                'tiled': bool(
+                                    render_all and
+                                    PAGE_HEIGHTS[page] > 32766),
+                                'scale_method': scale_method,
+                                'format': fmt,
+                            }
+
+
+def run_render_case(case, splash_url, page_url, repeat):
+    width = int(case['viewport'].split('x')[0])
+    params = {
+        'url': page_url + '?height=%d' % PAGE_HEIGHTS[case['page']],
+        'engine': case['engine'],
+        'viewport': case['viewport'],
+        'render_all': case['render_all'],
+        'scale_method': case['scale_method'],
+        # downscale, so that scale_method matters
+        'width': width // 2,
+        'wait': 0.1 if case['render_all'] else 0,
+        'timeout': 300,
+    }
+    endpoint = splash_url + 'render.' + case['format']
+
+    # warm up: load fonts, fill caches
+    resp = requests.get(endpoint, params=params)
+    if resp.status_code != 200:
+        return dict(case, error=resp.text[:500])
+
+    before = get_metrics(splash_url)
+    wall_time = 0.0
+    size = 0
+    for _ in range(repeat):
+        start_time = time.time()
+        resp = requests.get(endpoint, params=params)
+        wall_time += time.time() - start_time
+        if resp.status_code != 200:
+            return dict(case, error=resp.text[:500])
+        size = len(resp.content)
+    after = get_metrics(splash_url)
+
+    result = dict(case)
+    result.update({
+        'wall_time': wall_time / repeat,
+        'cpu_time': (after['splash_cpu_seconds'] -
+                     before['splash_cpu_seconds']) / repeat,
+        'stages': {
+            stage: (value - before.get(stage, 0.0)) / repeat
+            for stage, value in after.items()
+            if not stage.startswith('splash_') and value != before.get(stage)
+        },
+        'max_rss': int(after['splash_max_rss_bytes']),
+        'size': size,
+    })
+    return result
+
+
+def run_encode_cases(opts, splash_url, page_url):
+    for viewport in opts.viewports:
+        for page in opts.pages:
+            resp = requests.get(splash_url + 'render.png', params={
+                'url': page_url + '?height=%d' % PAGE_HEIGHTS[page],
+                'viewport': viewport,
+                'render_all': 1,
+                'wait': 0.1,
+                'format': 'raw',
+                'timeout': 300,
+            })
+            if resp.status_code != 200:
+                yield {'viewport': viewport, 'page': page,
+                       'error': resp.text[:500]}
+                continue
+            image = raw_image_to_pil(resp.content)
+            for level in opts.png_levels:
+                for encoder in ('pillow', 'stream'):
+                    yield dict(
+                        {'viewport': viewport, 'page': page,
+                         'image_size': list(image.size),
+                         'encoder': encoder, 'png_level': level},
+                        **measure(encode_png, image, level, encoder,
+                                  repeat=opts.repeat)
+                    )
+
+
+def encode_png(image, level, encoder):
+    if encoder == 'pillow':
+        buf = io.BytesIO()
+        image.save(buf, 'png', compress_level=level)
+        return buf.getvalue()
+    # band-wise encoder, used for tiled screenshots
+    writer = PngStreamWriter(image.size[0], image.size[1],
+                             mode=image.mode, complevel=level)
+    band_height = 1024
+    for top in range(0, image.size[1], band_height):
+        band = image.crop((0, top, image.size[0],
+                           min(top + band_height, image.size[1])))
+        writer.write(band)
+    return writer.close()
+
+
+def measure(func, *args, repeat=1):
+    wall_time = cpu_time = 0.0
+    for _ in range(repeat):
+        start_time, start_cpu = time.time(), time.process_time()
+        result = func(*args)
+        wall_time += time.time() - start_time
+        cpu_time += time.process_time() - start_cpu
+    return {
+        'wall_time': wall_time / repeat,
+        'cpu_time': cpu_time / repeat,
+        'max_rss': get_max_rss(),
+        'size': len(result),
+    }
+
+
+def get_max_rss():
+    size = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        size *= 1024
+    return size
+
+
+def get_case_key(case):
+    return tuple(sorted(
+        (key, str(value)) for key, value in case.items()
+        if key in {'engine', 'viewport', 'page', 'render_all',
+                   'scale_method', 'format', 'encoder', 'png_level'}
+    ))
+
+
+def compare(old_path, new_path):
+    """ Print wall and CPU time changes between two result files """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    for kind in ('render', 'encode'):
+        old_cases = {get_case_key(case): case for case in old[kind]
+                     if 'error' not in case}
+        for case in new[kind]:
+            old_case = old_cases.get(get_case_key(case))
+            if old_case is None or 'error' in case:
+                continue
+            print("%-80s wall %+6.1f%%  cpu %+6.1f%%" % (
+                " ".join("%s=%s" % kv for kv in get_case_key(case)),
+                _change(old_case['wall_time'], case['wall_time']),
+                _change(old_case['cpu_time'], case['cpu_time']),
+            ))
+
+
+def _change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) * 100.0 / old
+
+
+def _split(value):
+    return [v for v in value.split(',') if v]
+
+
+def main():
+    op = optparse.OptionParser(usage=__doc__)
+    op.add_option("-o", "--output", help="write results to this file "
+                  "(default: stdout)")
+    op.add_option("--engines", default="webkit,chromium")
+    op.add_option("--viewports", default="1024x768,1920x1080")
+    op.add_option("--pages", default="short,tall",
+                  help="comma-separated list of: %s" % ", ".join(PAGE_HEIGHTS))
+    op.add_option("--scale-methods", default="raster,vector")
+    op.add_option("--formats", default="png,jpeg")
+    op.add_option("--png-levels", default="0,1,3,6,9")
+    op.add_option("--repeat", type=int, default=5)
+    op.add_option("--compare", nargs=2, metavar="OLD NEW",
+                  help="compare two result files instead of running "
+                       "the benchmark")
+    opts, _ = op.parse_args()
+    if opts.compare:
+        compare(*opts.compare)
+        return
+
+    opts.engines = _split(opts.engines)
+    opts.viewports = _split(opts.viewports)
+    opts.pages = _split(opts.pages)
+    opts.scale_methods = _split(opts.scale_methods)
+    opts.formats = _split(opts.formats)
+    opts.png_levels = [int(level) for level in _split(opts.png_levels)]
+
+    extra_args = ['--browser-engines', ','.join(opts.engines)]
+    with MockServer() as mock, SplashServer(extra_args=extra_args,
+                                            verbosity=0) as server:
+        splash_url = "http://localhost:%d/" % server.portnum
+        page_url = mock.url('synthetic', gzip=False)
+        results = {
+            'python': sys.version,
+            'zlib': zlib.ZLIB_RUNTIME_VERSION,
+            'pillow': Image.__version__,
+            'splash': splash.__version__,
+            'render': [],
+            'encode': [],
+        }
+        for case in iter_render_cases(opts):
+            result = run_render_case(case, splash_url, page_url, opts.repeat)
+            print(json.dumps(result, sort_keys=True), file=sys.stderr)
+            results['render'].append(result)
+        for result in run_encode_cases(opts, splash_url, page_url):
+            print(json.dumps(result, sort_keys=True), file=sys.stderr)
+            results['encode'].append(result)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,3 +31,19 @@ def comma_separated_callback(*, is_valid_func=lambda v: True,
                 raise optparse.OptionValueError(msg)
         setattr(parser.values, option.dest, values)
     return callback
+
+
+def client_weights_callback(option, opt, value, parser):
+    """ optparse callback for comma-separated client_id:weight pairs """
+    weights = {}
+    for pair in value.split(','):
+        client_id, _, weight = pair.rpartition(':')
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = 0
+        if not client_id or weight <= 0:
+            msg = "%s is not a valid client_id:weight pair" % pair
+            raise optparse.OptionValueError(msg)
+        weights[client_id] = weight
+    setattr(parser.values, option.dest, weights)
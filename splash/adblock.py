@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Matching of URLs against Adblock Plus filters (``--filters-path``).
+
+Rules of all filters are kept in a single :class:`FilterIndex`. Each rule
+is indexed by a token (a run of letters, digits and ``%``) which every URL
+matched by the rule contains. To check a URL only rules indexed by
+tokens of this URL are matched, plus a few rules without suitable tokens
+(e.g. regex rules), so matching time doesn't grow with the number of rules
+the way a single large regex does.
+
+Rules are parsed by `adblockparser <https://github.com/scrapinghub/adblockparser>`_.
+Parsing large filters takes a while, so a parsed and indexed FilterIndex
+can be saved to a snapshot file (:func:`save_snapshot`). The snapshot is
+memory-mapped when it is loaded (:func:`load_snapshot`), and rules are
+decoded only when they are matched for the first time; Splash processes
+which map the same snapshot share its memory.
+"""
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+from array import array
+from collections import defaultdict
+
+
+TOKEN_RE = re.compile(r'[a-z0-9%]+')
+
+# Tokens present in most URLs; rules are indexed by other tokens if possible.
+COMMON_TOKENS = frozenset(['http', 'https', 'www', 'com', 'net', 'org',
+                           'html', 'js'])
+
+
+def get_url_tokens(url):
+    """
+    Return a set of tokens of ``url``.
+
+    >>> sorted(get_url_tokens('http://Example.com/ads/banner_1.gif?x=%20'))
+    ['%20', '1', 'ads', 'banner', 'com', 'example', 'gif', 'http', 'x']
+    """
+    return set(TOKEN_RE.findall(url.lower()))
+
+
+def get_rule_tokens(rule_text):
+    """
+    Return tokens which are present in every URL matched by a rule
+    (``rule_text`` is a rule pattern without options). A token can be
+    used only if both its ends are fixed: it is not followed or preceded by
+    a wildcard or by an unanchored start or end of the pattern.
+
+    >>> get_rule_tokens('||ads.example.com^')
+    ['ads', 'example', 'com']
+    >>> get_rule_tokens('/banner/*/img^')
+    ['banner', 'img']
+    >>> get_rule_tokens('.swf|')
+    ['swf']
+    >>> get_rule_tokens('-ad-')
+    ['ad']
+    >>> get_rule_tokens('ads/')
+    []
+    >>> get_rule_tokens('/ad[0-9]+/')
+    []
+    """
+    if len(rule_text) > 1 and rule_text.startswith('/') and rule_text.endswith('/'):
+        return []  # regex rule
+    text = rule_text.lower()
+    tokens = []
+    for match in TOKEN_RE.finditer(text):
+        start, end = match.span()
+        if start == 0 or text[start - 1] == '*':
+            continue
+        if end == len(text) or text[end] == '*':
+            continue
+        tokens.append(match.group())
+    return tokens
+
+
+def _domain_variants(domain):
+    """
+    >>> list(_domain_variants("foo.bar.example.com"))
+    ['foo.bar.example.com', 'bar.example.com', 'example.com']
+    >>> list(_domain_variants("localhost"))
+    ['localhost']
+    """
+    parts = domain.split('.')
+    if len(parts) == 1:
+        yield parts[0]
+    else:
+        for i in range(len(parts), 1, -1):
+            yield ".".join(parts[-i:])
+
+
+class IndexedRule(object):
+    """ A rule of :class:`FilterIndex` """
+    __slots__ = ['text', 'regex', 'is_exception', 'domains', 'match_case',
+                 'filters', '_regex_re']
+
+    def __init__(self, regex, is_exception=False, domains=None,
+                 match_case=False, filters=(), text=None):
+        self.text = text
+        self.regex = regex
+        self.is_exception = is_exception
+        self.domains = domains
+        self.match_case = match_case
+        self.filters = set(filters)
+        self._regex_re = None
+
+    @classmethod
+    def from_adblock_rule(cls, rule):
+        """ Create IndexedRule from ``adblockparser.AdblockRule`` """
+        return cls(
+            regex=rule.regex,
+            is_exception=rule.is_exception,
+            domains=rule.options.get('domain'),
+            match_case='match-case' in rule.options,
+            text=rule.rule_text,
+        )
+
+    def match(self, url, options):
+        if self.domains is not None:
+            domain = options.get('domain')
+            if domain is None or not self._domain_matches(domain):
+                return False
+        if self._regex_re is None:
+            flags = 0 if self.match_case else re.IGNORECASE
+            self._regex_re = re.compile(self.regex, flags)
+        return bool(self._regex_re.search(url))
+
+    def _domain_matches(self, domain):
+        for variant in _domain_variants(domain):
+            if variant in self.domains:
+                return self.domains[variant]
+        return not any(self.domains.values())
+
+
+class RuleGroup(object):
+    """
+    Rules without domain options which have the same filters and type,
+    matched using a single regex.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.filters = rules[0].filters
+        self.is_exception = rules[0].is_exception
+        self._regex_re = re.compile(
+            "|".join("(?:%s)" % rule.regex for rule in rules),
+            re.IGNORECASE)
+
+    def match(self, url, options):
+        return bool(self._regex_re.search(url))
+
+
+class FilterIndex(object):
+    """
+    Rules of several filters indexed by URL tokens.
+
+    A rule which is present in several filters is stored (and matched)
+    once. A request is blocked by a filter if a blocking rule of this
+    filter matches and no exception (``@@``) rule of the same filter
+    matches.
+
+    Rules without tokens are checked for every URL; those of them which
+    don't have domain options are combined into regexes (see
+    :class:`RuleGroup`).
+    """
+    def __init__(self, rules=None, index=None, generic=None):
+        self.rules = [] if rules is None else rules
+        self._rule_ids = {}  # (raw rule text) => rule id
+        self._index = defaultdict(list)  # token => [rule ids]
+        if index is not None:
+            self._index.update(index)
+        self._generic = [] if generic is None else generic  # ids of rules without tokens
+        self._generic_matchers = None
+
+    def add_rule(self, rule, filter_name):
+        """ Add ``adblockparser.AdblockRule`` ``rule`` to a filter """
+        key = rule.raw_rule_text.strip()
+        rule_id = self._rule_ids.get(key)
+        if rule_id is None:
+            rule_id = len(self.rules)
+            self._rule_ids[key] = rule_id
+            indexed_rule = IndexedRule.from_adblock_rule(rule)
+            self.rules.append(indexed_rule)
+            self._add_to_index(rule_id, get_rule_tokens(indexed_rule.text))
+        self.rules[rule_id].filters.add(filter_name)
+        self._generic_matchers = None
+
+    def _add_to_index(self, rule_id, tokens):
+        if not tokens:
+            self._generic.append(rule_id)
+            return
+        # use the least common token
+        token = min(tokens, key=lambda t: (t in COMMON_TOKENS,
+                                           len(self._index.get(t, ())),
+                                           -len(t)))
+        self._index[token].append(rule_id)
+
+    def iter_candidates(self, url):
+        """ Return rules (or groups of rules) which may match ``url`` """
+        if self._generic_matchers is None:
+            self.prepare()
+        for matcher in self._generic_matchers:
+            yield matcher
+        for token in get_url_tokens(url):
+            for rule_id in self._index.get(token, ()):
+                yield self.rules[rule_id]
+
+    def prepare(self):
+        """
+        Combine rules without tokens into regexes. It is done on the first
+        match if this method is not called after rules are added.
+        """
+        groups = defaultdict(list)
+        matchers = []
+        for rule_id in self._generic:
+            rule = self.rules[rule_id]
+            if rule.domains is None and not rule.match_case:
+                key = (frozenset(rule.filters), rule.is_exception)
+                groups[key].append(rule)
+            else:
+                matchers.append(rule)
+        matchers.extend(RuleGroup(rules) for rules in groups.values())
+        self._generic_matchers = matchers
+
+    def get_blocking_filter(self, filter_names, url, options):
+        """
+        Return the first of ``filter_names`` which blocks ``url``,
+        or None.
+        """
+        requested = set(filter_names)
+        blocked, allowed = set(), set()
+        for rule in self.iter_candidates(url):
+            names = rule.filters & requested
+            if not names:
+                continue
+            matched = allowed if rule.is_exception else blocked
+            if names <= matched:
+                continue
+            if rule.match(url, options):
+                matched.update(names)
+
+        for name in filter_names:
+            if name in blocked and name not in allowed:
+                return name
+
+    def stats(self):
+        return {
+            'rules': len(self.rules),
+            'tokens': len(self._index),
+            'generic_rules': len(self._generic),
+        }
+
+
+SNAPSHOT_MAGIC = b'SPLASH-FILTERS\n'
+SNAPSHOT_VERSION = 1
+_HEADER_SIZE = struct.Struct('<I')
+
+
+def save_snapshot(path, index, filters, key):
+    """
+    Save FilterIndex ``index`` and ``filters`` (a dict with numbers
+    of rules in each filter) to ``path``. ``key`` is a JSON-serializable
+    value which identifies source files of the filters; :func:`load_snapshot`
+    ignores snapshots with a different key. The file is replaced atomically.
+
+    Snapshot layout: magic bytes, header size, JSON header (padded to
+    4 bytes), offsets of rule records (uint32), rule ids grouped by
+    tokens (uint32), JSON-encoded rule records.
+    """
+    filter_names = sorted(filters)
+    filter_ids = {name: i for i, name in enumerate(filter_names)}
+
+    records = bytearray()
+    offsets = array('I', [0])
+    for rule in index.rules:
+        records += json.dumps([
+            rule.regex,
+            rule.is_exception,
+            rule.domains,
+            rule.match_case,
+            sorted(filter_ids[name] for name in rule.filters),
+        ]).encode('utf8')
+        offsets.append(len(records))
+
+    rule_ids = array('I')
+    tokens = {}
+    for token, ids in index._index.items():
+        tokens[token] = [len(rule_ids), len(rule_ids) + len(ids)]
+        rule_ids.extend(ids)
+    generic = [len(rule_ids), len(rule_ids) + len(index._generic)]
+    rule_ids.extend(index._generic)
+
+    header = json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'byteorder': sys.byteorder,
+        'key': key,
+        'filters': filters,
+        'filter_names': filter_names,
+        'rules': len(index.rules),
+        'rule_ids': len(rule_ids),
+        'tokens': tokens,
+        'generic': generic,
+    }).encode('utf8')
+    header += b' ' * (-(len(SNAPSHOT_MAGIC) + _HEADER_SIZE.size +
+                        len(header)) % 4)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.filters-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(_HEADER_SIZE.pack(len(header)))
+            f.write(header)
+            f.write(offsets.tobytes())
+            f.write(rule_ids.tobytes())
+            f.write(records)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_snapshot(path, key):
+    """
+    Load a snapshot saved by :func:`save_snapshot`. Return
+    ``(index, filters)`` tuple, or None if there is no valid snapshot
+    with this ``key``.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        pos = len(SNAPSHOT_MAGIC)
+        if data[:pos] != SNAPSHOT_MAGIC:
+            return None
+        header_size, = _HEADER_SIZE.unpack_from(data, pos)
+        pos += _HEADER_SIZE.size
+        header = json.loads(data[pos:pos + header_size].decode('utf8'))
+        pos += header_size
+        if (header['version'] != SNAPSHOT_VERSION or
+                header['byteorder'] != sys.byteorder or
+                header['key'] != json.loads(json.dumps(key))):
+            return None
+
+        view = memoryview(data)
+        offsets_end = pos + 4 * (header['rules'] + 1)
+        rule_ids_end = offsets_end + 4 * header['rule_ids']
+        offsets = view[pos:offsets_end].cast('I')
+        rule_ids = view[offsets_end:rule_ids_end].cast('I')
+        records = view[rule_ids_end:]
+        if len(records) != offsets[-1]:
+            return None
+    except (ValueError, KeyError, TypeError, struct.error):
+        return None
+
+    rules = SnapshotRules(offsets, records, header['filter_names'])
+    index = FilterIndex(
+        rules=rules,
+        index={token: rule_ids[start:end]
+               for token, (start, end) in header['tokens'].items()},
+        generic=rule_ids[slice(*header['generic'])],
+    )
+    return index, header['filters']
+
+
+class SnapshotRules(object):
+    """
+    A read-only sequence of IndexedRule objects which are decoded
+    from memory-mapped snapshot records on first access.
+    """
+    def __init__(self, offsets, records, filter_names):
+        self._offsets = offsets
+        self._records = records
+        self._filter_names = filter_names
+        self._rules = {}
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, rule_id):
+        rule = self._rules.get(rule_id)
+        if rule is None:
+            start, end = self._offsets[rule_id], self._offsets[rule_id + 1]
+            regex, is_exception, domains, match_case, filter_ids = \
+                json.loads(self._records[start:end].tobytes().decode('utf8'))
+            rule = IndexedRule(
+                regex=regex,
+                is_exception=is_exception,
+                domains=domains,
+                match_case=match_case,
+                filters=[self._filter_names[i] for i in filter_ids],
+            )
+            self._rules[rule_id] = rule
+        return rule
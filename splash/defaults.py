@@ -41,6 +41,17 @@ PNG_COMPRESSION_LEVEL = 1
 # and results in large files with hardly any gain in image quality.
 JPEG_QUALITY = 75
 
+# WebP quality (0-100) is a compression effort for lossless images;
+# WEBP_METHOD is a speed/size tradeoff from 0 (fastest) to 6 (smallest).
+WEBP_QUALITY = 80
+WEBP_METHOD = 4
+
+# Maximum server-side downsampling factor for raw (uncompressed) screenshots.
+MAX_DOWNSAMPLE = 16
+
+# Maximum number of images in 'screenshots' argument of render.json.
+MAX_SCREENSHOTS = 20
+
 # There's a bug in Qt that manifests itself when width or height of rendering
 # surface (aka the png image) is more than 32768.  Usually, this is solved by
 # rendering the image in tiled manner and obviously, TILE_MAXSIZE must not
@@ -53,6 +64,21 @@ JPEG_QUALITY = 75
 # size is chosen to fit commonly used 1080p resolution in one tile.
 TILE_MAXSIZE = 2048
 
+# Number of threads used to encode screenshots (PNG/JPEG compression and
+# base64); 0 means images are encoded in the main thread.
+IMAGE_ENCODING_THREADS = 0
+
+# Screenshot cache (--screenshot-cache-size) can keep evicted entries
+# on disk (--screenshot-cache-path); this is a limit of disk usage, in MB.
+SCREENSHOT_CACHE_DISK_SIZE = 1024
+
+# On-disk HTTP cache shared between renders, in MB; 0 disables it.
+HTTP_CACHE_SIZE = 0
+
+# How often to check --filters-path for changed filters, in seconds;
+# 0 means filters are reloaded only when Splash receives SIGUSR2.
+RELOAD_INTERVAL = 0
+
 # defaults for render.json endpoint
 DO_HTML = 0
 DO_IFRAMES = 0
@@ -67,9 +93,38 @@ SHOW_HAR = 0
 SPLASH_PORT = 8050
 SPLASH_IP = '0.0.0.0'
 
+# number of Splash processes sharing the listening port
+WORKERS = 1
+
+# When --maxrss is exceeded Splash stops accepting new requests and waits
+# up to DRAIN_TIMEOUT seconds for active and queued renders to finish.
+# RSS is checked every MAXRSS_CHECK_INTERVAL seconds.
+DRAIN_TIMEOUT = 60
+MAXRSS_CHECK_INTERVAL = 2.0
+
+# What to do when a single render increases RSS by more than
+# --render-rss-threshold MB: 'gc' clears caches and runs garbage collection,
+# 'restart' restarts Splash (see DRAIN_TIMEOUT).
+RENDER_RSS_ACTION = 'gc'
+
 # pool options
 SLOTS = 20
 
+# Requests are rejected with HTTP 503 if there are more than MAX_QUEUE_SIZE
+# requests in the queue, or if the expected queue wait time is larger than
+# MAX_QUEUE_WAIT seconds. 0 means no limit.
+MAX_QUEUE_SIZE = 0
+MAX_QUEUE_WAIT = 0
+
+# Requests with a higher priority are rendered first;
+# allowed values are from -MAX_PRIORITY to MAX_PRIORITY.
+PRIORITY = 0
+MAX_PRIORITY = 100
+
+# When tab reuse is enabled, a browser tab is destroyed after this
+# many renders, to limit the effect of leaks in a long-living tab.
+MAX_TAB_REUSES = 100
+
 # argument cache option
 ARGUMENT_CACHE_MAX_ENTRIES = 500
 
@@ -63,6 +63,7 @@ class QtChromiumScreenshotRenderer(BaseQtScreenshotRenderer):
                                web_rect: QRect,
                                render_rect: QRect,
                                canvas_size: QSize,
+                               stream: bool = False,
                                ) -> 'WrappedImage':
         raise ValueError("tiling is required, but it is not implemented")
 
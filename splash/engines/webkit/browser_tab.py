@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
-import base64
 import functools
-import os
+import math
 import weakref
 import traceback
 
@@ -14,8 +13,9 @@ from PyQt5.QtNetwork import QNetworkRequest
 from PyQt5.QtWebKitWidgets import QWebPage
 from PyQt5.QtWebKit import QWebSettings
 from PyQt5.QtWidgets import QApplication
+from twisted.internet import defer
 
-from splash import defaults
+from splash import defaults, metrics
 from splash.har.qt import cookies2har
 from splash.qtutils import (
     OPERATION_QT_CONSTANTS,
@@ -38,7 +38,13 @@ from splash.jsutils import (
     escape_js,
     store_dom_elements,
 )
+from splash.casperjs_utils import VISIBLE_JS_FUNC
 from splash.html_element import HTMLElement
+from splash.image_encoding import encode_image, gather_encoded, get_encoder
+from splash.qtrender_image import CachingImage, EncodedImage
+from splash.raw_image import RAW_PIXEL_FORMATS
+from splash.profiles import get_js_profile_sources
+from splash.screenshot_cache import get_screenshot_cache
 from splash.browser_tab import (
     BrowserTab,
     OneShotCallbackProxy,
@@ -52,11 +58,39 @@ from splash.browser_tab import (
     ElementsStorage,
 )
 from .http_client import SplashWebkitHttpClient, get_header_value
-from .webpage import WebkitWebPage, WebkitEventLogger
+from .webpage import (
+    WebkitWebPage,
+    WebkitEventLogger,
+    PER_RENDER_WEBPAGE_OPTIONS,
+)
 from .webview import SplashQWebView
 from .screenshot import QtWebkitScreenshotRenderer
 
 
+def _get_storage_origin(url):
+    """
+    Return ``(scheme, host, port)`` of a QUrl, or None for URLs without
+    DOM storage (about:blank, data: URLs).
+    """
+    scheme = url.scheme()
+    if scheme not in {'http', 'https', 'file'}:
+        return None
+    return scheme, url.host().lower(), url.port()
+
+
+# Bounds of the first visible element matching a selector
+# (screenshot specs with 'selector'), or null.
+SELECTOR_BOUNDS_JS = u"""
+(function(elem, visible) {
+    if (!elem || !visible(elem)) {
+        return null;
+    }
+    var rect = elem.getBoundingClientRect();
+    return [rect.left, rect.top, rect.right, rect.bottom];
+})(document.querySelector(%%s), %s)
+""" % VISIBLE_JS_FUNC
+
+
 class WebkitBrowserTab(BrowserTab):
     """
     An object for controlling a single browser tab (QWebView).
@@ -81,10 +115,86 @@ class WebkitBrowserTab(BrowserTab):
         self._js_console = None
         self._autoload_scripts = []
         self._js_storage_initiated = False
+        self._storage_origins = set()  # origins of loaded documents
+        self.reuse_count = 0
         self._init_webpage(verbosity, network_manager, splash_proxy_factory,
                            render_options)
         self.http_client = SplashWebkitHttpClient(self.web_page)
 
+    def rebind(self, render_options, splash_proxy_factory):
+        """
+        Attach a tab which was previously :meth:`reset` to a new render.
+        """
+        self.reuse_count += 1
+        self._uid = render_options.get_uid()
+        self.logger.uid = self._uid
+        self.web_page.render_options = render_options
+        self.web_page.splash_proxy_factory = splash_proxy_factory
+        self.logger.log("tab is reused (%d)" % self.reuse_count, min_level=2)
+
+    def reset(self, callback, errback):
+        """
+        Drop all per-render state, so that the tab can be reused for
+        another render: cookies, HAR data, callbacks, autoload scripts,
+        custom headers and User-Agent, webpage options, viewport and
+        JS objects. The current page is replaced with a blank page;
+        ``callback`` is called when the tab is ready to be reused,
+        ``errback`` is called if it can't be reset.
+
+        sessionStorage and localStorage can only be cleared from a page
+        of the same origin, so a tab which loaded documents (including
+        iframes) from other origins than the current page can't be reset.
+        """
+        self.logger.log("resetting the tab", min_level=2)
+        current_origin = _get_storage_origin(self.web_page.mainFrame().url())
+        if not self._storage_origins <= {current_origin}:
+            self.logger.log("tab storage can't be cleared: %d origins "
+                            "visited" % len(self._storage_origins),
+                            min_level=2)
+            errback()
+            return
+        self.stop_loading()
+        self._cancel_all_timers()
+        self._timers_to_cancel_on_redirect.clear()
+        self._timers_to_cancel_on_error.clear()
+        for callback_id in list(self._load_finished.callbacks):
+            self._load_finished.disconnect(callback_id)
+        self.clear_callbacks()
+        self.autoload_reset()
+        self.clear_cookies()
+        self._clear_event_handlers_storage()
+        self._js_console = None
+        self.runjs("try { window.sessionStorage.clear(); } catch (e) {}"
+                   "try { window.localStorage.clear(); } catch (e) {}",
+                   handle_errors=False)
+        self._storage_origins.clear()
+
+        web_page = self.web_page
+        web_page.custom_user_agent = None
+        web_page.custom_headers = None
+        web_page.skip_custom_headers = False
+        web_page.navigation_locked = False
+        web_page.resource_timeout = 0
+        web_page.http2_enabled = False
+        web_page.http_cache_enabled = True
+        web_page.error_info = None
+
+        settings = web_page.settings()
+        for attr in PER_RENDER_WEBPAGE_OPTIONS:
+            settings.resetAttribute(attr)
+        self._set_default_webpage_options(web_page)
+        self.set_viewport(defaults.VIEWPORT_SIZE)
+        self.set_scroll_position(0, 0)
+
+        def on_blank_page_loaded():
+            web_page.history().clear()
+            self.har_reset()
+            callback()
+
+        self.set_content(b"",
+                         callback=on_blank_page_loaded,
+                         errback=lambda error_info: errback())
+
     def _init_webpage(self, verbosity, network_manager, splash_proxy_factory,
                       render_options):
         """ Create and initialize QWebPage and QWebView """
@@ -195,6 +305,7 @@ class WebkitBrowserTab(BrowserTab):
         self._load_finished = WrappedSignal(main_frame.loadFinished)
         main_frame.loadFinished.connect(self._on_load_finished)
         main_frame.urlChanged.connect(self._on_url_changed)
+        self.web_page.frameCreated.connect(self._on_frame_created)
         main_frame.javaScriptWindowObjectCleared.connect(
             self._on_javascript_window_object_cleared)
         self._webpage_logger = WebkitEventLogger(self.logger)
@@ -216,6 +327,9 @@ class WebkitBrowserTab(BrowserTab):
     get_http2_enabled = webpage_attribute_getter("http2_enabled")
     set_http2_enabled = webpage_attribute_setter("http2_enabled")
 
+    get_http_cache_enabled = webpage_attribute_getter("http_cache_enabled")
+    set_http_cache_enabled = webpage_attribute_setter("http_cache_enabled")
+
     def set_resource_timeout(self, timeout):
         """ Set a default timeout for HTTP requests, in seconds. """
         self.web_page.resource_timeout = timeout
@@ -512,6 +626,15 @@ class WebkitBrowserTab(BrowserTab):
     def _on_url_changed(self, url):
         self.web_page.har.store_redirect(str(url.toString()))
         self._cancel_timers(self._timers_to_cancel_on_redirect)
+        self._add_storage_origin(url)
+
+    def _on_frame_created(self, frame):
+        frame.urlChanged.connect(self._add_storage_origin)
+
+    def _add_storage_origin(self, url):
+        origin = _get_storage_origin(url)
+        if origin is not None:
+            self._storage_origins.add(origin)
 
     def _process_js_result(self, obj, allow_dom):
         if obj is None:
@@ -553,11 +676,10 @@ class WebkitBrowserTab(BrowserTab):
     def run_js_files(self, folder, handle_errors=True):
         """
         Load all JS libraries from ``folder`` folder to the current frame.
+        Files are cached (see :mod:`splash.profiles`).
         """
-        for jsfile in os.listdir(folder):
-            if jsfile.endswith('.js'):
-                filename = os.path.join(folder, jsfile)
-                self.run_js_file(filename, handle_errors=handle_errors)
+        for filename, script in get_js_profile_sources(folder):
+            self.runjs(script, handle_errors=handle_errors)
 
     def autoload(self, js_source):
         """ Execute JS code before each page load """
@@ -775,7 +897,8 @@ class WebkitBrowserTab(BrowserTab):
         return result
 
     def _get_image(self, image_format, width, height, render_all,
-                   scale_method, region):
+                   scale_method, region, quality=None, use_cache=True,
+                   stream=True):
         old_size = self.web_page.viewportSize()
         try:
             if render_all:
@@ -786,7 +909,11 @@ class WebkitBrowserTab(BrowserTab):
                 self.web_page, self.logger, image_format,
                 width=width, height=height, scale_method=scale_method,
                 region=region)
-            image = renderer.render_qwebpage()
+            if use_cache:
+                image = self._render_or_get_cached(renderer, image_format,
+                                                   quality)
+            else:
+                image = renderer.render_qwebpage(stream=stream)
         finally:
             if old_size != self.web_page.viewportSize():
                 # Let's not generate extra "set size" messages in the log.
@@ -797,32 +924,257 @@ class WebkitBrowserTab(BrowserTab):
     def png(self, width=None, height=None, b64=False, render_all=False,
             scale_method=None, region=None):
         """ Return screenshot in PNG format """
-        self.logger.log(
-            "Getting PNG: width=%s, height=%s, "
-            "render_all=%s, scale_method=%s, region=%s" %
-            (width, height, render_all, scale_method, region), min_level=2)
-        image = self._get_image('PNG', width, height, render_all,
-                                scale_method, region=region)
-        result = image.to_png()
-        if b64:
-            result = base64.b64encode(result).decode('utf-8')
+        image = self._get_png_image(width, height, render_all, scale_method,
+                                    region)
+        result = encode_image(image, 'PNG', b64=b64)
         self.store_har_timing("_onPngRendered")
         return result
 
+    def png_deferred(self, width=None, height=None, b64=False,
+                     render_all=False, scale_method=None, region=None):
+        """
+        Same as :meth:`png`, but return a Deferred which fires with
+        the screenshot. The page is rendered immediately, and the image
+        is encoded using image encoding threads, if they are enabled.
+        """
+        image = self._get_png_image(width, height, render_all, scale_method,
+                                    region)
+        d = get_encoder().encode(encode_image, image, 'PNG', b64=b64)
+        d.addCallback(self._store_har_timing_passthrough, "_onPngRendered")
+        return d
+
     def jpeg(self, width=None, height=None, b64=False, render_all=False,
              scale_method=None, quality=None, region=None):
         """ Return screenshot in JPEG format. """
+        image = self._get_jpeg_image(width, height, render_all, scale_method,
+                                     quality, region)
+        result = encode_image(image, 'JPEG', quality=quality, b64=b64)
+        self.store_har_timing("_onJpegRendered")
+        return result
+
+    def jpeg_deferred(self, width=None, height=None, b64=False,
+                      render_all=False, scale_method=None, quality=None,
+                      region=None):
+        """
+        Same as :meth:`jpeg`, but return a Deferred which fires with
+        the screenshot (see :meth:`png_deferred`).
+        """
+        image = self._get_jpeg_image(width, height, render_all, scale_method,
+                                     quality, region)
+        d = get_encoder().encode(encode_image, image, 'JPEG',
+                                 quality=quality, b64=b64)
+        d.addCallback(self._store_har_timing_passthrough, "_onJpegRendered")
+        return d
+
+    def webp(self, width=None, height=None, b64=False, render_all=False,
+             scale_method=None, quality=None, lossless=False, method=None,
+             region=None):
+        """ Return screenshot in WebP format. """
+        image, options = self._get_webp_image(
+            width, height, render_all, scale_method, quality, lossless,
+            method, region)
+        result = encode_image(image, 'WEBP', b64=b64, **options)
+        self.store_har_timing("_onWebpRendered")
+        return result
+
+    def webp_deferred(self, width=None, height=None, b64=False,
+                      render_all=False, scale_method=None, quality=None,
+                      lossless=False, method=None, region=None):
+        """
+        Same as :meth:`webp`, but return a Deferred which fires with
+        the screenshot (see :meth:`png_deferred`).
+        """
+        image, options = self._get_webp_image(
+            width, height, render_all, scale_method, quality, lossless,
+            method, region)
+        d = get_encoder().encode(encode_image, image, 'WEBP', b64=b64,
+                                 **options)
+        d.addCallback(self._store_har_timing_passthrough, "_onWebpRendered")
+        return d
+
+    def raw(self, width=None, height=None, b64=False, render_all=False,
+            scale_method=None, region=None, pixel_format='RGBA',
+            downsample=1):
+        """
+        Return uncompressed screenshot with a header
+        (see :mod:`splash.raw_image`). ``pixel_format`` is 'RGBA' (same
+        as PNG screenshots) or 'RGB' (same as JPEG screenshots);
+        if ``downsample`` is greater than 1, the screenshot is reduced
+        by this factor.
+        """
+        image = self._get_raw_image(width, height, render_all, scale_method,
+                                    region, pixel_format)
+        result = encode_image(image, 'RAW', b64=b64,
+                              pixel_format=pixel_format,
+                              downsample=downsample)
+        self.store_har_timing("_onRawRendered")
+        return result
+
+    def raw_deferred(self, width=None, height=None, b64=False,
+                     render_all=False, scale_method=None, region=None,
+                     pixel_format='RGBA', downsample=1):
+        """
+        Same as :meth:`raw`, but return a Deferred which fires with
+        the screenshot (see :meth:`png_deferred`).
+        """
+        image = self._get_raw_image(width, height, render_all, scale_method,
+                                    region, pixel_format)
+        d = get_encoder().encode(encode_image, image, 'RAW', b64=b64,
+                                 pixel_format=pixel_format,
+                                 downsample=downsample)
+        d.addCallback(self._store_har_timing_passthrough, "_onRawRendered")
+        return d
+
+    def screenshots_deferred(self, specs, render_all=False, b64=False):
+        """
+        Render the page once and return a Deferred which fires with a list
+        of screenshots, one per :class:`~splash.screenshot_specs.ScreenshotSpec`
+        in ``specs``. Each screenshot is a ``(data, (width, height))`` tuple,
+        or None if spec selector doesn't match a visible element.
+        Images are scaled using 'raster' method.
+        """
+        self.logger.log("Getting %d screenshots: render_all=%s" %
+                        (len(specs), render_all), min_level=2)
+        old_size = self.web_page.viewportSize()
+        try:
+            if render_all:
+                self.logger.log("Rendering whole page contents (RENDER_ALL)",
+                                min_level=2)
+                self.set_viewport('full')
+            regions = [self._get_spec_region(spec) for spec in specs]
+            canvas = QtWebkitScreenshotRenderer(
+                self.web_page, self.logger, 'PNG').render_canvas()
+            images = []
+            for spec, region in zip(specs, regions):
+                if spec.selector is not None and region is None:
+                    images.append(None)
+                    continue
+                renderer = QtWebkitScreenshotRenderer(
+                    self.web_page, self.logger, spec.renderer_format,
+                    width=spec.width, height=spec.height,
+                    scale_method='raster', region=region)
+                images.append(renderer.derive_image(canvas))
+        finally:
+            if old_size != self.web_page.viewportSize():
+                self.web_page.setViewportSize(old_size)
+        self.store_har_timing("_onScreenshotPrepared")
+
+        deferreds = []
+        for spec, image in zip(specs, images):
+            if image is None:
+                deferreds.append(defer.succeed(None))
+                continue
+            image_format, options = spec.encoder_args()
+            d = get_encoder().encode(encode_image, image, image_format,
+                                     b64=b64, **options)
+            d.addCallback(_with_size, image)
+            deferreds.append(d)
+        d = gather_encoded(deferreds)
+        d.addCallback(self._store_har_timing_passthrough,
+                      "_onScreenshotsRendered")
+        return d
+
+    def _get_spec_region(self, spec):
+        """ Return region of a screenshot spec, in viewport coordinates """
+        if spec.selector is None:
+            return spec.get_region(spec.region)
+        bounds = self.evaljs(SELECTOR_BOUNDS_JS % escape_js(spec.selector),
+                             dom_elements=False)
+        if not bounds:
+            return None
+        left, top, right, bottom = bounds
+        region = (math.floor(left), math.floor(top),
+                  math.ceil(right), math.ceil(bottom))
+        return spec.get_region(region)
+
+    def _get_png_image(self, width, height, render_all, scale_method, region):
+        self.logger.log(
+            "Getting PNG: width=%s, height=%s, "
+            "render_all=%s, scale_method=%s, region=%s" %
+            (width, height, render_all, scale_method, region), min_level=2)
+        return self._get_image('PNG', width, height, render_all,
+                               scale_method, region=region)
+
+    def _get_jpeg_image(self, width, height, render_all, scale_method,
+                        quality, region):
         self.logger.log(
             "Getting JPEG: width=%s, height=%s, "
             "render_all=%s, scale_method=%s, quality=%s, region=%s" %
             (width, height, render_all, scale_method, quality, region),
             min_level=2)
-        image = self._get_image('JPEG', width, height, render_all,
-                                scale_method, region=region)
-        result = image.to_jpeg(quality=quality)
-        if b64:
-            result = base64.b64encode(result).decode('utf-8')
-        self.store_har_timing("_onJpegRendered")
+        return self._get_image('JPEG', width, height, render_all,
+                               scale_method, region=region, quality=quality)
+
+    def _get_webp_image(self, width, height, render_all, scale_method,
+                        quality, lossless, method, region):
+        self.logger.log(
+            "Getting WebP: width=%s, height=%s, render_all=%s, "
+            "scale_method=%s, quality=%s, lossless=%s, method=%s, "
+            "region=%s" % (width, height, render_all, scale_method, quality,
+                           lossless, method, region),
+            min_level=2)
+        options = {
+            'quality': defaults.WEBP_QUALITY if quality is None else quality,
+            'lossless': bool(lossless),
+            'method': defaults.WEBP_METHOD if method is None else method,
+        }
+        cache_quality = (options['quality'], options['lossless'],
+                         options['method'])
+        image = self._get_image('WEBP', width, height, render_all,
+                                scale_method, region=region,
+                                quality=cache_quality)
+        return image, options
+
+    def _get_raw_image(self, width, height, render_all, scale_method, region,
+                       pixel_format):
+        self.logger.log(
+            "Getting raw image: width=%s, height=%s, render_all=%s, "
+            "scale_method=%s, region=%s, pixel_format=%s" %
+            (width, height, render_all, scale_method, region, pixel_format),
+            min_level=2)
+        if pixel_format not in RAW_PIXEL_FORMATS:
+            raise ValueError("Unsupported pixel format: %s" % pixel_format)
+        # RGB images get a white background, like JPEG images.
+        # Raw images are taken from the canvas: tall pages must not be
+        # encoded to PNG while they are rendered only to be decoded again.
+        image_format = 'PNG' if pixel_format == 'RGBA' else 'JPEG'
+        return self._get_image(image_format, width, height, render_all,
+                               scale_method, region=region, use_cache=False,
+                               stream=False)
+
+    def _render_or_get_cached(self, renderer, image_format, quality):
+        cache = get_screenshot_cache()
+        if not cache.enabled or not self._screenshot_is_cacheable():
+            return renderer.render_qwebpage()
+        if image_format == 'JPEG' and quality is None:
+            quality = defaults.JPEG_QUALITY
+        key = renderer.get_cache_key(quality=quality)
+        cached = cache.get(key)
+        if cached is not None:
+            data, size = cached
+            self.logger.log("screenshot is taken from cache", min_level=2)
+            return EncodedImage(data, QSize(*size), image_format)
+        return CachingImage(renderer.render_qwebpage(), cache, key)
+
+    def _screenshot_is_cacheable(self):
+        """
+        Page state used for screenshot cache keys doesn't reflect
+        resources which are still loading and canvas contents,
+        so such pages are not cached.
+        """
+        if self.web_page.har.has_pending_requests():
+            return False
+        frames = [self.web_page.mainFrame()]
+        while frames:
+            frame = frames.pop()
+            if not frame.findFirstElement('canvas').isNull():
+                return False
+            frames.extend(frame.childFrames())
+        return True
+
+    def _store_har_timing_passthrough(self, result, name):
+        if not self.closing:
+            self.store_har_timing(name)
         return result
 
     def iframes_info(self, children=True, html=True):
@@ -837,6 +1189,7 @@ class WebkitBrowserTab(BrowserTab):
         """ Return HAR information """
         self.logger.log("getting HAR", min_level=3)
         res = self.web_page.har.todict()
+        metrics.HAR_ENTRIES.observe(len(res['log']['entries']))
         if reset:
             self.har_reset()
         return res
@@ -970,3 +1323,7 @@ class _JavascriptConsole(QObject):
     @pyqtSlot(str)
     def log(self, message):
         self.messages.append(str(message))
+
+
+def _with_size(data, image):
+    return data, (image.size.width(), image.size.height())
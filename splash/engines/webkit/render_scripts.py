@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 import abc
-import json
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from splash import defaults
+from splash.image_encoding import gather_encoded
+from splash.raw_image import RAW_CONTENT_TYPE
+from splash.screenshot_specs import ScreenshotSpec
+from splash.utils import BinaryCapsule, StreamedJSON
 from splash.engines.webkit import WebkitBrowserTab
 from splash.render_scripts import (
     BaseRenderScript,
@@ -13,9 +19,18 @@ from splash.render_scripts import (
 
 class WebkitRenderScript(BaseRenderScript):
     """ Base class for Webkit-based render scripts """
+
+    # If True, RenderPool may pass a reset WebkitBrowserTab
+    # to the constructor instead of creating a new one.
+    tab_reuse_supported = False
+
     def __init__(self, render_options, verbosity, network_manager,
-                 splash_proxy_factory):
+                 splash_proxy_factory, tab=None):
         super().__init__(render_options, verbosity)
+        if tab is not None:
+            tab.rebind(render_options, splash_proxy_factory)
+            self.tab = tab
+            return
         self.tab = WebkitBrowserTab(
             render_options=render_options,
             verbosity=verbosity,
@@ -37,11 +52,14 @@ class WebkitDefaultRenderScript(WebkitRenderScript, BaseFixedRenderScript):
     This class is not used directly; its subclasses are used.
     Subclasses choose how to return the result (as html, json, png).
     """
+    tab_reuse_supported = True
+
     def start(self, url, baseurl=None, wait=None, viewport=None,
               js_source=None, js_profile=None, images=None, console=False,
               headers=None, http_method='GET', body=None,
               render_all=False, resource_timeout=None, request_body=False,
-              response_body=False, html5_media=False, http2=False):
+              response_body=False, html5_media=False, http2=False,
+              http_cache=True):
         self.url = url
         self.wait_time = defaults.WAIT_TIME if wait is None else wait
         self.js_source = js_source
@@ -63,6 +81,7 @@ class WebkitDefaultRenderScript(WebkitRenderScript, BaseFixedRenderScript):
         self.tab.set_response_body_enabled(response_body)
         self.tab.set_html5_media_enabled(html5_media)
         self.tab.set_http2_enabled(http2)
+        self.tab.set_http_cache_enabled(http_cache)
 
         self.tab.go(
             url=url,
@@ -79,7 +98,7 @@ class WebkitDefaultRenderScript(WebkitRenderScript, BaseFixedRenderScript):
         """
         This method is called to get the result after the requested page is
         downloaded and rendered. Subclasses should implement it to customize
-        which data to return.
+        which data to return. It may return a Deferred.
         """
         pass
 
@@ -88,7 +107,18 @@ class WebkitDefaultRenderScript(WebkitRenderScript, BaseFixedRenderScript):
         super()._load_finished_ok()
         self.tab.store_har_timing("_onPrepareStart")
         self._prepare_render()
-        self.return_result(self.get_result())
+        d = defer.maybeDeferred(self.get_result)
+        d.addBoth(self._on_result_ready)
+
+    def _on_result_ready(self, result):
+        if self._result_already_returned():
+            # e.g. render timeout happened while an image was encoded
+            self.log("result is ignored because render is already finished")
+            return
+        if isinstance(result, Failure):
+            self.return_error(result)
+        else:
+            self.return_result(result)
 
     def _runjs(self, js_source, js_profile):
         js_output, js_console_output = None, None
@@ -127,15 +157,27 @@ class ImageRender(WebkitDefaultRenderScript):
         self.width = kwargs.pop('width')
         self.height = kwargs.pop('height')
         self.scale_method = kwargs.pop('scale_method')
+        self.raw = kwargs.pop('raw', False)
+        self.downsample = kwargs.pop('downsample', 1)
         return super(ImageRender, self).start(**kwargs)
 
+    def get_raw_result(self, pixel_format):
+        d = self.tab.raw_deferred(self.width, self.height,
+                                  render_all=self.render_all,
+                                  scale_method=self.scale_method,
+                                  pixel_format=pixel_format,
+                                  downsample=self.downsample)
+        return d.addCallback(BinaryCapsule, RAW_CONTENT_TYPE)
+
 
 class PngRender(ImageRender):
 
     def get_result(self):
-        return self.tab.png(self.width, self.height,
-                            render_all=self.render_all,
-                            scale_method=self.scale_method)
+        if self.raw:
+            return self.get_raw_result('RGBA')
+        return self.tab.png_deferred(self.width, self.height,
+                                     render_all=self.render_all,
+                                     scale_method=self.scale_method)
 
 
 class JpegRender(ImageRender):
@@ -145,17 +187,35 @@ class JpegRender(ImageRender):
         return super(JpegRender, self).start(**kwargs)
 
     def get_result(self):
-        return self.tab.jpeg(
+        if self.raw:
+            return self.get_raw_result('RGB')
+        return self.tab.jpeg_deferred(
             self.width, self.height, render_all=self.render_all,
             scale_method=self.scale_method, quality=self.quality)
 
 
+class WebpRender(ImageRender):
+
+    def start(self, **kwargs):
+        self.quality = kwargs.pop('quality')
+        self.lossless = kwargs.pop('lossless')
+        self.method = kwargs.pop('method')
+        return super(WebpRender, self).start(**kwargs)
+
+    def get_result(self):
+        return self.tab.webp_deferred(
+            self.width, self.height, render_all=self.render_all,
+            scale_method=self.scale_method, quality=self.quality,
+            lossless=self.lossless, method=self.method)
+
+
 class JsonRender(JpegRender):
 
     def start(self, **kwargs):
         include_options = ['html', 'png', 'jpeg', 'iframes',
                            'script', 'history', 'har']
         self.include = {inc: kwargs.pop(inc) for inc in include_options}
+        self.screenshots = kwargs.pop('screenshots', None)
         self.include['console'] = kwargs.get('console')
         if not self.include['har'] and not self.include['history']:
             kwargs['request_body'] = False
@@ -163,18 +223,78 @@ class JsonRender(JpegRender):
         super(JsonRender, self).start(**kwargs)
 
     def get_result(self):
-        res = {}
+        # Pages are rendered right away; encoding may happen in threads.
+        # Other fields are collected now as well, so that they match
+        # the images even if page JS keeps running while images are encoded.
+        res = self._get_page_info()
+        if self.screenshots or (self.include['png'] and
+                                self.include['jpeg'] and
+                                self.scale_method == 'raster'):
+            return self._get_derived_images(res)
+        images = []
+        if self.include['png']:
+            images.append(('png', 'image/png', self.tab.png_deferred(
+                self.width, self.height,
+                render_all=self.render_all,
+                scale_method=self.scale_method)))
+        if self.include['jpeg']:
+            images.append(('jpeg', 'image/jpeg', self.tab.jpeg_deferred(
+                self.width, self.height,
+                render_all=self.render_all,
+                scale_method=self.scale_method,
+                quality=self.quality)))
+
+        d = gather_encoded([img_d for _, _, img_d in images])
+        d.addCallback(self._get_json_result, images, res)
+        return d
 
+    def _get_derived_images(self, res):
+        """
+        Render the page once and derive png, jpeg and screenshots
+        images from this rendering.
+        """
+        specs = list(self.screenshots or [])
+        images = []
         if self.include['png']:
-            res['png'] = self.tab.png(self.width, self.height, b64=True,
-                                      render_all=self.render_all,
-                                      scale_method=self.scale_method)
+            images.append(('png', 'image/png', None))
+            specs.append(ScreenshotSpec('png', self.width, self.height))
         if self.include['jpeg']:
-            res['jpeg'] = self.tab.jpeg(self.width, self.height, b64=True,
-                                        render_all=self.render_all,
-                                        scale_method=self.scale_method,
-                                        quality=self.quality)
+            images.append(('jpeg', 'image/jpeg', None))
+            specs.append(ScreenshotSpec('jpeg', self.width, self.height,
+                                        quality=self.quality))
+        d = self.tab.screenshots_deferred(specs, render_all=self.render_all)
+        d.addCallback(self._get_derived_json_result, images, res)
+        return d
+
+    def _get_derived_json_result(self, results, images, res):
+        num_screenshots = len(results) - len(images)
+        image_data = [data for data, size in results[num_screenshots:]]
+        res = self._get_json_result(image_data, images, res)
+        if res is None or not self.screenshots:
+            return res
+        res.data['screenshots'] = [
+            None if result is None else {
+                'format': spec.format,
+                'width': result[1][0],
+                'height': result[1][1],
+                'data': BinaryCapsule(result[0], spec.content_type),
+            }
+            for spec, result in zip(self.screenshots, results)
+        ]
+        return res
+
+    def _get_json_result(self, image_data, images, res):
+        if self._result_already_returned():
+            return None
 
+        # images are base64-encoded when the result is serialized
+        for (key, content_type, _), data in zip(images, image_data):
+            res[key] = BinaryCapsule(data, content_type)
+        return StreamedJSON(res)
+
+    def _get_page_info(self):
+        """ Return all result fields except images """
+        res = {}
         if self.include['script'] and self.js_output:
             res['script'] = self.js_output
 
@@ -197,5 +317,5 @@ class JsonRender(JpegRender):
 
 class HarRender(WebkitDefaultRenderScript):
     def get_result(self):
-        return json.dumps(self.tab.har())
+        return StreamedJSON(self.tab.har())
 
@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 import math
+import time
 
 import attr
 from PyQt5.QtCore import QRect, QSize, QPoint
 from PyQt5.QtGui import QPainter, QRegion
 
-from splash import defaults
+from splash import defaults, metrics
+from splash.png_stream import PngStreamWriter
 from splash.qtrender_image import (
     BaseQtScreenshotRenderer, WrappedImage,
     WrappedQImage,
     WrappedPillowImage,
+    EncodedImage,
 )
+from splash.qtutils import qsize_to_tuple
+from splash.utils import to_bytes
+from .webpage import PER_RENDER_WEBPAGE_OPTIONS
 
 
 @attr.s
@@ -43,6 +49,26 @@ class QtWebkitScreenshotRenderer(BaseQtScreenshotRenderer):
         """ Return size of the current viewport """
         return self.web_page.viewportSize()
 
+    def get_page_fingerprint(self):
+        frame = self.web_page.mainFrame()
+        settings = self.web_page.settings()
+        state = (
+            frame.url().toString(),
+            qsize_to_tuple(self.web_page.viewportSize()),
+            qsize_to_tuple(frame.contentsSize()),
+            frame.scrollPosition().x(), frame.scrollPosition().y(),
+            [settings.testAttribute(attr)
+             for attr in PER_RENDER_WEBPAGE_OPTIONS],
+        )
+        parts = [repr(state).encode('utf8')]
+        frames = [frame]
+        while frames:
+            frame = frames.pop(0)
+            parts.append(to_bytes(frame.url().toString()))
+            parts.append(to_bytes(frame.toHtml()))
+            frames.extend(frame.childFrames())
+        return b"\0".join(parts)
+
     def _render_qwebpage_full(self,
                               web_rect: QRect,
                               render_rect: QRect,
@@ -71,6 +97,7 @@ class QtWebkitScreenshotRenderer(BaseQtScreenshotRenderer):
                                web_rect: QRect,
                                render_rect: QRect,
                                canvas_size: QSize,
+                               stream: bool = False,
                                ) -> 'WrappedImage':
         """ Render web page tile-by-tile.
 
@@ -93,7 +120,19 @@ class QtWebkitScreenshotRenderer(BaseQtScreenshotRenderer):
         tile_conf = self._calculate_tiling(
             to_paint=render_rect.intersected(QRect(QPoint(0, 0), canvas_size)))
 
-        canvas = self.img_converter.new_pillow_image(canvas_size)
+        #
+        # Tiles are rendered row by row; each row of tiles (a band) is
+        # assembled in a Pillow image which is either pasted to a full-size
+        # canvas or, when ``stream`` is True and the result is PNG, passed
+        # to a streaming PNG encoder right away, so that uncompressed
+        # full-size image is never kept in memory.
+        if stream and self.img_converter.target_format == 'PNG':
+            output = _StreamingCanvas(canvas_size,
+                                      self.img_converter.pillow_image_format)
+        else:
+            output = _PillowCanvas(
+                self.img_converter.new_pillow_image(canvas_size))
+
         ratio = render_rect.width() / float(web_rect.width())
         tile_qimage = self.img_converter.new_qimage(tile_conf.tile_size, fill=False)
         painter = QPainter(tile_qimage)
@@ -110,12 +149,24 @@ class QtWebkitScreenshotRenderer(BaseQtScreenshotRenderer):
             # painter.setClipRect(web_rect)
             self.logger.log(
                 "Tiled rendering. tile_conf=%s; web_rect=%s, render_rect=%s, "
-                "canvas_size=%s" % (tile_conf, web_rect, render_rect, canvas_size),
+                "canvas_size=%s, streaming=%s" % (
+                    tile_conf, web_rect, render_rect, canvas_size,
+                    output.streaming),
                 min_level=2)
-            for i in range(tile_conf.horizontal_count):
-                left = i * tile_qimage.width()
-                for j in range(tile_conf.vertical_count):
-                    top = j * tile_qimage.height()
+            for j in range(tile_conf.vertical_count):
+                top = j * tile_qimage.height()
+                # If this is the bottommost tile, its bottom may have stuff
+                # left over from rendering the previous tile.  Make sure
+                # these leftovers don't garble the bottom of the canvas
+                # which can be larger than render_rect because of
+                # "height=" option.
+                rendered_vsize = min(render_rect.height() - top,
+                                     tile_qimage.height(),
+                                     canvas_size.height() - top)
+                band = self.img_converter.new_pillow_image(
+                    (canvas_size.width(), rendered_vsize))
+                for i in range(tile_conf.horizontal_count):
+                    left = i * tile_qimage.width()
                     painter.setViewport(render_rect.translated(-left, -top))
                     self.logger.log("Rendering with viewport=%s"
                                % painter.viewport(), min_level=2)
@@ -126,29 +177,20 @@ class QtWebkitScreenshotRenderer(BaseQtScreenshotRenderer):
                         QPoint(math.ceil((left + tile_qimage.width()) / ratio),
                                math.ceil((top + tile_qimage.height()) / ratio)))
                     self.web_page.mainFrame().render(painter, QRegion(clip_rect))
-                    tile_image = self.img_converter.qimage_to_pil(tile_qimage)
-
-                    # If this is the bottommost tile, its bottom may have stuff
-                    # left over from rendering the previous tile.  Make sure
-                    # these leftovers don't garble the bottom of the canvas
-                    # which can be larger than render_rect because of
-                    # "height=" option.
-                    rendered_vsize = min(render_rect.height() - top,
-                                         tile_qimage.height())
-                    if rendered_vsize < tile_qimage.height():
-                        box = (0, 0, tile_qimage.width(), rendered_vsize)
-                        tile_image = tile_image.crop(box)
+                    tile_image = self.img_converter.qimage_to_pil(
+                        tile_qimage, height=rendered_vsize)
 
                     self.logger.log("Pasting rendered tile to coords: %s" %
                                     ((left, top),), min_level=2)
-                    canvas.paste(tile_image, (left, top))
+                    band.paste(tile_image, (left, 0))
+                output.add_band(band, top)
         finally:
             # It is important to end painter explicitly in python code, because
             # Python finalizer invocation order, unlike C++ destructors, is not
             # deterministic and there is a possibility of image's finalizer
             # running before painter's which may break tests and kill your cat.
             painter.end()
-        return WrappedPillowImage(canvas)
+        return output.get_image()
 
     def _calculate_tiling(self, to_paint: QRect) -> _TilingOptions:
         tile_maxsize = defaults.TILE_MAXSIZE
@@ -162,3 +204,43 @@ class QtWebkitScreenshotRenderer(BaseQtScreenshotRenderer):
             vertical_count=vtiles,
             tile_size=tile_size
         )
+
+
+class _PillowCanvas:
+    """ Full-size canvas for tiled rendering """
+    streaming = False
+
+    def __init__(self, image):
+        self.image = image
+
+    def add_band(self, band, top):
+        self.image.paste(band, (0, top))
+
+    def get_image(self):
+        return WrappedPillowImage(self.image)
+
+
+class _StreamingCanvas:
+    """ Tiled rendering output which compresses bands as PNG right away """
+    streaming = True
+
+    def __init__(self, canvas_size, mode):
+        self.size = QSize(canvas_size)
+        self.writer = PngStreamWriter(canvas_size.width(),
+                                      canvas_size.height(), mode)
+        self.encode_time = 0.0
+
+    def add_band(self, band, top):
+        start_time = time.time()
+        self.writer.write(band)
+        self.encode_time += time.time() - start_time
+
+    def get_image(self):
+        start_time = time.time()
+        # canvas may be taller than the rendered area (see "height" option)
+        self.writer.write_blank(self.writer.height - self.writer.rows_written)
+        data = self.writer.close()
+        self.encode_time += time.time() - start_time
+        metrics.IMAGE_ENCODE_DURATION.labels(format='png').observe(
+            self.encode_time)
+        return EncodedImage(data, self.size, 'PNG')
@@ -2,6 +2,7 @@
 
 import sip
 from PyQt5.QtWebKitWidgets import QWebPage
+from PyQt5.QtWebKit import QWebSettings
 from PyQt5.QtCore import QByteArray
 from twisted.python import log
 import traceback
@@ -9,7 +10,23 @@ import traceback
 from splash.browser_tab import WebpageEventLogger
 from splash.har_builder import HarBuilder
 from splash.errors import RenderErrorInfo
-from splash.qtutils import qurl2ascii
+from splash.qtutils import qurl2ascii, MediaSourceEnabled, MediaEnabled
+
+
+# QWebPage options which render scripts are allowed to change;
+# WebkitBrowserTab.reset restores their global defaults, and screenshot
+# cache keys include their values.
+PER_RENDER_WEBPAGE_OPTIONS = [
+    QWebSettings.AutoLoadImages,
+    QWebSettings.JavascriptEnabled,
+    QWebSettings.PluginsEnabled,
+    QWebSettings.PrivateBrowsingEnabled,
+    QWebSettings.LocalStorageEnabled,
+    QWebSettings.OfflineStorageDatabaseEnabled,
+    QWebSettings.WebGLEnabled,
+    MediaSourceEnabled,
+    MediaEnabled,
+]
 
 
 class WebkitWebPage(QWebPage):
@@ -32,6 +49,7 @@ class WebkitWebPage(QWebPage):
     request_body_enabled = False
     response_body_enabled = False
     http2_enabled = False
+    http_cache_enabled = True
 
     def __init__(self, verbosity=0):
         super(QWebPage, self).__init__()
@@ -34,6 +34,21 @@ class GlobalTimeoutError(Exception):
     pass
 
 
+class OverloadedError(Exception):
+    """ Splash is overloaded; request is rejected without queueing """
+    pass
+
+
+class QueueTimeoutError(Exception):
+    """ Request is not started because queue_timeout is exceeded """
+    pass
+
+
+class RenderTimeoutError(Exception):
+    """ Timeout exceeded rendering page after render is started """
+    pass
+
+
 class UnsupportedContentType(Exception):
     """ Request Content-Type is not supported """
     pass
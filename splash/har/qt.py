@@ -138,6 +138,23 @@ def reply2har(reply, content=None):
     return res
 
 
+def cache2har(reply):
+    """
+    Return HAR 'cache' object for a finished reply. If the request could
+    use HTTP cache (see ``--http-cache-size``), non-standard ``_fromCache``
+    field tells whether the reply was taken from the cache.
+    """
+    manager = reply.manager()
+    if manager is None or manager.cache() is None:
+        return {}
+    load_control = reply.request().attribute(
+        QNetworkRequest.CacheLoadControlAttribute)
+    if load_control == QNetworkRequest.AlwaysNetwork:
+        return {}
+    from_cache = reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute)
+    return {"_fromCache": bool(from_cache)}
+
+
 def _har_postdata(body, content_type):
     """
 
@@ -4,7 +4,7 @@ from datetime import datetime
 
 from splash.har.log import HarLog
 from splash.har.utils import format_datetime, get_duration, cleaned_har_entry
-from splash.har.qt import request2har, reply2har
+from splash.har.qt import request2har, reply2har, cache2har
 
 
 class HarBuilder(object):
@@ -45,6 +45,13 @@ class HarBuilder(object):
         except KeyError:
             return
 
+    def has_pending_requests(self):
+        """ Return True if some requests are not finished yet """
+        return any(
+            entry["_splash_processing_state"] != self.REQUEST_FINISHED
+            for entry in self.log.network_entries_map.values()
+        )
+
     def get_entry(self, req_id):
         """ Return HAR entry for a given req_id """
         if not self.log.has_entry(req_id):
@@ -147,6 +154,7 @@ class HarBuilder(object):
 
         # update other reply information
         entry["response"].update(reply2har(reply, content=content))
+        entry["cache"].update(cache2har(reply))
 
     def store_reply_headers_received(self, req_id, reply):
         """
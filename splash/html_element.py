@@ -200,12 +200,14 @@ class HTMLElement(object):
         Padding value can be negative which means that the image will be
         cropped.
         """
-        if not self.exists() or not self.visible():
-            return None
+        return self._screenshot(self.tab.png, width, pad,
+                                scale_method=scale_method)
 
-        with self._in_viewport():
-            region = _bounds_to_region(self.bounds(), pad)
-            return self.tab.png(width, region=region,
+    def png_deferred(self, width=None, scale_method=None, pad=None):
+        """ Same as :meth:`png`, but return a Deferred
+        (see ``BrowserTab.png_deferred``), or None if element is not visible.
+        """
+        return self._screenshot(self.tab.png_deferred, width, pad,
                                 scale_method=scale_method)
 
     def jpeg(self, width=None, scale_method=None, quality=None, pad=None):
@@ -220,14 +222,43 @@ class HTMLElement(object):
         Padding value can be negative which means that the image will
         be cropped.
         """
+        return self._screenshot(self.tab.jpeg, width, pad,
+                                scale_method=scale_method, quality=quality)
+
+    def jpeg_deferred(self, width=None, scale_method=None, quality=None,
+                      pad=None):
+        """ Same as :meth:`jpeg`, but return a Deferred
+        (see ``BrowserTab.jpeg_deferred``), or None if element is not visible.
+        """
+        return self._screenshot(self.tab.jpeg_deferred, width, pad,
+                                scale_method=scale_method, quality=quality)
+
+    def webp(self, width=None, scale_method=None, quality=None,
+             lossless=False, method=None, pad=None):
+        """ Return screenshot of the element in WebP format.
+
+        ``pad`` argument works in the same way as in :meth:`png`.
+        """
+        return self._screenshot(self.tab.webp, width, pad,
+                                scale_method=scale_method, quality=quality,
+                                lossless=lossless, method=method)
+
+    def webp_deferred(self, width=None, scale_method=None, quality=None,
+                      lossless=False, method=None, pad=None):
+        """ Same as :meth:`webp`, but return a Deferred
+        (see ``BrowserTab.webp_deferred``), or None if element is not visible.
+        """
+        return self._screenshot(self.tab.webp_deferred, width, pad,
+                                scale_method=scale_method, quality=quality,
+                                lossless=lossless, method=method)
+
+    def _screenshot(self, tab_method, width, pad, **kwargs):
         if not self.exists() or not self.visible():
             return None
 
         with self._in_viewport():
             region = _bounds_to_region(self.bounds(), pad)
-            return self.tab.jpeg(width, region=region,
-                                 scale_method=scale_method,
-                                 quality=quality)
+            return tab_method(width, region=region, **kwargs)
 
     def visible(self):
         """ Return flag indicating whether element is visible """
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk HTTP cache shared between renders (``--http-cache-size``).
+
+By default every render downloads all subresources (scripts, stylesheets,
+fonts, images) again. With the cache enabled responses are stored
+in a folder according to their HTTP caching headers, and renders of
+the same website reuse them.
+
+QNetworkAccessManager takes ownership of its cache, so a single
+QNetworkDiskCache can't be set for several managers; each manager gets
+a :class:`SharedNetworkCache` proxy which forwards calls to the global
+:class:`LRUDiskCache` instead.
+
+The cache is shared by renders of all clients, so responses which
+may contain per-user data are not stored (see :func:`is_shareable`);
+requests with credentials are not stored as well (see
+``SplashQNetworkAccessManager._handle_cache_policy``).
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from PyQt5.QtCore import QDir, QDirIterator
+from PyQt5.QtNetwork import (
+    QAbstractNetworkCache,
+    QNetworkDiskCache,
+    QNetworkRequest,
+)
+from twisted.python import log
+
+from splash.qtutils import qurl2ascii
+
+
+# Values of request:set_cache_policy() argument
+CACHE_POLICIES = {
+    'default': QNetworkRequest.PreferNetwork,
+    'network': QNetworkRequest.AlwaysNetwork,
+    'prefer_cache': QNetworkRequest.PreferCache,
+    'cache_only': QNetworkRequest.AlwaysCache,
+}
+
+
+def is_shareable(meta_data):
+    """
+    Return True if a response with QNetworkCacheMetaData ``meta_data``
+    can be stored in a cache shared between users: it is not marked
+    as private, it doesn't set cookies and it doesn't vary on request
+    headers other than Accept-Encoding (Qt ignores Vary header, and
+    Accept-Encoding is the same for all requests).
+    """
+    for name, value in meta_data.rawHeaders():
+        name = bytes(name).decode('latin1').strip().lower()
+        value = bytes(value).decode('latin1').lower()
+        if name == 'cache-control':
+            directives = {d.split('=')[0].strip() for d in value.split(',')}
+            if directives & {'private', 'no-store'}:
+                return False
+        elif name in {'set-cookie', 'set-cookie2'}:
+            return False
+        elif name == 'vary':
+            fields = {f.strip() for f in value.split(',')} - {''}
+            if fields - {'accept-encoding'}:
+                return False
+    return True
+
+
+class LRUDiskCache(QNetworkDiskCache):
+    """
+    QNetworkDiskCache which evicts least recently used entries.
+
+    QNetworkDiskCache removes the oldest files when the cache is full,
+    even if they are used by every render. Here the last access time
+    of each URL is tracked, and :meth:`expire` removes entries which
+    weren't read for the longest time.
+    """
+    def __init__(self, path, max_size, parent=None):
+        super(LRUDiskCache, self).__init__(parent)
+        self.setCacheDirectory(path)
+        self.setMaximumCacheSize(max_size)
+        self._last_access = {}  # url => time.time() of the last hit
+
+    def data(self, url):
+        device = super(LRUDiskCache, self).data(url)
+        if device is not None:
+            self._last_access[qurl2ascii(url)] = time.time()
+        return device
+
+    def remove(self, url):
+        self._last_access.pop(qurl2ascii(url), None)
+        return super(LRUDiskCache, self).remove(url)
+
+    def expire(self):
+        """
+        Remove least recently used entries until the cache takes less
+        than 90% of maximumCacheSize (like QNetworkDiskCache does);
+        return the resulting cache size.
+        """
+        entries = []
+        total_size = 0
+        it = QDirIterator(self.cacheDirectory(), ['*.d'], QDir.Files,
+                          QDirIterator.Subdirectories)
+        while it.hasNext():
+            path = it.next()
+            info = it.fileInfo()
+            url = qurl2ascii(self.fileMetaData(path).url())
+            accessed = self._last_access.get(
+                url, info.lastModified().toMSecsSinceEpoch() / 1000.0)
+            entries.append((accessed, path, url, info.size()))
+            total_size += info.size()
+
+        goal = self.maximumCacheSize() * 9 // 10
+        entries.sort()
+        for accessed, path, url, size in entries:
+            if total_size <= goal:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._last_access.pop(url, None)
+            total_size -= size
+        return total_size
+
+
+class SharedNetworkCache(QAbstractNetworkCache):
+    """
+    Per-QNetworkAccessManager proxy for a shared QNetworkDiskCache.
+    """
+    def __init__(self, cache, parent=None):
+        super(SharedNetworkCache, self).__init__(parent)
+        self.cache = cache
+
+    def metaData(self, url):
+        return self.cache.metaData(url)
+
+    def updateMetaData(self, meta_data):
+        self.cache.updateMetaData(meta_data)
+
+    def data(self, url):
+        return self.cache.data(url)
+
+    def remove(self, url):
+        return self.cache.remove(url)
+
+    def cacheSize(self):
+        return self.cache.cacheSize()
+
+    def prepare(self, meta_data):
+        if not is_shareable(meta_data):
+            return None
+        return self.cache.prepare(meta_data)
+
+    def insert(self, device):
+        self.cache.insert(device)
+
+    def clear(self):
+        self.cache.clear()
+
+
+_cache = None
+
+
+def get_http_cache():
+    """ Return the global LRUDiskCache, or None if the cache is disabled """
+    return _cache
+
+
+def setup_http_cache(max_size_mb, path=None):
+    """
+    Create the global LRUDiskCache in a new subfolder of ``path``
+    (a system temporary folder by default); the subfolder is removed
+    on shutdown. Each Splash process gets its own subfolder because
+    QNetworkDiskCache can't be used by several processes.
+    """
+    global _cache
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+    path = tempfile.mkdtemp(prefix='http-cache-', dir=path)
+    _cache = LRUDiskCache(path, int(max_size_mb * 1024 ** 2))
+
+    from twisted.internet import reactor
+    reactor.addSystemEventTrigger('after', 'shutdown', shutil.rmtree,
+                                  path, ignore_errors=True)
+    log.msg("HTTP cache: %s MB, path: %s" % (max_size_mb, path))
+    return _cache
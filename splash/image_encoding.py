@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Screenshot encoding (PNG/JPEG/WebP compression, raw images and base64) outside of the
+reactor thread.
+
+Compressing a large screenshot can take hundreds of milliseconds; when it
+happens in the reactor thread, all other render slots are stalled.
+Pillow and Qt release the GIL while encoding, so encoding screenshots in
+a thread pool allows other renders to proceed meanwhile.
+
+By default (``--image-encoding-threads 0``) images are encoded in
+the reactor thread, as before.
+"""
+import base64
+
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+
+class ImageEncoder:
+    """
+    Run image encoding functions in a thread pool and return Deferreds.
+    When ``num_threads`` is 0, functions are called in the current thread.
+    """
+    def __init__(self, num_threads=0):
+        self.num_threads = num_threads
+        self.threadpool = None
+
+    @property
+    def is_threaded(self):
+        return self.threadpool is not None
+
+    def start(self, reactor=None):
+        if self.num_threads <= 0 or self.threadpool is not None:
+            return
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.threadpool = ThreadPool(minthreads=0,
+                                     maxthreads=self.num_threads,
+                                     name="splash-image-encoding")
+        self.threadpool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.threadpool is not None:
+            self.threadpool.stop()
+            self.threadpool = None
+
+    def encode(self, func, *args, **kwargs):
+        """
+        Call ``func(*args, **kwargs)`` and return a Deferred with the result.
+        ``func`` is called in a thread pool, so it must not touch Qt objects
+        other than the image being encoded.
+        """
+        if self.threadpool is None:
+            return defer.maybeDeferred(func, *args, **kwargs)
+        return threads.deferToThreadPool(self.reactor, self.threadpool,
+                                         func, *args, **kwargs)
+
+
+_encoder = ImageEncoder()
+
+
+def get_encoder():
+    """ Return the global ImageEncoder """
+    return _encoder
+
+
+def setup_encoder(num_threads, reactor=None):
+    """ Replace the global ImageEncoder with the one using ``num_threads`` """
+    global _encoder
+    _encoder.stop()
+    _encoder = ImageEncoder(num_threads)
+    _encoder.start(reactor)
+    log.msg("image encoding threads: %s" % (num_threads or "off"))
+    return _encoder
+
+
+def gather_encoded(deferreds):
+    """
+    Return a Deferred which fires with a list of results of ``deferreds``
+    (e.g. returned by :meth:`ImageEncoder.encode`), or fails with
+    the first error.
+    """
+    d = defer.gatherResults(deferreds, consumeErrors=True)
+    d.addErrback(_unwrap_first_error)
+    return d
+
+
+def _unwrap_first_error(failure):
+    failure.trap(defer.FirstError)
+    return failure.value.subFailure
+
+
+def encode_image(image, image_format, quality=None, b64=False, **options):
+    """
+    Serialize WrappedImage ``image`` as PNG, JPEG, WebP or RAW; return
+    bytes or, if ``b64`` is True, a base64-encoded string. Extra ``options``
+    are passed to WebP (``lossless`` and ``method``) and RAW
+    (``pixel_format`` and ``downsample``) encoders.
+    """
+    if image_format == 'PNG':
+        result = image.to_png()
+    elif image_format == 'JPEG':
+        result = image.to_jpeg(quality=quality)
+    elif image_format == 'WEBP':
+        if quality is not None:
+            options['quality'] = quality
+        result = image.to_webp(**options)
+    elif image_format == 'RAW':
+        result = image.to_raw(**options)
+    else:
+        raise ValueError("Unsupported image format %r" % image_format)
+    if b64:
+        result = base64.b64encode(result).decode('utf-8')
+    return result
@@ -170,7 +170,7 @@ class SplashKernel(Kernel):
                     'text/plain': result if isinstance(result, str) else str(result),
                 }
                 if isinstance(result, BinaryCapsule):
-                    if result.content_type in {'image/png', 'image/jpeg'}:
+                    if result.content_type in {'image/png', 'image/jpeg', 'image/webp'}:
                         data[result.content_type] = result.as_b64()
                 self._publish_execute_result(parent, data, {}, self.execution_count)
 
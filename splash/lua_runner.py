@@ -4,6 +4,7 @@ import itertools
 
 import lupa
 
+from splash import metrics
 from splash.errors import ScriptError, InternalError
 from splash.lua import parse_error_message, PyResult
 from splash.utils import truncated, ensure_tuple
@@ -173,6 +174,7 @@ class BaseScriptRunner(metaclass=abc.ABCMeta):
                     })
 
                 self._print_instructions_used()
+                self._record_instructions_used()
                 self.on_result(res)
                 return
             except lupa.LuaError as lua_ex:
@@ -181,6 +183,7 @@ class BaseScriptRunner(metaclass=abc.ABCMeta):
 
                 # Lua script raised an error
                 self._print_instructions_used()
+                self._record_instructions_used()
                 self.log("[lua_runner] caught LuaError %r" % lua_ex)
 
                 # this can raise a ScriptError
@@ -207,6 +210,10 @@ class BaseScriptRunner(metaclass=abc.ABCMeta):
                 self.log("[lua_runner] got non-command")
                 self.result = cmd
 
+    def _record_instructions_used(self):
+        if self.sandboxed:
+            metrics.LUA_INSTRUCTIONS.observe(self.lua.instruction_count())
+
     def _print_instructions_used(self):
         if self.sandboxed:
             self.log("[lua_runner] instructions used: %d" % self.lua.instruction_count())
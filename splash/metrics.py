@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal metrics support: counters, gauges and histograms exported
+in Prometheus text format by /metrics endpoint.
+
+Metrics are process-wide; they are declared at the bottom of this module
+and updated from the code which knows about the events::
+
+    from splash import metrics
+    metrics.ADBLOCK_BLOCKED_REQUESTS.labels(filter='easylist').inc()
+
+Metrics can be updated from any thread (e.g. image encoding threads).
+"""
+import math
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry:
+    """ A collection of metrics which are exported together """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """ Return all metrics in Prometheus text format """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, _escape_help(metric.documentation)))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, _format_labels(labels),
+                                          _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # label values -> child
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # export metrics without labels even if they are not updated
+            self.labels()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, **labels):
+        """ Return a metric for the given label values """
+        if set(labels) != set(self.labelnames):
+            raise ValueError("%s expects labels %s, got %s" % (
+                self.name, self.labelnames, sorted(labels)))
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self._new_child()
+        return child
+
+    def _unlabelled(self):
+        if self.labelnames:
+            raise ValueError("%s requires labels %s" % (
+                self.name, self.labelnames))
+        return self.labels()
+
+    def samples(self):
+        """ Yield (name, labels, value) tuples """
+        with self._lock:
+            children = sorted(self._children.items())
+        for key, child in children:
+            labels = list(zip(self.labelnames, key))
+            for suffix, extra_labels, value in child.samples():
+                yield self.name + suffix, labels + extra_labels, value
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def samples(self):
+        yield "", [], self.value
+
+
+class _CounterValue(_Value):
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("Counters can only be incremented")
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeValue(_Value):
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = float(value)
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        """ Observe the time (in seconds) spent in a ``with`` block """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start_time)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total_sum, total_count = self.sum, self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield "_bucket", [("le", _format_value(bound))], cumulative
+        yield "_bucket", [("le", "+Inf")], total_count
+        yield "_sum", [], total_sum
+        yield "_count", [], total_count
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._unlabelled().inc(amount)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def inc(self, amount=1):
+        self._unlabelled().inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabelled().dec(amount)
+
+    def set(self, value):
+        self._unlabelled().set(value)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled().observe(value)
+
+    def time(self):
+        return self._unlabelled().time()
+
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})? (\S+)$')
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_samples(text):
+    """
+    Parse metrics in Prometheus text format, e.g. a response of /metrics
+    endpoint. Return a dict ``{(name, labels): value}``, where ``labels``
+    is a sorted tuple of ``(label, value)`` pairs.
+
+    >>> parse_samples('# TYPE x counter\\nx{b="2",a="1"} 3.0\\ny 1')
+    {('x', (('a', '1'), ('b', '2'))): 3.0, ('y', ()): 1.0}
+    """
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE_RE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        labels = tuple(sorted(
+            (label, _unescape_label_value(label_value))
+            for label, label_value in _LABEL_RE.findall(labels or "")
+        ))
+        samples[name, labels] = float(value)
+    return samples
+
+
+def _unescape_label_value(value):
+    return re.sub(r'\\(.)',
+                  lambda m: "\n" if m.group(1) == "n" else m.group(1), value)
+
+
+def _escape_help(text):
+    return text.replace("\\", r"\\").replace("\n", r"\n")
+
+
+def _escape_label_value(value):
+    return (value.replace("\\", r"\\")
+                 .replace("\n", r"\n")
+                 .replace('"', r'\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, _escape_label_value(str(value)))
+        for name, value in labels
+    )
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+# Request metrics; 'endpoint' is a name of a render endpoint, e.g. render.html
+REQUESTS = Counter(
+    "splash_requests_total",
+    "Render requests by endpoint, engine and HTTP status code",
+    ["endpoint", "engine", "status"])
+REQUEST_DURATION = Histogram(
+    "splash_request_duration_seconds",
+    "Total time to process a render request, including time in the queue",
+    ["endpoint", "engine"])
+QUEUE_WAIT = Histogram(
+    "splash_queue_wait_seconds",
+    "Time render requests spent waiting for a render slot",
+    ["endpoint", "engine"])
+RENDER_DURATION = Histogram(
+    "splash_render_duration_seconds",
+    "Time render requests spent in a render slot",
+    ["endpoint", "engine"])
+
+# Render pool and process state; updated when metrics are requested
+SLOTS = Gauge("splash_slots", "Number of render slots")
+ACTIVE_SLOTS = Gauge("splash_active_slots", "Number of busy render slots")
+QUEUE_SIZE = Gauge("splash_queue_size",
+                   "Number of requests waiting for a render slot")
+OPEN_FDS = Gauge("splash_open_fds", "Number of open file descriptors")
+RSS = Gauge("splash_rss_bytes", "Resident set size of Splash process")
+MAX_RSS = Gauge("splash_max_rss_bytes",
+                "Peak resident set size of Splash process")
+CPU_SECONDS = Gauge("splash_cpu_seconds",
+                    "User and system CPU time of Splash process")
+
+# Rendering details
+IMAGE_ENCODE_DURATION = Histogram(
+    "splash_image_encode_seconds",
+    "Time spent encoding screenshots",
+    ["format"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+             0.5, 1.0, 2.5, 5.0))
+# 'full' and 'tiled' stages are rasterization of a page in one step or
+# tile-by-tile (tiled rendering includes conversion of tiles and, for PNG
+# images which are not scaled, encoding); 'convert' is QImage to Pillow
+# image conversion; 'resample' is raster scaling and cropping.
+IMAGE_RENDER_DURATION = Histogram(
+    "splash_image_render_seconds",
+    "Time spent rendering screenshots, by stage",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+             0.5, 1.0, 2.5, 5.0))
+HAR_ENTRIES = Histogram(
+    "splash_har_entries",
+    "Number of entries in HAR data returned to clients",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+LUA_INSTRUCTIONS = Histogram(
+    "splash_lua_instructions",
+    "Number of Lua instructions executed by sandboxed scripts",
+    buckets=(1e3, 1e4, 1e5, 1e6, 2.5e6, 5e6, 1e7))
+SCREENSHOT_CACHE_REQUESTS = Counter(
+    "splash_screenshot_cache_requests_total",
+    "Screenshot cache lookups by result (hit or miss)",
+    ["result"])
+HTTP_CACHE_REQUESTS = Counter(
+    "splash_http_cache_requests_total",
+    "Finished HTTP requests which could use HTTP cache, by result "
+    "(hit or miss)",
+    ["result"])
+ADBLOCK_BLOCKED_REQUESTS = Counter(
+    "splash_adblock_blocked_requests_total",
+    "Requests dropped by request filters",
+    ["filter"])
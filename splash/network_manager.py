@@ -25,16 +25,22 @@ from splash.request_middleware import (
     RequestResponseBodyTrackingMiddleware,
 )
 from splash.response_middleware import ContentTypeMiddleware
-from splash import defaults
+from splash import defaults, metrics
+from splash.har.qt import cache2har
+from splash.http_cache import SharedNetworkCache, setup_http_cache
 from splash.utils import to_bytes
 from splash.cookies import SplashCookieJar
 
 
 class NetworkManagerFactory(object):
-    def __init__(self, filters_path=None, verbosity=None, allowed_schemes=None, disable_browser_caches=None):
+    def __init__(self, filters_path=None, verbosity=None, allowed_schemes=None, disable_browser_caches=None,
+                 http_cache_size=0, http_cache_path=None):
         verbosity = defaults.VERBOSITY if verbosity is None else verbosity
         self.verbosity = verbosity
         self.disable_browser_caches = disable_browser_caches
+        self.http_cache = None
+        if http_cache_size and not disable_browser_caches:
+            self.http_cache = setup_http_cache(http_cache_size, http_cache_path)
         self.request_middlewares = []
         self.response_middlewares = []
         self.adblock_rules = None
@@ -69,7 +75,10 @@ class NetworkManagerFactory(object):
             verbosity=self.verbosity,
             disable_browser_caches=self.disable_browser_caches,
         )
-        manager.setCache(None)
+        if self.http_cache is not None:
+            manager.setCache(SharedNetworkCache(self.http_cache))
+        else:
+            manager.setCache(None)
         return manager
 
 
@@ -183,6 +192,7 @@ class ProxiedQNetworkAccessManager(QNetworkAccessManager):
                                     request, operation, content)
 
         self._handle_http2_options(request)
+        self._handle_cache_policy(request)
         self._handle_custom_proxies(request)
         self._handle_request_response_tracking(request)
 
@@ -260,7 +270,8 @@ class ProxiedQNetworkAccessManager(QNetworkAccessManager):
             req.setAttribute(QNetworkRequest.CacheLoadControlAttribute, QNetworkRequest.AlwaysNetwork)
             req.setAttribute(QNetworkRequest.CacheSaveControlAttribute, False)
 
-        for attr in ['timeout', 'track_request_body', 'track_response_body']:
+        for attr in ['timeout', 'track_request_body', 'track_response_body',
+                     'cache_policy']:
             if hasattr(request, attr):
                 setattr(req, attr, getattr(request, attr))
         return req, req_id
@@ -330,6 +341,29 @@ class ProxiedQNetworkAccessManager(QNetworkAccessManager):
             request.setAttribute(QNetworkRequest.HTTP2AllowedAttribute,
                                  http2_enabled)
 
+    def _handle_cache_policy(self, request):
+        if self.cache() is None or self.disable_browser_caches:
+            return
+        if self._get_webpage_attribute(request, "http_cache_enabled") is False:
+            request.setAttribute(QNetworkRequest.CacheLoadControlAttribute,
+                                 QNetworkRequest.AlwaysNetwork)
+            request.setAttribute(QNetworkRequest.CacheSaveControlAttribute,
+                                 False)
+            return
+        if hasattr(request, "cache_policy"):
+            request.setAttribute(QNetworkRequest.CacheLoadControlAttribute,
+                                 request.cache_policy)
+        if self._has_credentials(request):
+            # the cache is shared between clients; responses to requests
+            # with cookies or authentication are not stored
+            request.setAttribute(QNetworkRequest.CacheSaveControlAttribute,
+                                 False)
+
+    def _has_credentials(self, request):
+        return (request.hasRawHeader(b"Authorization") or
+                request.hasRawHeader(b"Cookie") or
+                bool(request.url().userInfo()))
+
     def _handle_request_response_tracking(self, request):
         track = getattr(request, 'track_response_body', False)
         request.setAttribute(self._SHOULD_TRACK, track)
@@ -401,6 +435,11 @@ class ProxiedQNetworkAccessManager(QNetworkAccessManager):
             har.store_reply_finished(req_id, reply, content)
             har_entry = har.get_entry(req_id)
 
+        cache_info = cache2har(reply)
+        if cache_info:
+            metrics.HTTP_CACHE_REQUESTS.labels(
+                result="hit" if cache_info["_fromCache"] else "miss").inc()
+
         # We're passing HAR entry to the callbacks because reply object
         # itself doesn't have all information.
         # Content is passed in order to avoid decoding it from base64.
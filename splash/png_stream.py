@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+PNG encoder which accepts an image in horizontal bands, so that large
+screenshots can be compressed while they are rendered, without keeping
+the whole uncompressed image in memory.
+"""
+import struct
+import zlib
+
+from PIL import Image
+
+from splash import defaults
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG color types for Pillow image modes
+_COLOR_TYPES = {'RGB': 2, 'RGBA': 6}
+
+# compressed data is written in IDAT chunks of about this size
+_IDAT_SIZE = 256 * 1024
+
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(data, zlib.crc32(chunk_type))
+    return b"".join([
+        struct.pack(">I", len(data)), chunk_type, data,
+        struct.pack(">I", crc & 0xffffffff),
+    ])
+
+
+class PngStreamWriter:
+    """
+    Encode a ``width`` x ``height`` PNG image from Pillow images
+    (bands) passed to :meth:`write`; bands must have the same width and
+    mode as the resulting image. Call :meth:`close` to get PNG data.
+
+    Rows are written without PNG filters: deflate compresses typical
+    screenshots about as well without them, and this way each band is
+    passed to zlib with a single call.
+    """
+    def __init__(self, width: int, height: int, mode: str = 'RGBA',
+                 complevel: int = defaults.PNG_COMPRESSION_LEVEL) -> None:
+        if mode not in _COLOR_TYPES:
+            raise ValueError("Unsupported image mode: %s" % mode)
+        if width <= 0 or height <= 0:
+            raise ValueError("Invalid image size: %sx%s" % (width, height))
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(complevel)
+        self._chunks = [PNG_SIGNATURE, _chunk(b'IHDR', struct.pack(
+            ">IIBBBBB", width, height, 8, _COLOR_TYPES[mode], 0, 0, 0))]
+        self._idat = bytearray()
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def write(self, band: Image.Image) -> None:
+        """ Append rows of ``band`` image to the PNG image """
+        if band.mode != self.mode or band.width != self.width:
+            raise ValueError(
+                "Band must be a %s image %s pixels wide, got %s %s" % (
+                    self.mode, self.width, band.mode, band.size))
+        if self.rows_written + band.height > self.height:
+            raise ValueError("Too many rows: %d > %d" % (
+                self.rows_written + band.height, self.height))
+        if band.height == 0:
+            return
+        data = memoryview(band.tobytes())
+        stride = len(data) // band.height
+        # each row is prefixed with a filter type byte (0 - no filter)
+        rows = (data[i:i + stride] for i in range(0, len(data), stride))
+        self._compress(b"\x00")
+        self._compress(b"\x00".join(rows))
+        self.rows_written += band.height
+
+    def write_blank(self, num_rows: int) -> None:
+        """ Append ``num_rows`` rows of transparent (or black) pixels """
+        band_height = max(1, _IDAT_SIZE // (self.width * len(self.mode)))
+        while num_rows > 0:
+            height = min(num_rows, band_height)
+            self.write(Image.new(self.mode, (self.width, height)))
+            num_rows -= height
+
+    def close(self) -> bytes:
+        """ Finish the image and return PNG data """
+        if self.rows_written != self.height:
+            raise ValueError("Not enough rows: %d < %d" % (
+                self.rows_written, self.height))
+        self._idat += self._compressor.flush()
+        self._flush_idat(final=True)
+        self._chunks.append(_chunk(b'IEND', b''))
+        result = b"".join(self._chunks)
+        self._chunks = []
+        return result
+
+    def _compress(self, data):
+        self._idat += self._compressor.compress(data)
+        self._flush_idat(final=False)
+
+    def _flush_idat(self, final):
+        while len(self._idat) >= _IDAT_SIZE or (final and self._idat):
+            self._chunks.append(_chunk(b'IDAT', bytes(self._idat[:_IDAT_SIZE])))
+            del self._idat[:_IDAT_SIZE]
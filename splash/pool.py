@@ -1,10 +1,93 @@
+import gc
+import heapq
+import itertools
+import math
+import time
+from collections import deque, OrderedDict
 from typing import Dict
+from urllib.parse import urlsplit
 
 import attr
 from twisted.internet import defer
 from twisted.python import log
+from twisted.python.failure import Failure
 
+from splash import defaults
+from splash.errors import (
+    OverloadedError,
+    QueueTimeoutError,
+    RenderTimeoutError,
+)
 from splash.render_options import RenderOptions
+from splash.utils import get_rss
+
+
+@attr.s
+class RenderStats:
+    """ Timestamps and RSS samples of a request processed by RenderPool """
+    queued_at = attr.ib(default=None)  # type: float
+    started_at = attr.ib(default=None)  # type: float
+    finished_at = attr.ib(default=None)  # type: float
+    rss_before = attr.ib(default=None)  # type: int
+    rss_after = attr.ib(default=None)  # type: int
+
+    @property
+    def queue_time(self):
+        """ Time spent waiting for a render slot """
+        if self.queued_at is None:
+            return None
+        end = self.started_at or self.finished_at or time.time()
+        return end - self.queued_at
+
+    @property
+    def slot_time(self):
+        """ Time spent rendering, after a render slot is acquired """
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def rss_delta(self):
+        """
+        Process RSS growth (in bytes) during rendering. Other renders
+        running in parallel also contribute to it.
+        """
+        if self.rss_before is None or self.rss_after is None:
+            return None
+        return self.rss_after - self.rss_before
+
+
+class HostMemoryStats:
+    """
+    RSS growth of renders, aggregated per URL host.
+    Only ``max_hosts`` most recently seen hosts are kept.
+    """
+    max_hosts = 1000
+
+    def __init__(self):
+        self.hosts = OrderedDict()  # host -> [renders, total delta, max delta]
+
+    def add(self, host, rss_delta):
+        renders, total, max_delta = self.hosts.pop(host, (0, 0, rss_delta))
+        self.hosts[host] = [renders + 1, total + rss_delta,
+                            max(max_delta, rss_delta)]
+        if len(self.hosts) > self.max_hosts:
+            self.hosts.popitem(last=False)
+
+    def stats(self, limit=50):
+        """
+        Return stats for ``limit`` hosts with the largest total RSS growth.
+        """
+        top = sorted(self.hosts.items(), key=lambda item: item[1][1],
+                     reverse=True)[:limit]
+        return {
+            host: {
+                'renders': renders,
+                'rss_delta_avg': total // renders,
+                'rss_delta_max': max_delta,
+            }
+            for host, (renders, total, max_delta) in top
+        }
 
 
 @attr.s
@@ -14,40 +97,335 @@ class SlotArguments:
     splash_proxy_factory = attr.ib()
     kwargs = attr.ib()  # type: Dict
     pool_d = attr.ib()  # type: defer.Deferred
+    priority = attr.ib(default=defaults.PRIORITY)  # type: int
+    client_id = attr.ib(default=None)
+    queue_timeout = attr.ib(default=None)  # type: float
+    render_timeout = attr.ib(default=None)  # type: float
+    queue_timer = attr.ib(default=None)
+    stats = attr.ib(default=attr.Factory(RenderStats))  # type: RenderStats
+
+
+class _ClientQueues:
+    """
+    Items of a single priority class, grouped by client.
+    Clients are served in proportion to their weights using stride
+    scheduling: each client has a "pass" value which is increased by
+    ``1/weight`` each time an item of this client is returned, and
+    a client with the smallest pass is served next.
+    """
+    def __init__(self, client_weights):
+        self.client_weights = client_weights
+        self.queues = {}  # client_id -> deque of (queued_at, item)
+        self.passes = {}  # client_id -> pass value
+        self.heap = []    # (pass, seq, client_id) for non-empty queues
+        self.heap_entries = {}  # client_id -> seq of its current heap entry
+        self.vtime = 0.0
+        self.size = 0
+        self._seq = itertools.count()
+
+    def put(self, item, client_id):
+        queue = self.queues.get(client_id)
+        if queue is None:
+            queue = self.queues[client_id] = deque()
+            # Client can't save up the time it was idle.
+            pass_ = max(self.passes.get(client_id, 0.0), self.vtime)
+            self.passes[client_id] = pass_
+            self._push(pass_, client_id)
+        queue.append((time.time(), item))
+        self.size += 1
+
+    def pop(self):
+        while True:
+            pass_, seq, client_id = heapq.heappop(self.heap)
+            # skip entries left after remove()
+            if self.heap_entries.get(client_id) == seq:
+                break
+        queue = self.queues[client_id]
+        queued_at, item = queue.popleft()
+        self.size -= 1
+        self.vtime = pass_
+        pass_ += 1.0 / self.client_weights.get(client_id, 1.0)
+        self.passes[client_id] = pass_
+        if queue:
+            self._push(pass_, client_id)
+        else:
+            del self.queues[client_id]
+            del self.heap_entries[client_id]
+            self._forget_idle_clients()
+        return item
+
+    def _push(self, pass_, client_id):
+        seq = next(self._seq)
+        self.heap_entries[client_id] = seq
+        heapq.heappush(self.heap, (pass_, seq, client_id))
+
+    def remove(self, item, client_id):
+        queue = self.queues.get(client_id)
+        if not queue:
+            return False
+        for entry in queue:
+            if entry[1] is item:
+                queue.remove(entry)
+                break
+        else:
+            return False
+        self.size -= 1
+        if not queue:
+            # its heap entry is skipped by pop()
+            del self.queues[client_id]
+            del self.heap_entries[client_id]
+        return True
+
+    def _forget_idle_clients(self):
+        # Passes of idle clients are only needed while they are
+        # ahead of the virtual time.
+        if len(self.passes) <= 2 * len(self.queues) + 100:
+            return
+        self.passes = {
+            client_id: pass_ for client_id, pass_ in self.passes.items()
+            if client_id in self.queues or pass_ > self.vtime
+        }
+
+    def items(self):
+        for queue in self.queues.values():
+            for queued_at, item in queue:
+                yield item
+
+    def stats(self, now):
+        oldest = min(queue[0][0] for queue in self.queues.values())
+        return {
+            "size": self.size,
+            "clients": len(self.queues),
+            "max_wait": now - oldest,
+        }
+
+
+class FairQueue:
+    """
+    A queue with priority classes and weighted fair queuing of clients.
+
+    Items with a higher priority are always returned first. Items with
+    the same priority are grouped by client id; clients are served in
+    proportion to their weights, so a burst of requests from a single
+    client doesn't block other clients. Items of a single client are
+    returned in FIFO order.
+
+    The interface is similar to twisted.internet.defer.DeferredQueue.
+    """
+    def __init__(self, client_weights=None):
+        self.client_weights = client_weights or {}
+        self.waiting = []
+        self._classes = {}  # priority -> _ClientQueues
+
+    def put(self, item, priority=defaults.PRIORITY, client_id=None):
+        if self.waiting:
+            self.waiting.pop(0).callback(item)
+            return
+        queues = self._classes.get(priority)
+        if queues is None:
+            queues = self._classes[priority] = _ClientQueues(self.client_weights)
+        queues.put(item, client_id)
+
+    def get(self):
+        """
+        Return a Deferred which fires with the next item.
+        """
+        if self._classes:
+            return defer.succeed(self._pop())
+        d = defer.Deferred(canceller=self.waiting.remove)
+        self.waiting.append(d)
+        return d
+
+    def remove(self, item, priority=defaults.PRIORITY, client_id=None):
+        """
+        Remove an item from the queue. Return True if the item was
+        in the queue.
+        """
+        queues = self._classes.get(priority)
+        if queues is None or not queues.remove(item, client_id):
+            return False
+        if not queues.size:
+            del self._classes[priority]
+        return True
+
+    def _pop(self):
+        priority = max(self._classes)
+        queues = self._classes[priority]
+        item = queues.pop()
+        if not queues.size:
+            del self._classes[priority]
+        return item
+
+    def __len__(self):
+        return sum(queues.size for queues in self._classes.values())
+
+    def count_ahead(self, priority):
+        """
+        Return a number of queued items which would be returned before
+        a new item with the given priority.
+        """
+        return sum(queues.size for p, queues in self._classes.items()
+                   if p >= priority)
+
+    @property
+    def pending(self):
+        """ A list of all queued items, in no particular order """
+        return [item for queues in self._classes.values()
+                for item in queues.items()]
+
+    def stats(self):
+        """
+        Return queue size, number of clients and the longest wait time
+        for each priority class.
+        """
+        now = time.time()
+        return {
+            str(priority): queues.stats(now)
+            for priority, queues in self._classes.items()
+        }
 
 
 class RenderPool(object):
     """A pool of renders. The number of slots determines how many
     renders will be run in parallel, at the most."""
 
+    # weight of the last render in the average render time
+    render_time_smoothing = 0.1
+
     def __init__(self, slots,
                  network_manager_factory,
                  splash_proxy_factory_cls,
                  js_profiles_path,
-                 verbosity=1):
+                 verbosity=1,
+                 reuse_tabs=False,
+                 max_tab_reuses=defaults.MAX_TAB_REUSES,
+                 client_weights=None,
+                 max_queue_size=defaults.MAX_QUEUE_SIZE,
+                 max_queue_wait=defaults.MAX_QUEUE_WAIT,
+                 render_rss_threshold=0,
+                 render_rss_action=defaults.RENDER_RSS_ACTION):
         self.network_manager_factory = network_manager_factory
         self.splash_proxy_factory_cls = splash_proxy_factory_cls or (lambda profile_name: None)
         self.js_profiles_path = js_profiles_path
         self.active = set()
-        self.queue = defer.DeferredQueue()
+        self.queue = FairQueue(client_weights)
         self.verbosity = verbosity
+        self.slots = slots
+        self.max_queue_size = max_queue_size
+        self.max_queue_wait = max_queue_wait
+        self.avg_render_time = None
+        self.reuse_tabs = reuse_tabs
+        self.max_tab_reuses = max_tab_reuses
+        self.max_spare_tabs = slots
+        self.spare_tabs = []
+        self.resetting_tabs = set()
+        self.tabs_reused = 0
+        self.draining = False
+        self._drain_waiters = []
+        self.memory_stats = HostMemoryStats()
+        self.render_rss_threshold = render_rss_threshold  # MB
+        self.render_rss_action = render_rss_action
+        self.memory_outliers = 0  # renders which exceeded the threshold
+        # called to restart Splash when render_rss_action is 'restart'
+        self.shutdown_callback = None
         for n in range(slots):
             self._wait_for_render(None, n, log=False)
 
     def render(self, rendercls, render_options, proxy, **kwargs):
+        from twisted.internet import reactor
         splash_proxy_factory = self.splash_proxy_factory_cls(proxy)
-        pool_d = defer.Deferred()
+        # a request cancelled while waiting in the queue
+        # shouldn't occupy a place in the queue
+        pool_d = defer.Deferred(canceller=lambda d: self._unqueue(slot))
         slot = SlotArguments(
             rendercls=rendercls,
             render_options=render_options,
             splash_proxy_factory=splash_proxy_factory,
             kwargs=kwargs,
             pool_d = pool_d,
+            priority=render_options.get_priority(),
+            client_id=render_options.get_client_id(),
+            queue_timeout=render_options.get_queue_timeout(),
+            render_timeout=render_options.get_render_timeout(),
+            stats=RenderStats(queued_at=time.time()),
         )
-        self.queue.put(slot)
-        self.log("[%s] queued" % render_options.get_uid())
+        render_options.render_stats = slot.stats
+        # the timer is armed before put() because put() starts
+        # the render right away if there is a free slot
+        if slot.queue_timeout:
+            slot.queue_timer = reactor.callLater(
+                slot.queue_timeout, self._on_queue_timeout, slot)
+        self.queue.put(slot, priority=slot.priority, client_id=slot.client_id)
+        self.log("[%s] queued (priority=%s, client_id=%s)" % (
+            render_options.get_uid(), slot.priority, slot.client_id))
         return pool_d
 
+    def _unqueue(self, slot: SlotArguments):
+        """ Remove a request from the queue if it is still there """
+        if slot.queue_timer is not None and slot.queue_timer.active():
+            slot.queue_timer.cancel()
+        if not self.queue.remove(slot, slot.priority, slot.client_id):
+            return False
+        slot.stats.finished_at = time.time()
+        self.log("[%s] removed from the queue" % (
+            slot.render_options.get_uid()))
+        self._check_drained()
+        return True
+
+    def _on_queue_timeout(self, slot: SlotArguments):
+        if self._unqueue(slot):
+            slot.pool_d.errback(QueueTimeoutError({
+                'queue_timeout': slot.queue_timeout,
+            }))
+
+    def estimate_queue_wait(self, priority=defaults.PRIORITY):
+        """
+        Return an estimated time (in seconds) a new request with the given
+        priority would spend in the queue, based on recent render times.
+        """
+        if self.queue.waiting or self.avg_render_time is None:
+            # there is a free slot, or nothing is known yet
+            return 0.0
+        ahead = self.queue.count_ahead(priority)
+        return (ahead + 1) * self.avg_render_time / self.slots
+
+    def estimate_retry_after(self, priority=defaults.PRIORITY):
+        """
+        Return a value (in whole seconds) for the Retry-After header
+        of a request which was rejected or timed out in the queue.
+        """
+        wait = self.estimate_queue_wait(priority)
+        return max(1, int(math.ceil(wait or self.avg_render_time or 1)))
+
+    def check_queue_limits(self, priority=defaults.PRIORITY):
+        """
+        Raise OverloadedError if a new request with the given priority
+        shouldn't be queued because of --max-queue-size or
+        --max-queue-wait limits, or because the pool is draining.
+        """
+        if self.draining:
+            raise OverloadedError({'reason': 'draining', 'retry_after': 1})
+        if self.queue.waiting:
+            return
+        qsize = len(self.queue)
+        wait = self.estimate_queue_wait(priority)
+        info = None
+        if self.max_queue_size and qsize >= self.max_queue_size:
+            info = {
+                'reason': 'max_queue_size',
+                'qsize': qsize,
+                'max_queue_size': self.max_queue_size,
+            }
+        elif self.max_queue_wait and wait > self.max_queue_wait:
+            info = {
+                'reason': 'max_queue_wait',
+                'expected_wait': wait,
+                'max_queue_wait': self.max_queue_wait,
+            }
+        if info is not None:
+            info['retry_after'] = self.estimate_retry_after(priority)
+            raise OverloadedError(info)
+
     def _wait_for_render(self, _, slot, log=True):
         if log:
             self.log("SLOT %d is available" % slot)
@@ -57,18 +435,45 @@ class RenderPool(object):
         return _
 
     def _start_render(self, slot_args: SlotArguments, slot):
+        from twisted.internet import reactor
+        if slot_args.queue_timer is not None and slot_args.queue_timer.active():
+            slot_args.queue_timer.cancel()
+        if slot_args.pool_d.called:
+            self.log("[%s] SLOT %d skips a cancelled request" % (
+                slot_args.render_options.get_uid(), slot))
+            return
+        slot_args.stats.started_at = time.time()
+        slot_args.stats.rss_before = get_rss()
+
         self.log("initializing SLOT %d" % (slot, ))
-        # FIXME: refactor. network manager only works for webkit.
-        render = slot_args.rendercls(
-            render_options=slot_args.render_options,
-            verbosity=self.verbosity,
-            network_manager=self.network_manager_factory(),
-            splash_proxy_factory=slot_args.splash_proxy_factory,
-        )
+        tab = self._get_spare_tab(slot_args.rendercls)
+        if tab is not None:
+            self.log("SLOT %d reuses a spare tab" % (slot, ))
+            render = slot_args.rendercls(
+                render_options=slot_args.render_options,
+                verbosity=self.verbosity,
+                network_manager=None,
+                splash_proxy_factory=slot_args.splash_proxy_factory,
+                tab=tab,
+            )
+        else:
+            # FIXME: refactor. network manager only works for webkit.
+            render = slot_args.rendercls(
+                render_options=slot_args.render_options,
+                verbosity=self.verbosity,
+                network_manager=self.network_manager_factory(),
+                splash_proxy_factory=slot_args.splash_proxy_factory,
+            )
         self.active.add(render)
+        render_timer = None
+        if slot_args.render_timeout:
+            render_timer = reactor.callLater(slot_args.render_timeout,
+                                             self._on_render_timeout,
+                                             render, slot_args.render_timeout)
         render.deferred.chainDeferred(slot_args.pool_d)
         slot_args.pool_d.addErrback(self._error, render, slot)
-        slot_args.pool_d.addBoth(self._close_render, render, slot)
+        slot_args.pool_d.addBoth(self._close_render, render, slot,
+                                 slot_args.stats, render_timer)
 
         self.log("[%s] SLOT %d is starting" % (
             slot_args.render_options.get_uid(), slot))
@@ -87,15 +492,148 @@ class RenderPool(object):
         self.log("[%s] SLOT %d finished with an error %s: %s" % (uid, slot, render, failure))
         return failure
 
-    def _close_render(self, _, render, slot):
+    def _on_render_timeout(self, render, timeout):
+        if render.deferred.called:
+            return
+        uid = render.render_options.get_uid()
+        self.log("[%s] render timeout (%ss) exceeded" % (uid, timeout))
+        render.deferred.errback(RenderTimeoutError({
+            'render_timeout': timeout,
+        }))
+
+    def _close_render(self, _, render, slot, stats, render_timer):
         uid = render.render_options.get_uid()
         self.log("[%s] SLOT %d is closing %s" % (uid, slot, render))
+        if render_timer is not None and render_timer.active():
+            render_timer.cancel()
+        stats.finished_at = time.time()
+        stats.rss_after = get_rss()
+        self._update_avg_render_time(stats.slot_time)
+        self.memory_stats.add(self._get_render_host(render), stats.rss_delta)
         self.active.remove(render)
         render.deferred.cancel()
-        render.close()
+        memory_outlier = self._is_memory_outlier(stats.rss_delta)
+        if not memory_outlier and self._can_reuse_tab(render, _):
+            self._release_tab(render.tab)
+        else:
+            render.close()
         self.log("[%s] SLOT %d done with %s" % (uid, slot, render))
+        if memory_outlier:
+            self._on_memory_outlier(uid, stats.rss_delta)
+        self._check_drained()
         return _
 
+    def _get_render_host(self, render):
+        url = render.render_options.data.get('url')
+        if not url:
+            url = getattr(render, 'url', None) or render.tab.url
+        return urlsplit(url).hostname or ''
+
+    def _is_memory_outlier(self, rss_delta):
+        if not self.render_rss_threshold:
+            return False
+        return rss_delta > self.render_rss_threshold * (1024 ** 2)
+
+    def _on_memory_outlier(self, uid, rss_delta):
+        from twisted.internet import reactor
+        self.memory_outliers += 1
+        log.msg("[%s] render increased RSS by %d MB (threshold is %d MB)" % (
+            uid, rss_delta / (1024 ** 2), self.render_rss_threshold),
+            system='pool')
+        if self.render_rss_action == 'restart' and self.shutdown_callback:
+            self.shutdown_callback()
+        else:
+            # tabs are closed with deleteLater, collect garbage after that
+            reactor.callLater(0, self._collect_garbage)
+
+    def _collect_garbage(self):
+        from splash.qtutils import clear_caches
+        clear_caches()
+        unreachable = gc.collect()
+        rss = get_rss()
+        log.msg("caches are cleared, %d Python objects collected; "
+                "RSS is %d MB" % (unreachable, rss / (1024 ** 2)),
+                system='pool')
+
+    def drain(self):
+        """
+        Stop accepting new requests. Return a Deferred which fires
+        when all active and queued renders are finished.
+        """
+        self.draining = True
+        d = defer.Deferred()
+        self._drain_waiters.append(d)
+        self._check_drained()
+        return d
+
+    def is_idle(self):
+        return not self.active and not len(self.queue)
+
+    def _check_drained(self):
+        if not self.draining or not self.is_idle():
+            return
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for d in waiters:
+            if not d.called:
+                d.callback(None)
+
+    def _update_avg_render_time(self, render_time):
+        if self.avg_render_time is None:
+            self.avg_render_time = render_time
+        else:
+            alpha = self.render_time_smoothing
+            self.avg_render_time += alpha * (render_time - self.avg_render_time)
+
+    def _get_spare_tab(self, rendercls):
+        if not self.spare_tabs:
+            return None
+        if not getattr(rendercls, 'tab_reuse_supported', False):
+            return None
+        self.tabs_reused += 1
+        return self.spare_tabs.pop()
+
+    def _can_reuse_tab(self, render, result):
+        """
+        Only tabs of successful renders are reused: after an error or
+        a timeout the tab state is not reliable enough to reset it.
+        """
+        if not self.reuse_tabs:
+            return False
+        if not getattr(render, 'tab_reuse_supported', False):
+            return False
+        if isinstance(result, Failure) or render.tab.closing:
+            return False
+        if render.tab.reuse_count >= self.max_tab_reuses:
+            return False
+        n_tabs = len(self.spare_tabs) + len(self.resetting_tabs)
+        return n_tabs < self.max_spare_tabs
+
+    def _release_tab(self, tab):
+        """ Reset the tab and put it to the list of spare tabs """
+        def on_reset():
+            self.resetting_tabs.discard(tab)
+            if tab.closing:
+                return
+            self.spare_tabs.append(tab)
+
+        def on_reset_error():
+            self.resetting_tabs.discard(tab)
+            tab.close()
+
+        self.resetting_tabs.add(tab)
+        try:
+            tab.reset(callback=on_reset, errback=on_reset_error)
+        except Exception:
+            log.err(None, "error resetting a tab", system='pool')
+            on_reset_error()
+
+    def tab_stats(self):
+        return {
+            'spare': len(self.spare_tabs),
+            'resetting': len(self.resetting_tabs),
+            'reused': self.tabs_reused,
+        }
+
     def log(self, text):
         if self.verbosity >= 2:
             log.msg(text, system='pool')
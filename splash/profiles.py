@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of proxy profiles (``--proxy-profiles-path``) and JS profiles
+(``--js-profiles-path``) read from disk.
+
+Profiles used to be read and parsed for each request. Now parsed
+profiles are kept in memory; a cached value is used while
+modification time and size of its file stay the same, so changed
+profiles are picked up without a restart. The cache is cleared
+when Splash receives SIGUSR2.
+"""
+import os
+
+
+class FileCache(object):
+    """
+    Cache of values computed from files or folders. A value is computed
+    again when modification time or size of its file changes.
+    """
+    def __init__(self):
+        self._entries = {}  # path => ((mtime, size), value)
+
+    def get(self, path, load):
+        """
+        Return ``load(path)`` result, cached. If ``path`` can't be accessed,
+        ``load`` is called without caching, so it can handle the error.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._entries.pop(path, None)
+            return load(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        value = load(path)
+        self._entries[path] = (version, value)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+profile_cache = FileCache()
+
+
+def get_js_profile_sources(folder):
+    """
+    Return a list of ``(filename, source)`` tuples for .js files
+    of a JS profile ``folder``.
+    """
+    filenames = profile_cache.get(folder, _list_js_files)
+    return [(filename, profile_cache.get(filename, _read_js_file))
+            for filename in filenames]
+
+
+def _list_js_files(folder):
+    return [os.path.join(folder, fname) for fname in os.listdir(folder)
+            if fname.endswith('.js')]
+
+
+def _read_js_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read().decode('utf-8')
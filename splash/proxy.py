@@ -13,6 +13,7 @@ from urllib.parse import urlparse
 
 from PyQt5.QtNetwork import QNetworkProxy
 
+from splash.profiles import profile_cache
 from splash.render_options import RenderOptions
 from splash.qtutils import create_proxy, validate_proxy_type
 from splash.utils import path_join_secure
@@ -121,7 +122,7 @@ class ProfilesSplashProxyFactory(_AllowDenySplashProxyFactory):
         if profile_name == 'none':
             return [], [], []
         ini_path = self._get_ini_path(profile_name)
-        return self._parse_ini(ini_path)
+        return profile_cache.get(ini_path, self._parse_ini)
 
     def _get_ini_path(self, profile_name):
         filename = profile_name + '.ini'
@@ -1,53 +1,71 @@
-"""This module handles rendering QWebPage into PNG and JPEG images."""
+"""
+This module handles rendering QWebPage into PNG, JPEG, WebP and raw images.
+"""
+import hashlib
 import sys
 from abc import ABCMeta, abstractmethod, abstractproperty
 from io import BytesIO
-from math import ceil
+from math import ceil, floor, gcd
 from typing import Optional, Tuple
 
 from PIL import Image
 from PyQt5.QtCore import QBuffer, QPoint, QRect, QSize, Qt, QSizeF
 from PyQt5.QtGui import QImage
 
-from splash import defaults
+from splash import defaults, metrics
 from splash.log import DummyLogger
 from splash.qtutils import qsize_to_tuple
-from splash.utils import swap_byte_order_i32
+from splash.raw_image import encode_raw_image
 
 
 class QImagePillowConverter:
     """ Object for managing Pillow and QImages """
     def __init__(self, tagret_format: str) -> None:
         self.target_format = tagret_format.upper()
-        if self.target_format not in ('JPEG', 'PNG'):
-            raise ValueError('Invalid image format %s, must be PNG or JPEG' %
-                             self.target_format)
-
-        # QImage's 0xARGB in little-endian becomes [0xB, 0xG, 0xR, 0xA] for
-        # Pillow, hence the 'BGRA' decoder argument. Same for 'RGB' - 'BGRX'.
-        # mapping for self.pillow_image_decoder is taken from
+        if self.target_format not in ('JPEG', 'PNG', 'WEBP'):
+            raise ValueError('Invalid image format %s, must be PNG, JPEG '
+                             'or WEBP' % self.target_format)
+
+        # QImage's 0xAARRGGBB words are stored in host byte order, so in
+        # little-endian they become [0xBB, 0xGG, 0xRR, 0xAA] for Pillow,
+        # hence the 'BGRA' decoder argument, and in big-endian they are
+        # [0xAA, 0xRR, 0xGG, 0xBB], hence 'ARGB'. Same for 'RGB' - 'BGRX'
+        # and 'XRGB'. Mapping for self.pillow_decoder_format is taken from
         # https://github.com/python-pillow/Pillow/blob/2.9.0/libImaging/Pack.c#L526
-        if self.target_format == 'JPEG':
-            self.qt_image_format = QImage.Format_ARGB32
+        little_endian = sys.byteorder == "little"
+        self.qt_image_format = QImage.Format_ARGB32
+        if self.target_format in {'JPEG', 'WEBP'}:
             self.pillow_image_format = "RGB"
-            self.pillow_decoder_format = "BGRX"
+            self.pillow_decoder_format = "BGRX" if little_endian else "XRGB"
         else:
-            self.qt_image_format = QImage.Format_ARGB32
             self.pillow_image_format = "RGBA"
-            self.pillow_decoder_format = "BGRA"
-
-    def qimage_to_pil(self, qimage: QImage) -> Image:
-        """ Convert QImage (in ARGB32 format) to PIL.Image (in RGBA mode). """
-        # In our case QImage uses 0xAARRGGBB format stored in host endian
-        # order, we must convert it to [0xRR, 0xGG, 0xBB, 0xAA] sequences
-        # used by Pillow.
-        buf = qimage.bits().asstring(qimage.byteCount())
-        if sys.byteorder != "little":
-            buf = swap_byte_order_i32(buf)
-        return Image.frombytes(
-            self.pillow_image_format,
-            qsize_to_tuple(qimage.size()),
-            buf, 'raw', self.pillow_decoder_format)
+            self.pillow_decoder_format = "BGRA" if little_endian else "ARGB"
+
+    def qimage_to_pil(self, qimage: QImage,
+                      height: Optional[int] = None) -> Image:
+        """
+        Convert QImage (in ARGB32 format) to PIL.Image (in RGBA or RGB mode).
+
+        Pillow decoder reads pixels directly from QImage memory, so the only
+        copy made is the resulting PIL.Image itself. If ``height`` is passed,
+        only this number of top rows is converted.
+        """
+        width = qimage.width()
+        if height is None:
+            height = qimage.height()
+        height = min(height, qimage.height())
+        stride = qimage.bytesPerLine()
+        # constBits doesn't detach QImage data, unlike bits()
+        ptr = qimage.constBits()
+        ptr.setsize(stride * height)
+        # The decoder mode differs from the image mode, so Pillow decodes
+        # the data right away instead of keeping a reference to the buffer;
+        # the resulting image doesn't depend on QImage lifetime.
+        with metrics.IMAGE_RENDER_DURATION.labels(stage='convert').time():
+            return Image.frombuffer(
+                self.pillow_image_format,
+                (width, height),
+                memoryview(ptr), 'raw', self.pillow_decoder_format, stride, 1)
 
     def new_pillow_image(self, size) -> Image:
         """ Return a new blank Pillow image """
@@ -58,8 +76,9 @@ class QImagePillowConverter:
     def new_qimage(self, size, fill=True) -> QImage:
         img = QImage(size, self.qt_image_format)
         if fill:
-            if self.target_format == "JPEG":
-                # White background for JPEG images, same as in all browsers.
+            if self.target_format in {"JPEG", "WEBP"}:
+                # White background for JPEG and WebP images,
+                # same as in all browsers.
                 img.fill(Qt.white)
             else:
                 # Preserve old behaviour for PNG format.
@@ -105,6 +124,25 @@ class BaseQtScreenshotRenderer(metaclass=ABCMeta):
         """ Return size of the current viewport """
         raise NotImplementedError()
 
+    def get_page_fingerprint(self) -> bytes:
+        """
+        Return a value which changes when the page (or the part of it
+        which is rendered) may look differently; it is used for
+        screenshot cache keys.
+        """
+        raise NotImplementedError()
+
+    def get_cache_key(self, quality: Optional[int] = None) -> str:
+        """
+        Return a screenshot cache key for the current page state and
+        image parameters.
+        """
+        params = (self.img_converter.target_format, self.width, self.height,
+                  self.scale_method, self.region, quality)
+        fp = hashlib.sha1(self.get_page_fingerprint())
+        fp.update(repr(params).encode('utf8'))
+        return fp.hexdigest()
+
     @abstractmethod
     def _render_qwebpage_full(self,
                               web_rect: QRect,
@@ -119,16 +157,25 @@ class BaseQtScreenshotRenderer(metaclass=ABCMeta):
                                web_rect: QRect,
                                render_rect: QRect,
                                canvas_size: QSize,
+                               stream: bool = False,
                                ) -> 'WrappedImage':
         """ Render web page tile-by-tile.
 
         This function should work around bugs in QPaintEngine that occur when
         render_rect is larger than 32k pixels in either dimension.
+
+        If ``stream`` is True, the result won't be resized or cropped,
+        so it may be encoded while it is rendered.
         """
         raise NotImplementedError()
 
-    def render_qwebpage(self) -> 'WrappedImage':
-        """ Render QWebPage into a WrappedImage. """
+    def render_qwebpage(self, stream: bool = True) -> 'WrappedImage':
+        """ Render QWebPage into a WrappedImage.
+
+        If ``stream`` is False, the page is never encoded while it is
+        rendered, even if it is rendered tile-by-tile; use it when
+        the result is not going to be encoded to PNG.
+        """
         # Overall rendering pipeline looks as follows:
         # 1. render_qwebpage
         # 2. render_qwebpage_raster/-vector
@@ -150,12 +197,70 @@ class BaseQtScreenshotRenderer(metaclass=ABCMeta):
             return self._render_qwebpage_vector(
                 in_viewport=web_viewport,
                 out_viewport=img_viewport,
-                image_size=img_size)
+                image_size=img_size,
+                stream=stream)
         elif self.scale_method == 'raster':
             return self._render_qwebpage_raster(
                 in_viewport=web_viewport,
                 out_viewport=img_viewport,
-                image_size=img_size)
+                image_size=img_size,
+                stream=stream)
+
+    def render_canvas(self) -> 'WrappedImage':
+        """
+        Render the region (by default, the whole viewport) without scaling
+        into a Pillow image, to derive several images from it
+        with :meth:`derive_image`.
+        """
+        web_viewport = self._region_to_web_viewport(self.region)
+        if web_viewport.isEmpty():
+            return EmptyImage()
+        canvas = self._render_qwebpage_vector(
+            in_viewport=web_viewport,
+            out_viewport=QRect(QPoint(0, 0), web_viewport.size()),
+            image_size=web_viewport.size())
+        if isinstance(canvas, WrappedQImage):
+            canvas = WrappedPillowImage(
+                self.img_converter.qimage_to_pil(canvas.img))
+        return canvas
+
+    def derive_image(self, canvas: 'WrappedImage') -> 'WrappedImage':
+        """
+        Return an image :meth:`render_qwebpage` would return, computing it
+        from ``canvas`` returned by :meth:`render_canvas` of a renderer
+        for the same page and the whole viewport, instead of rendering
+        the page again. ``canvas`` is not modified. Only 'raster'
+        scale method is supported; regions are clipped to the canvas.
+        """
+        if isinstance(canvas, EmptyImage):
+            return EmptyImage()
+        canvas_rect = QRect(QPoint(0, 0), canvas.size)
+        if self.region is None:
+            web_viewport = canvas_rect
+        else:
+            web_viewport = self._region_to_web_viewport(
+                self.region).intersected(canvas_rect)
+            if web_viewport.isEmpty():
+                return EmptyImage()
+        img_viewport, img_size = self._calculate_output_image_parameters(
+            web_viewport=web_viewport,
+            img_width=self.width,
+            img_height=self.height)
+        if img_viewport.isEmpty() or img_size.isEmpty():
+            return EmptyImage()
+
+        image = WrappedPillowImage(canvas.img)
+        if web_viewport != canvas_rect:
+            image.crop(web_viewport)
+        if web_viewport.size() != img_viewport.size():
+            image = self._resample_canvas(image, web_viewport.size(),
+                                          img_viewport.size(), img_size)
+        if image.size != img_size:
+            image.crop(QRect(QPoint(0, 0), img_size))
+        if (self.img_converter.pillow_image_format == 'RGB' and
+                image.img.mode == 'RGBA'):
+            image = WrappedPillowImage(_flatten_on_white(image.img))
+        return image
 
     def _region_to_web_viewport(self, region: Optional[Tuple]) -> QRect:
         """ Return QRect from region parameter. By default, current viewport
@@ -171,13 +276,15 @@ class BaseQtScreenshotRenderer(metaclass=ABCMeta):
     def _render_qwebpage_vector(self,
                                 in_viewport: QRect,
                                 out_viewport: QRect,
-                                image_size: QSize) -> 'WrappedImage':
+                                image_size: QSize,
+                                stream: bool = False) -> 'WrappedImage':
         """
         Render a webpage using vector rescale method.
 
         :param in_viewport: region of the webpage to render from
         :param out_viewport: region of the image to render to
         :param image_size: size of the resulting image
+        :param stream: True if the result is not going to be modified
         """
         web_rect = QRect(in_viewport)
         render_rect = QRect(out_viewport)
@@ -194,21 +301,27 @@ class BaseQtScreenshotRenderer(metaclass=ABCMeta):
             self.logger.log(
                 "image render: draw region too large, rendering tile-by-tile",
                 min_level=2)
-            return self._render_qwebpage_tiled(web_rect, render_rect, canvas_size)
+            with metrics.IMAGE_RENDER_DURATION.labels(stage='tiled').time():
+                return self._render_qwebpage_tiled(web_rect, render_rect,
+                                                   canvas_size, stream=stream)
         else:
             self.logger.log("image render: rendering webpage in one step",
                             min_level=2)
-            return self._render_qwebpage_full(web_rect, render_rect, canvas_size)
+            with metrics.IMAGE_RENDER_DURATION.labels(stage='full').time():
+                return self._render_qwebpage_full(web_rect, render_rect,
+                                                  canvas_size)
 
     def _render_qwebpage_raster(self,
                                 in_viewport: QRect,
                                 out_viewport: QRect,
-                                image_size: QSize) -> 'WrappedImage':
+                                image_size: QSize,
+                                stream: bool = False) -> 'WrappedImage':
         """ Render a webpage rescaling pixel-wise if necessary.
 
         :param in_viewport: region of the webpage to render from
         :param out_viewport: region of the image to render to
         :param image_size: size of the resulting image
+        :param stream: True if the result is not going to be modified
         """
         self.logger.log("image render (raster): rendering %s of the web page" %
                         in_viewport, min_level=2)
@@ -218,7 +331,8 @@ class BaseQtScreenshotRenderer(metaclass=ABCMeta):
                         min_level=2)
 
         render_rect = QRect(in_viewport)
-        if in_viewport.size() == out_viewport.size():
+        needs_resize = in_viewport.size() != out_viewport.size()
+        if not needs_resize:
             # If no resizing is requested, we can make canvas of the size
             # of the output image to avoid the final cropping step.
             canvas_size = QSize(image_size)
@@ -229,17 +343,20 @@ class BaseQtScreenshotRenderer(metaclass=ABCMeta):
             self.logger.log("image render: image is trimmed vertically",
                             min_level=2)
             hcut = image_size.height()
-            if in_viewport.size() == out_viewport.size():
+            if not needs_resize:
                 # If no resizing then we need to render exactly the requested
                 # number of pixels vertically.
                 hrender = hcut
             else:
                 # If there's a resize, there will be interpolation.  We must
-                # ensure that both pixels that contribute to the color of the
-                # last row of the resulting image are rendered.
+                # ensure that all pixels that contribute to the color of the
+                # last resampled row are rendered: bilinear filter support
+                # is 1 pixel, scaled when downsampling.
                 h0 = in_viewport.height()
                 h1 = out_viewport.height()
-                hrender = min(ceil(h0 * (hcut - 0.5) / float(h1) + 0.5), h0)
+                _, box_height = self._get_resample_rows(h0, h1, hcut)
+                hrender = min(ceil(box_height + max(h0 / float(h1), 1.0)), h0)
+                canvas_size.setHeight(hrender)
             render_rect = QRect(QPoint(0, 0),
                                 QSize(in_viewport.width(), hrender))
             self.logger.log("image render: image is trimmed vertically, "
@@ -251,17 +368,58 @@ class BaseQtScreenshotRenderer(metaclass=ABCMeta):
         canvas = self._render_qwebpage_vector(
             in_viewport=render_rect,
             out_viewport=QRect(QPoint(0, 0), render_rect.size()),
-            image_size=canvas_size)
-        if in_viewport.size() != out_viewport.size():
-            self.logger.log("Scaling canvas (%s) to image viewport (%s)" %
-                            (canvas.size, out_viewport.size()), min_level=2)
-            canvas.resize(out_viewport.size())
+            image_size=canvas_size,
+            stream=stream and not needs_resize)
+        if needs_resize:
+            canvas = self._resample_canvas(canvas, in_viewport.size(),
+                                           out_viewport.size(), image_size)
         if canvas.size != image_size:
             self.logger.log("Cropping canvas (%s) to image size (%s)" %
                             (canvas.size, image_size), min_level=2)
             canvas.crop(QRect(QPoint(0, 0), image_size))
         return canvas
 
+    def _resample_canvas(self, canvas: 'WrappedImage', in_size: QSize,
+                         out_size: QSize, image_size: QSize
+                         ) -> 'WrappedImage':
+        """
+        Scale ``canvas`` rendered at ``in_size`` to ``out_size``, skipping
+        rows which are below ``image_size``, in one step.
+        """
+        rows, box_height = self._get_resample_rows(
+            in_size.height(), out_size.height(), image_size.height())
+        size = QSize(out_size.width(), rows)
+        box = (0, 0, in_size.width(), box_height)
+        self.logger.log("Resampling %s of canvas (%s) to %s" %
+                        (box, canvas.size, size), min_level=2)
+        if isinstance(canvas, WrappedQImage):
+            # Pillow resamples faster than QImage.scaled, and it can
+            # resample a part of the image without cropping it first.
+            canvas = WrappedPillowImage(
+                self.img_converter.qimage_to_pil(canvas.img))
+        with metrics.IMAGE_RENDER_DURATION.labels(stage='resample').time():
+            canvas.resample(box, size)
+        return canvas
+
+    @staticmethod
+    def _get_resample_rows(in_height: int, out_height: int,
+                           rows: int) -> Tuple[int, int]:
+        """
+        Return ``(out_rows, in_rows)`` tuple: at least ``rows`` top rows
+        of an image scaled from ``in_height`` to ``out_height`` can be
+        computed by scaling ``in_rows`` top source rows to ``out_rows``.
+
+        The ratio of these numbers is the same as the ratio of heights,
+        and it is computed exactly, so resulting rows are the same
+        as rows of the whole scaled image.
+        """
+        if rows >= out_height:
+            return out_height, in_height
+        divisor = gcd(in_height, out_height)
+        step_in, step_out = in_height // divisor, out_height // divisor
+        steps = -(-rows // step_out)
+        return step_out * steps, step_in * steps
+
     def _qpainter_needs_tiling(self, render_rect: QRect,
                                canvas_size: QSize) -> bool:
         """ Return True if QPainter cannot perform given render
@@ -300,6 +458,19 @@ class BaseQtScreenshotRenderer(metaclass=ABCMeta):
         return image_viewport, image_size
 
 
+def _is_integer(value: float) -> bool:
+    return abs(value - round(value)) < 1e-9
+
+
+def _flatten_on_white(image: Image.Image) -> Image.Image:
+    """ Convert RGBA image to RGB, with a white background """
+    if image.getextrema()[3][0] < 255:
+        # there are transparent pixels
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    return image.convert('RGB')
+
+
 class WrappedImage(metaclass=ABCMeta):
     """
     Base interface for operations with images of rendered webpages.
@@ -320,6 +491,14 @@ class WrappedImage(metaclass=ABCMeta):
     def crop(self, rect: QRect) -> None:
         """ Crop/extend image to specified rectangle. """
 
+    @abstractmethod
+    def resample(self, box: Tuple[float, float, float, float],
+                 new_size: QSize) -> None:
+        """
+        Replace the image with ``(left, top, right, bottom)`` ``box``
+        of it (coordinates may be fractional) resized to ``new_size``.
+        """
+
     @abstractmethod
     def to_png(self, complevel: int = defaults.PNG_COMPRESSION_LEVEL) -> bytes:
         """
@@ -338,6 +517,30 @@ class WrappedImage(metaclass=ABCMeta):
             100 being large files with no compression)
         """
 
+    @abstractmethod
+    def to_webp(self, quality: int = defaults.WEBP_QUALITY,
+                lossless: bool = False,
+                method: int = defaults.WEBP_METHOD) -> bytes:
+        """
+        Serialize image as WebP and return the result as a byte sequence.
+
+        :param quality: quality level (0-100); for lossless images
+            it is the compression effort
+        :param lossless: use lossless compression
+        :param method: speed/size tradeoff, from 0 (fastest)
+            to 6 (slowest, smallest files)
+        """
+
+    @abstractmethod
+    def to_raw(self, pixel_format: str = 'RGBA', downsample: int = 1) -> bytes:
+        """
+        Return uncompressed image with a header
+        (see :mod:`splash.raw_image`).
+
+        :param pixel_format: 'RGBA' or 'RGB'
+        :param downsample: reduce image size by this factor
+        """
+
 
 class WrappedQImage(WrappedImage):
     def __init__(self, qimage):
@@ -357,19 +560,41 @@ class WrappedQImage(WrappedImage):
         assert isinstance(rect, QRect)
         self.img = self.img.copy(rect)
 
+    def resample(self, box, new_size):
+        assert isinstance(new_size, QSize)
+        left, top, right, bottom = box
+        rect = QRect(QPoint(floor(left), floor(top)),
+                     QPoint(ceil(right) - 1, ceil(bottom) - 1))
+        self.img = self.img.copy(rect).scaled(
+            new_size, transformMode=Qt.SmoothTransformation)
+
     def to_png(self, complevel=defaults.PNG_COMPRESSION_LEVEL):
         quality = 90 - (complevel * 10)
         buf = QBuffer()
-        self.img.save(buf, 'png', quality)
+        with metrics.IMAGE_ENCODE_DURATION.labels(format='png').time():
+            self.img.save(buf, 'png', quality)
         return bytes(buf.data())
 
     def to_jpeg(self, quality=None):
         if quality is None:
             quality = defaults.JPEG_QUALITY
         buf = QBuffer()
-        self.img.save(buf, 'jpeg', quality)
+        with metrics.IMAGE_ENCODE_DURATION.labels(format='jpeg').time():
+            self.img.save(buf, 'jpeg', quality)
         return bytes(buf.data())
 
+    def to_webp(self, quality=defaults.WEBP_QUALITY, lossless=False,
+                method=defaults.WEBP_METHOD):
+        # Qt WebP plugin is not always available, so Pillow is used
+        image = QImagePillowConverter('WEBP').qimage_to_pil(self.img)
+        return WrappedPillowImage(image).to_webp(quality, lossless, method)
+
+    def to_raw(self, pixel_format='RGBA', downsample=1):
+        converter = QImagePillowConverter(
+            'PNG' if pixel_format == 'RGBA' else 'JPEG')
+        image = converter.qimage_to_pil(self.img)
+        return encode_raw_image(image, pixel_format, downsample)
+
 
 class WrappedPillowImage(WrappedImage):
     def __init__(self, image):
@@ -391,18 +616,145 @@ class WrappedPillowImage(WrappedImage):
         top, bottom = rect.top(), rect.top() + rect.height()
         self.img = self.img.crop((left, top, right, bottom))
 
+    def resample(self, box, new_size):
+        assert isinstance(new_size, QSize)
+        width, height = new_size.width(), new_size.height()
+        left, top, right, bottom = box
+        factor_x = (right - left) / width
+        factor_y = (bottom - top) / height
+        if all(_is_integer(v) for v in box + (factor_x, factor_y)):
+            # Box reduction for integer factors is much faster than
+            # resampling, and it gives the same result as a box filter.
+            int_box = tuple(int(round(v)) for v in box)
+            factor = (int(round(factor_x)), int(round(factor_y)))
+            if factor == (1, 1):
+                self.img = self.img.crop(int_box)
+            else:
+                self.img = self.img.reduce(factor, box=int_box)
+        else:
+            self.img = self.img.resize((width, height), Image.BILINEAR,
+                                       box=box)
+
     def to_png(self, complevel=defaults.PNG_COMPRESSION_LEVEL):
         buf = BytesIO()
-        self.img.save(buf, 'png', compress_level=complevel)
+        with metrics.IMAGE_ENCODE_DURATION.labels(format='png').time():
+            self.img.save(buf, 'png', compress_level=complevel)
         return buf.getvalue()
 
     def to_jpeg(self, quality=None):
         if quality is None:
             quality = defaults.JPEG_QUALITY
         buf = BytesIO()
-        self.img.save(buf, 'jpeg', quality=quality)
+        with metrics.IMAGE_ENCODE_DURATION.labels(format='jpeg').time():
+            self.img.save(buf, 'jpeg', quality=quality)
+        return buf.getvalue()
+
+    def to_webp(self, quality=defaults.WEBP_QUALITY, lossless=False,
+                method=defaults.WEBP_METHOD):
+        buf = BytesIO()
+        with metrics.IMAGE_ENCODE_DURATION.labels(format='webp').time():
+            self.img.save(buf, 'webp', quality=quality, lossless=lossless,
+                          method=method)
         return buf.getvalue()
 
+    def to_raw(self, pixel_format='RGBA', downsample=1):
+        return encode_raw_image(self.img, pixel_format, downsample)
+
+
+class EncodedImage(WrappedImage):
+    """
+    Image which is already encoded as PNG or JPEG, e.g. while it was
+    rendered (see :class:`splash.png_stream.PngStreamWriter`) or
+    in a screenshot cache. It can't be resized or cropped.
+    """
+    def __init__(self, data: bytes, size: QSize,
+                 image_format: str = 'PNG') -> None:
+        self.data = data
+        self._size = QSize(size)
+        self.image_format = image_format
+
+    @property
+    def size(self):
+        return QSize(self._size)
+
+    def resize(self, new_size):
+        raise NotImplementedError("Encoded image can't be resized")
+
+    def crop(self, rect):
+        if rect != QRect(QPoint(0, 0), self._size):
+            raise NotImplementedError("Encoded image can't be cropped")
+
+    def resample(self, box, new_size):
+        raise NotImplementedError("Encoded image can't be resized")
+
+    def to_png(self, complevel=defaults.PNG_COMPRESSION_LEVEL):
+        if self.image_format != 'PNG':
+            raise ValueError("%s image can't be converted to PNG" %
+                             self.image_format)
+        return self.data
+
+    def to_jpeg(self, quality=None):
+        if self.image_format != 'JPEG':
+            raise ValueError("%s image can't be converted to JPEG" %
+                             self.image_format)
+        return self.data
+
+    def to_webp(self, quality=defaults.WEBP_QUALITY, lossless=False,
+                method=defaults.WEBP_METHOD):
+        if self.image_format != 'WEBP':
+            raise ValueError("%s image can't be converted to WebP" %
+                             self.image_format)
+        return self.data
+
+    def to_raw(self, pixel_format='RGBA', downsample=1):
+        # Raw screenshots are rendered with stream=False; other images
+        # are already encoded, so they have to be decoded again.
+        image = Image.open(BytesIO(self.data))
+        return encode_raw_image(image, pixel_format, downsample)
+
+
+class CachingImage(WrappedImage):
+    """
+    WrappedImage wrapper which stores the encoded image in
+    a screenshot cache under ``cache_key``.
+    """
+    def __init__(self, image: WrappedImage, cache, cache_key: str) -> None:
+        self.image = image
+        self.cache = cache
+        self.cache_key = cache_key
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def resize(self, new_size):
+        self.image.resize(new_size)
+
+    def crop(self, rect):
+        self.image.crop(rect)
+
+    def resample(self, box, new_size):
+        self.image.resample(box, new_size)
+
+    def to_png(self, complevel=defaults.PNG_COMPRESSION_LEVEL):
+        return self._cached(self.image.to_png(complevel))
+
+    def to_jpeg(self, quality=None):
+        return self._cached(self.image.to_jpeg(quality))
+
+    def to_webp(self, quality=defaults.WEBP_QUALITY, lossless=False,
+                method=defaults.WEBP_METHOD):
+        return self._cached(self.image.to_webp(quality, lossless, method))
+
+    def to_raw(self, pixel_format='RGBA', downsample=1):
+        # raw images are too large to be cached
+        return self.image.to_raw(pixel_format, downsample)
+
+    def _cached(self, data):
+        if data:
+            self.cache.put(self.cache_key, data, qsize_to_tuple(self.size))
+        return data
+
 
 class EmptyImage(WrappedImage):
     @property
@@ -415,8 +767,18 @@ class EmptyImage(WrappedImage):
     def crop(self, rect):
         pass
 
+    def resample(self, box, new_size):
+        pass
+
     def to_png(self, complevel=defaults.PNG_COMPRESSION_LEVEL):
         return b''
 
     def to_jpeg(self, quality=None):
         return b''
+
+    def to_webp(self, quality=defaults.WEBP_QUALITY, lossless=False,
+                method=defaults.WEBP_METHOD):
+        return b''
+
+    def to_raw(self, pixel_format='RGBA', downsample=1):
+        return b''
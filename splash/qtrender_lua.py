@@ -10,10 +10,12 @@ import weakref
 from urllib.parse import urlencode
 
 import twisted
+from twisted.python.failure import Failure
 from PyQt5.QtCore import QTimer
 import lupa
 
 import splash
+from splash import defaults
 from splash.browser_tab import BrowserTab
 from splash.errors import JsError
 from splash.lua_runner import (
@@ -26,6 +28,7 @@ from splash.lua import (get_main, get_main_sandboxed, parse_error_message,
                         PyResult, _mark_table_as_array)
 from splash.har.qt import reply2har, request2har
 from splash.har.utils import get_response_body_bytes
+from splash.http_cache import CACHE_POLICIES
 from splash.render_options import RenderOptions
 from splash.utils import (
     truncated,
@@ -47,6 +50,8 @@ from splash.qtutils import (
 from splash.lua_runtime import SplashLuaRuntime
 from splash.errors import ScriptError, DOMError
 from splash.html_element import HTMLElement, escape_js_args
+from splash.raw_image import RAW_CONTENT_TYPE
+from splash.screenshot_specs import parse_screenshot_spec
 
 
 class AsyncBrowserCommand(AsyncCommand):
@@ -730,21 +735,24 @@ class Splash(BaseExposedObject):
 
     @command()
     def png(self, width=None, height=None, render_all=False,
-            scale_method=None, region=None):
+            scale_method=None, region=None, format=None, downsample=None):
         if width is not None:
             width = int(width)
         if height is not None:
             height = int(height)
         region = self.validate_region(region)
-        result = self.tab.png(width, height, b64=False, render_all=render_all,
-                              scale_method=scale_method, region=region)
-        if not result:
-            return None
-        return BinaryCapsule(result, 'image/png')
+        if self.validate_image_format(format, downsample, 'png'):
+            return self.raw_image(width, height, render_all, scale_method,
+                                  region, 'RGBA', downsample)
+        d = self.tab.png_deferred(width, height, b64=False,
+                                  render_all=render_all,
+                                  scale_method=scale_method, region=region)
+        return self.image_result(d, 'image/png')
 
     @command()
     def jpeg(self, width=None, height=None, render_all=False,
-             scale_method=None, quality=None, region=None):
+             scale_method=None, quality=None, region=None, format=None,
+             downsample=None):
         if width is not None:
             width = int(width)
         if height is not None:
@@ -753,12 +761,180 @@ class Splash(BaseExposedObject):
             quality = int(quality)
 
         region = self.validate_region(region)
-        result = self.tab.jpeg(width, height, b64=False, render_all=render_all,
-                               scale_method=scale_method, quality=quality,
-                               region=region)
-        if not result:
+        if self.validate_image_format(format, downsample, 'jpeg'):
+            return self.raw_image(width, height, render_all, scale_method,
+                                  region, 'RGB', downsample)
+        d = self.tab.jpeg_deferred(width, height, b64=False,
+                                   render_all=render_all,
+                                   scale_method=scale_method, quality=quality,
+                                   region=region)
+        return self.image_result(d, 'image/jpeg')
+
+    @command()
+    def webp(self, width=None, height=None, render_all=False,
+             scale_method=None, quality=None, lossless=False, method=None,
+             region=None):
+        if width is not None:
+            width = int(width)
+        if height is not None:
+            height = int(height)
+        quality, method = self.validate_webp_options(quality, method,
+                                                     "splash:webp")
+        region = self.validate_region(region)
+        d = self.tab.webp_deferred(width, height, b64=False,
+                                   render_all=render_all,
+                                   scale_method=scale_method, quality=quality,
+                                   lossless=bool(lossless), method=method,
+                                   region=region)
+        return self.image_result(d, 'image/webp')
+
+    @command()
+    def screenshots(self, images, render_all=False):
+        specs = self.parse_screenshot_specs(images)
+        keys = list(specs)
+        d = self.tab.screenshots_deferred([specs[key] for key in keys],
+                                          render_all=render_all, b64=False)
+
+        def to_capsules(results):
+            capsules = [
+                None if res is None else
+                BinaryCapsule(res[0], specs[key].content_type)
+                for key, res in zip(keys, results)
+            ]
+            if keys == list(range(1, len(keys) + 1)):
+                return capsules
+            return dict(zip(keys, capsules))
+
+        d.addCallback(to_capsules)
+        return self.deferred_result(d, "wait_screenshots")
+
+    @staticmethod
+    def parse_screenshot_specs(images):
+        """
+        Return a dict with ScreenshotSpec objects for ``images`` argument
+        of splash:screenshots - a table with image specifications.
+        """
+        if not isinstance(images, dict) or not images:
+            raise ScriptError({
+                "argument": "images",
+                "message": "splash:screenshots images must be "
+                           "a non-empty table",
+            })
+        if all(isinstance(key, int) for key in images):
+            keys = sorted(images)
+        else:
+            keys = sorted(images, key=str)
+        specs = {}
+        for key in keys:
+            try:
+                specs[key] = parse_screenshot_spec(images[key])
+            except ValueError as e:
+                raise ScriptError({
+                    "argument": "images",
+                    "message": "splash:screenshots images[%s]: %s" % (key, e),
+                })
+        return specs
+
+    @staticmethod
+    def validate_image_format(format, downsample, image_format):
+        """
+        Validate ``format`` and ``downsample`` arguments of splash:png
+        and splash:jpeg; return True if raw image is requested.
+        """
+        if format is None:
+            format = image_format
+        if format not in (image_format, 'raw'):
+            raise ScriptError({
+                "argument": "format",
+                "message": "splash:%s format must be either '%s' or 'raw'" % (
+                    image_format, image_format),
+            })
+        if downsample is not None:
+            if format != 'raw':
+                raise ScriptError({
+                    "argument": "downsample",
+                    "message": "splash:%s downsample is only supported "
+                               "with format='raw'" % image_format,
+                })
+            if not (isinstance(downsample, (int, float)) and
+                    int(downsample) == downsample and
+                    1 <= downsample <= defaults.MAX_DOWNSAMPLE):
+                raise ScriptError({
+                    "argument": "downsample",
+                    "message": "splash:%s downsample must be an integer "
+                               "in 1-%s range" % (image_format,
+                                                  defaults.MAX_DOWNSAMPLE),
+                })
+        return format == 'raw'
+
+    def raw_image(self, width, height, render_all, scale_method, region,
+                  pixel_format, downsample):
+        d = self.tab.raw_deferred(width, height, b64=False,
+                                  render_all=render_all,
+                                  scale_method=scale_method, region=region,
+                                  pixel_format=pixel_format,
+                                  downsample=int(downsample or 1))
+        return self.image_result(d, RAW_CONTENT_TYPE)
+
+    @staticmethod
+    def validate_webp_options(quality, method, prefix):
+        if quality is not None:
+            quality = int(quality)
+            if not 0 <= quality <= 100:
+                raise ScriptError({
+                    "argument": "quality",
+                    "message": "%s quality must be in 0-100 range" % prefix,
+                })
+        if method is not None:
+            method = int(method)
+            if not 0 <= method <= 6:
+                raise ScriptError({
+                    "argument": "method",
+                    "message": "%s method must be in 0-6 range" % prefix,
+                })
+        return quality, method
+
+    def image_result(self, d, content_type):
+        """
+        Return a result of splash:png/splash:jpeg-like command for
+        a Deferred returned by tab.png_deferred/tab.jpeg_deferred.
+        If the image is still being encoded (in an image encoding thread),
+        the command yields until it is ready.
+        """
+        def to_capsule(data):
+            if not data:
+                return None
+            return BinaryCapsule(data, content_type)
+
+        if d is None:
             return None
-        return BinaryCapsule(result, 'image/jpeg')
+        d.addCallback(to_capsule)
+        return self.deferred_result(d, "wait_image")
+
+    def deferred_result(self, d, name):
+        """
+        Return a result of a Deferred ``d`` if it is already available
+        (e.g. an image is encoded in the reactor thread); otherwise
+        yield until it is ready.
+        """
+        if d.called:
+            results = []
+            d.addBoth(results.append)
+            result, = results
+            if isinstance(result, Failure):
+                result.raiseException()
+            return result
+
+        def on_ready(result):
+            if isinstance(result, Failure):
+                cmd.raise_error(result.getErrorMessage())
+            else:
+                cmd.return_result(result)
+
+        cmd = AsyncFunctionCommand(name, dict(
+            func=lambda: d.addBoth(on_ready)
+        ))
+        return PyResult.yield_(cmd)
 
     @staticmethod
     def validate_region(region, var_name="region"):
@@ -1207,6 +1383,16 @@ class Splash(BaseExposedObject):
     def set_http2_enabled(self, enabled):
         self.tab.set_http2_enabled(bool(enabled))
 
+    @lua_property('http_cache_enabled')
+    @command()
+    def get_http_cache_enabled(self):
+        return self.tab.get_http_cache_enabled()
+
+    @get_http_cache_enabled.lua_setter
+    @command()
+    def set_http_cache_enabled(self, enabled):
+        self.tab.set_http_cache_enabled(bool(enabled))
+
     @lua_property('resource_timeout')
     @command()
     def get_resource_timeout(self):
@@ -1912,11 +2098,9 @@ class _ExposedElement(BaseExposedObject):
         if pad is not None and isinstance(pad, (int, float)):
             pad = (pad, pad, pad, pad)
         pad = self.splash.validate_region(pad, 'pad')
-        result = self.element.png(width, scale_method=scale_method, pad=pad)
-
-        if not result:
-            return None
-        return BinaryCapsule(result, 'image/png')
+        d = self.element.png_deferred(width, scale_method=scale_method,
+                                      pad=pad)
+        return self.splash.image_result(d, 'image/png')
 
     @command()
     def jpeg(self, width=None, scale_method=None, quality=None, pad=None):
@@ -1928,12 +2112,26 @@ class _ExposedElement(BaseExposedObject):
         if pad is not None and isinstance(pad, (int, float)):
             pad = (pad, pad, pad, pad)
         pad = self.splash.validate_region(pad, 'pad')
-        result = self.element.jpeg(width, scale_method=scale_method,
-                                   quality=quality, pad=pad)
+        d = self.element.jpeg_deferred(width, scale_method=scale_method,
+                                       quality=quality, pad=pad)
+        return self.splash.image_result(d, 'image/jpeg')
 
-        if not result:
-            return None
-        return BinaryCapsule(result, 'image/jpeg')
+    @command()
+    def webp(self, width=None, scale_method=None, quality=None,
+             lossless=False, method=None, pad=None):
+        if width is not None:
+            width = int(width)
+        quality, method = self.splash.validate_webp_options(
+            quality, method, "element:webp")
+
+        if pad is not None and isinstance(pad, (int, float)):
+            pad = (pad, pad, pad, pad)
+        pad = self.splash.validate_region(pad, 'pad')
+        d = self.element.webp_deferred(width, scale_method=scale_method,
+                                       quality=quality,
+                                       lossless=bool(lossless),
+                                       method=method, pad=pad)
+        return self.splash.image_result(d, 'image/webp')
 
     @command()
     def visible(self):
@@ -2147,6 +2345,19 @@ class _ExposedBoundRequest(BaseExposedObject):
     def set_http2_enabled(self, value):
         self.request.http2_enabled = bool(value)
 
+    @command()
+    @requires_request
+    def set_cache_policy(self, policy):
+        if policy not in CACHE_POLICIES:
+            raise ScriptError({
+                "argument": "policy",
+                "splash_method": "on_request",
+                "request_method": "set_cache_policy",
+                "message": "request:set_cache_policy() argument must be "
+                           "one of: %s" % ", ".join(sorted(CACHE_POLICIES)),
+            })
+        self.request.cache_policy = CACHE_POLICIES[policy]
+
 
 class _ExposedResponse(BaseExposedObject):
     """
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Uncompressed ("raw") screenshot format.
+
+A raw image is a 20-byte header followed by pixel rows, top to bottom,
+without padding between them::
+
+    magic         4 bytes   b"SRAW"
+    width         uint32    little-endian
+    height        uint32    little-endian
+    stride        uint32    little-endian, bytes per row
+    pixel format  4 bytes   b"RGBA" or b"RGB\\x00"
+
+Each pixel is 1 byte per channel, in pixel format order. Raw images are
+meant for clients which decode screenshots into pixel arrays anyway;
+e.g. with numpy::
+
+    width, height, stride, fmt, pixels = unpack_raw_image(data)
+    arr = np.frombuffer(pixels, np.uint8).reshape(height, width, -1)
+"""
+import struct
+from typing import Tuple
+
+from PIL import Image
+
+from splash import metrics
+
+
+RAW_MAGIC = b"SRAW"
+RAW_HEADER = struct.Struct("<4sIII4s")
+RAW_CONTENT_TYPE = "application/octet-stream"
+RAW_PIXEL_FORMATS = ('RGBA', 'RGB')
+
+
+def encode_raw_image(image: Image.Image, pixel_format: str = 'RGBA',
+                     downsample: int = 1) -> bytes:
+    """
+    Return Pillow ``image`` as a raw image. If ``downsample`` is greater
+    than 1, image is reduced by this factor in both dimensions;
+    each resulting pixel is an average of ``downsample`` x ``downsample``
+    source pixels.
+    """
+    if pixel_format not in RAW_PIXEL_FORMATS:
+        raise ValueError("Unsupported pixel format: %s" % pixel_format)
+    if downsample < 1:
+        raise ValueError("Invalid downsample factor: %s" % downsample)
+    with metrics.IMAGE_ENCODE_DURATION.labels(format='raw').time():
+        if image.mode != pixel_format:
+            image = image.convert(pixel_format)
+        if downsample > 1:
+            image = image.reduce(downsample)
+        width, height = image.size
+        header = RAW_HEADER.pack(RAW_MAGIC, width, height,
+                                 width * len(pixel_format),
+                                 pixel_format.encode('ascii'))
+        return header + image.tobytes()
+
+
+def unpack_raw_image(data: bytes) -> Tuple[int, int, int, str, memoryview]:
+    """
+    Parse a raw image; return ``(width, height, stride, pixel_format,
+    pixels)`` tuple.
+    """
+    if len(data) < RAW_HEADER.size:
+        raise ValueError("Raw image is too short")
+    magic, width, height, stride, pixel_format = RAW_HEADER.unpack_from(data)
+    if magic != RAW_MAGIC:
+        raise ValueError("Not a raw image")
+    pixels = memoryview(data)[RAW_HEADER.size:]
+    if len(pixels) != stride * height:
+        raise ValueError("Raw image is truncated")
+    return (width, height, stride,
+            pixel_format.rstrip(b"\x00").decode('ascii'), pixels)
+
+
+def raw_image_to_pil(data: bytes) -> Image.Image:
+    """ Decode a raw image to Pillow image """
+    width, height, stride, pixel_format, pixels = unpack_raw_image(data)
+    return Image.frombytes(pixel_format, (width, height), bytes(pixels),
+                           'raw', pixel_format, stride)
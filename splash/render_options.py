@@ -5,6 +5,7 @@ import json
 from splash import defaults
 from splash.utils import to_bytes, path_join_secure
 from splash.errors import BadOption
+from splash.screenshot_specs import parse_screenshot_spec
 
 
 class RenderOptions(object):
@@ -14,6 +15,9 @@ class RenderOptions(object):
 
     _REQUIRED = object()
 
+    # splash.pool.RenderStats instance, set by RenderPool
+    render_stats = None
+
     def __init__(self, data, max_timeout):
         self.data = data
         self.max_timeout = max_timeout
@@ -59,6 +63,11 @@ class RenderOptions(object):
                     data['js_source'] = request.content.read().decode('utf-8')
                 request.content.seek(0)
 
+        # 4. client id for fair scheduling can be also sent in a header
+        client_id = request.getHeader(b'x-splash-client-id')
+        if client_id and 'client_id' not in data:
+            data['client_id'] = client_id.decode('utf-8')
+
         data['uid'] = id(request)
         return cls(data, max_timeout)
 
@@ -129,6 +138,21 @@ class RenderOptions(object):
         return self.get("timeout", default, type=float,
                         range=(0, self.max_timeout))
 
+    def get_queue_timeout(self):
+        return self.get("queue_timeout", None, type=float,
+                        range=(0, self.get_timeout()))
+
+    def get_render_timeout(self):
+        return self.get("render_timeout", None, type=float,
+                        range=(0, self.get_timeout()))
+
+    def get_priority(self):
+        return self.get("priority", defaults.PRIORITY, type=int,
+                        range=(-defaults.MAX_PRIORITY, defaults.MAX_PRIORITY))
+
+    def get_client_id(self):
+        return self.get("client_id", default=None)
+
     def get_resource_timeout(self):
         return self.get("resource_timeout", defaults.RESOURCE_TIMEOUT,
                         type=float, range=(0, 1e6))
@@ -371,6 +395,9 @@ class RenderOptions(object):
             default = defaults.CHROMIUM_HTTP2_ENABLED
         return self._get_bool("http2", default)
 
+    def get_http_cache(self):
+        return self._get_bool("http_cache", True)
+
     def get_common_params(self, js_profiles_path):
         wait = self.get_wait()
         return {
@@ -389,6 +416,7 @@ class RenderOptions(object):
             'body': self.get_body(),
             'html5_media': self.get_html5_media(),
             'http2': self.get_http2(),
+            'http_cache': self.get_http_cache(),
             # 'lua': self.get_lua(),
         }
 
@@ -407,6 +435,70 @@ class RenderOptions(object):
         params.update(self.get_image_params())
         return params
 
+    def get_webp_params(self):
+        params = {
+            'quality': self.get("quality", defaults.WEBP_QUALITY, type=int,
+                                range=(0, 100)),
+            'lossless': bool(self._get_bool("lossless", False)),
+            'method': self.get("method", defaults.WEBP_METHOD, type=int,
+                               range=(0, 6)),
+        }
+        params.update(self.get_image_params())
+        return params
+
+    def get_raw_params(self, image_format):
+        """
+        Return parameters of ``format=raw`` option of render.png
+        and render.jpeg endpoints; ``image_format`` is the default format
+        of the endpoint.
+        """
+        fmt = self.get("format", image_format)
+        allowed_formats = [image_format, 'raw']
+        if fmt not in allowed_formats:
+            self.raise_error(
+                argument='format',
+                description="Invalid 'format': %s" % fmt,
+                allowed=allowed_formats,
+                received=fmt,
+            )
+        downsample = self.get("downsample", 1, type=int,
+                              range=(1, defaults.MAX_DOWNSAMPLE))
+        if downsample != 1 and fmt != 'raw':
+            self.raise_error("downsample",
+                             "'downsample' is only supported with format=raw")
+        return {'raw': fmt == 'raw', 'downsample': downsample}
+
+    def get_screenshots(self):
+        """
+        Return a list of ScreenshotSpec objects for ``screenshots`` argument
+        of render.json (a JSON array of image specifications), or None.
+        """
+        screenshots = self.get("screenshots", default=None, type=None)
+        if screenshots is None:
+            return None
+        if isinstance(screenshots, str):
+            try:
+                screenshots = json.loads(screenshots)
+            except ValueError:
+                self.raise_error("screenshots",
+                                 "'screenshots' must be a JSON array")
+        if not isinstance(screenshots, list) or not screenshots:
+            self.raise_error("screenshots",
+                             "'screenshots' must be a non-empty JSON array "
+                             "of image specifications")
+        if len(screenshots) > defaults.MAX_SCREENSHOTS:
+            self.raise_error("screenshots", "Too many screenshots",
+                             max=defaults.MAX_SCREENSHOTS,
+                             received=len(screenshots))
+        specs = []
+        for index, data in enumerate(screenshots):
+            try:
+                specs.append(parse_screenshot_spec(data))
+            except ValueError as e:
+                self.raise_error("screenshots",
+                                 "Invalid screenshots[%d]: %s" % (index, e))
+        return specs
+
     def get_include_params(self):
         return dict(
             html=self._get_bool("html", defaults.DO_HTML),
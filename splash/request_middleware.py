@@ -4,15 +4,60 @@ Classes that process (and maybe filter) requests based on
 various conditions. They should be used with
 :class:`splash.network_manager.SplashQNetworkAccessManager`.
 """
-import re
+import functools
 import os
 from urllib.parse import urlsplit
 
+from twisted.internet import defer, threads
 from twisted.python import log
 
+from splash import metrics
+from splash.adblock import FilterIndex, load_snapshot, save_snapshot
 from splash.qtutils import request_repr, drop_request, get_request_webframe
 
 
+class HostMatcher(object):
+    """
+    Check if a host is one of ``domains`` or, if ``allow_subdomains``
+    is True, a subdomain of one of them. Matching is case-insensitive.
+
+    Host suffixes are looked up in a set, so the check doesn't
+    become slower as more domains are added.
+
+    >>> matcher = HostMatcher(['example.com', 'foo.org'])
+    >>> matcher.match('www.Example.COM'), matcher.match('badexample.com')
+    (True, False)
+    >>> HostMatcher(['example.com'], allow_subdomains=False).match('www.example.com')
+    False
+    """
+    def __init__(self, domains, allow_subdomains=True):
+        self.domains = frozenset(domain.lower() for domain in domains)
+        self.allow_subdomains = allow_subdomains
+
+    def match(self, host):
+        host = host.lower()
+        if host in self.domains:
+            return True
+        if not self.allow_subdomains:
+            return False
+        pos = host.find('.')
+        while pos != -1:
+            if host[pos + 1:] in self.domains:
+                return True
+            pos = host.find('.', pos + 1)
+        return False
+
+
+@functools.lru_cache(maxsize=128)
+def get_host_matcher(domains, allow_subdomains=True):
+    """
+    Return a HostMatcher for a tuple of ``domains``; matchers are cached,
+    so that all requests of a render (and renders with the same
+    ``allowed_domains`` argument) share one.
+    """
+    return HostMatcher(domains, allow_subdomains)
+
+
 class AllowedDomainsMiddleware(object):
     """
     This request middleware checks ``allowed_domains`` argument
@@ -24,24 +69,26 @@ class AllowedDomainsMiddleware(object):
 
     def process(self, request, render_options, operation, data):
         allowed_domains = render_options.get_allowed_domains()
-        host_re = self._get_host_regex(allowed_domains, self.allow_subdomains)
-        if not host_re.match(str(request.url().host())):
+        host_matcher = self._get_host_matcher(allowed_domains,
+                                              self.allow_subdomains)
+        if host_matcher is None:
+            return request  # allow all by default
+        if not host_matcher.match(str(request.url().host())):
             if self.verbosity >= 2:
                 msg = "Dropped offsite %s" % request_repr(request, operation)
                 log.msg(msg, system='request_middleware')
             drop_request(request)
         return request
 
-    def _get_host_regex(self, allowed_domains, allow_subdomains):
-        """ Override this method to implement a different offsite policy """
+    def _get_host_matcher(self, allowed_domains, allow_subdomains):
+        """
+        Override this method to implement a different offsite policy.
+        It should return an object with ``match(host)`` method (e.g.
+        a compiled regex), or None to allow all hosts.
+        """
         if not allowed_domains:
-            return re.compile('')  # allow all by default
-        domains = [d.replace('.', r'\.') for d in allowed_domains]
-        if allow_subdomains:
-            regex = r'(.*\.)?(%s)$' % '|'.join(domains)
-        else:
-            regex = r'(%s)$' % '|'.join(domains)
-        return re.compile(regex, re.IGNORECASE)
+            return None
+        return get_host_matcher(tuple(allowed_domains), allow_subdomains)
 
 
 class AllowedSchemesMiddleware(object):
@@ -131,6 +178,7 @@ class AdblockMiddleware(object):
         options = {'domain': domain}
         blocking_filter = self.rules.get_blocking_filter(filter_names, url, options)
         if blocking_filter:
+            metrics.ADBLOCK_BLOCKED_REQUESTS.labels(filter=blocking_filter).inc()
             if self.verbosity >= 2:
                 msg = "Filter %s: dropped %s %s" % (
                     blocking_filter,
@@ -152,14 +200,29 @@ class AdblockMiddleware(object):
 
 
 class AdblockRulesRegistry(object):
+    """
+    Adblock Plus filters loaded from ``.txt`` files in ``path`` folder.
+    Rules of all filters are matched using a shared
+    :class:`splash.adblock.FilterIndex`.
 
-    RE2_WARN_THRESHOLD = 100
+    Parsed filters are saved to a snapshot file in the same folder;
+    the snapshot is used instead of parsing ``.txt`` files again
+    until any of them changes.
+    """
+    SNAPSHOT_NAME = '.filters.snapshot'
 
     def __init__(self, path, supported_options=('domain',), verbosity=0):
-        self.filters = {}
+        self.path = path
+        self.filters = {}  # filter name => number of rules
+        self.index = FilterIndex()
         self.verbosity = verbosity
         self.supported_options = supported_options
-        self._load(path)
+        self._snapshot_key = None
+        self._reloading = None
+        changes = self._get_changes()
+        if changes is not None:
+            fnames, snapshot_key = changes
+            self._swap(self._load(fnames, snapshot_key), snapshot_key)
 
     def get_blocking_filter(self, filter_names, url, options):
         for name in filter_names:
@@ -169,53 +232,130 @@ class AdblockRulesRegistry(object):
                     # names must be validated earlier
                     log.msg("Invalid filter name: %s" % name)
 
-        for name in filter_names:
-            if name not in self.filters:
-                continue
-            if self.filters[name].should_block(url, options):
-                return name
+        return self.index.get_blocking_filter(filter_names, url, options)
+
+    def reload(self):
+        """
+        Load filters if ``.txt`` files were changed, added or removed
+        since the last load. Return a Deferred which fires with True
+        if filters are reloaded.
+
+        Files are parsed in a thread, so that renders in progress are
+        not blocked. New filters replace old ones at once, after they
+        are loaded, so requests are checked either against old
+        or against new filters.
+        """
+        if self._reloading is not None:
+            return defer.succeed(False)
+        changes = self._get_changes()
+        if changes is None:
+            return defer.succeed(False)
+        fnames, snapshot_key = changes
+
+        def done(result):
+            self._reloading = None
+            return result
+
+        d = self._reloading = threads.deferToThread(
+            self._load, fnames, snapshot_key)
+        d.addCallback(self._swap, snapshot_key)
+        d.addBoth(done)
+        return d
+
+    def _get_changes(self):
+        """
+        Return ``(fnames, snapshot_key)`` tuple if filter files were
+        changed since the last load, None otherwise.
+        """
+        fnames = [
+            fname for fname in sorted(os.listdir(self.path))
+            if fname.endswith('.txt') and
+            os.path.isfile(os.path.join(self.path, fname))
+        ]
+        snapshot_key = self._get_snapshot_key(fnames)
+        if snapshot_key == self._snapshot_key:
+            return None
+        return fnames, snapshot_key
+
+    def _swap(self, loaded, snapshot_key):
+        if loaded is None:
+            return False
+        self.index, self.filters = loaded
+        self._snapshot_key = snapshot_key
+        return True
+
+    def _load(self, fnames, snapshot_key):
+        """
+        Return ``(index, filters)`` tuple. It doesn't change the registry,
+        so it can be called in a thread.
+        """
+        snapshot_path = os.path.join(self.path, self.SNAPSHOT_NAME)
+        snapshot = load_snapshot(snapshot_path, snapshot_key)
+        if snapshot is not None:
+            index, filters = snapshot
+            if self.verbosity >= 1:
+                log.msg("Filters %s loaded from %s" % (
+                    ", ".join(sorted(filters)), snapshot_path))
+            index.prepare()
+            return index, filters
 
-    def _load(self, path):
         try:
-            import adblockparser
+            from adblockparser import AdblockRule
         except ImportError:
             log.msg('WARNING: https://github.com/scrapinghub/adblockparser '
                     'library is not available, filters are not loaded.')
             return
 
-        for fname in os.listdir(path):
-            if not fname.endswith('.txt'):
-                continue
-            fpath = os.path.join(path, fname)
+        index = FilterIndex()
+        filters = {}
+        params = {option: True for option in self.supported_options}
+        for fname in fnames:
+            fpath = os.path.join(self.path, fname)
             name = fname[:-len('.txt')]
 
-            if not os.path.isfile(fpath):
-                continue
-
             if self.verbosity >= 1:
                 log.msg("Loading filter %s" % name)
 
+            filters_num = 0
             with open(fpath, 'rb') as f:
-                lines = [line.decode('utf8').strip() for line in f]
-
-            rules = adblockparser.AdblockRules(
-                lines,
-                supported_options=self.supported_options,
-                skip_unsupported_rules=False,
-                max_mem=512*1024*1024,  # this doesn't actually use 512M
-            )
-            filters_num = len(rules.rules)
+                for line in f:
+                    rule = AdblockRule(line.decode('utf8').strip())
+                    if not (rule.regex or rule.options):
+                        continue
+                    if not rule.matching_supported(params):
+                        continue
+                    index.add_rule(rule, name)
+                    filters_num += 1
 
             if self.verbosity >= 2:
                 log.msg("%d rule(s) loaded for filter %s" % (filters_num, name))
 
-            if not rules.uses_re2 and filters_num > self.RE2_WARN_THRESHOLD:
-                log.msg('WARNING: a filter %s with %d rules loaded, but '
-                        'pyre2 library is not installed. Matching may become '
-                        'slow; installing https://github.com/axiak/pyre2 is '
-                        'highly recommended.' % (name, filters_num))
+            filters[name] = filters_num
 
-            self.filters[name] = rules
+        index.prepare()
+        if self.verbosity >= 2:
+            log.msg("Filter index: %(rules)d unique rule(s), %(tokens)d "
+                    "token(s), %(generic_rules)d rule(s) without tokens"
+                    % index.stats())
+
+        if fnames:
+            try:
+                save_snapshot(snapshot_path, index, filters, snapshot_key)
+            except OSError as e:
+                if self.verbosity >= 1:
+                    log.msg("Filters snapshot is not saved: %s" % e)
+        return index, filters
+
+    def _get_snapshot_key(self, fnames):
+        """
+        Return a value which changes when filter files or
+        supported options change.
+        """
+        files = []
+        for fname in fnames:
+            stat = os.stat(os.path.join(self.path, fname))
+            files.append([fname, stat.st_size, stat.st_mtime_ns])
+        return {'files': files, 'options': list(self.supported_options)}
 
     def filter_is_known(self, name):
         return name in self.filters
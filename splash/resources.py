@@ -4,6 +4,7 @@ exposed to the user).
 """
 import os
 import gc
+import base64
 import time
 import json
 import resource
@@ -13,6 +14,9 @@ from twisted.internet.base import DelayedCall
 from twisted.python.failure import Failure
 from twisted.web.server import NOT_DONE_YET
 from twisted.web.resource import Resource
+from twisted.web.error import UnsupportedMethod
+from twisted.internet.interfaces import IPullProducer
+from zope.interface import implementer
 from twisted.web.static import File
 from twisted.internet import reactor, defer
 from twisted.python import log
@@ -25,6 +29,7 @@ from splash.engines.webkit.render_scripts import (
     JsonRender,
     HarRender,
     JpegRender,
+    WebpRender,
 )
 from splash.engines.chromium.render_scripts import (
     ChromiumRenderHtmlScript,
@@ -37,16 +42,24 @@ from splash.utils import (
     get_leaks,
     BinaryCapsule,
     SplashJSONEncoder,
+    StreamedJSON,
+    get_cpu_time,
     get_ru_maxrss,
+    get_rss,
     to_bytes)
 from splash import sentry
+from splash import metrics
 from splash.render_options import RenderOptions
 from splash.qtutils import clear_caches
+from splash.screenshot_cache import get_screenshot_cache
 from splash.errors import (
     BadOption, RenderError, InternalError,
     GlobalTimeoutError, UnsupportedContentType,
     ExpiredArguments,
-    CancelledError)
+    CancelledError,
+    OverloadedError,
+    QueueTimeoutError,
+    RenderTimeoutError)
 
 if lua_is_supported():
     from splash.qtrender_lua import LuaRender
@@ -129,9 +142,18 @@ class BaseRenderResource(_ValidatingResource):
         # check arguments before starting the render
         render_options.get_filters(self.pool)
         render_options.get_engine(browser_engines_enabled=self.browser_engines_enabled)
+        priority = render_options.get_priority()
+
+        try:
+            self.pool.check_queue_limits(priority)
+        except OverloadedError as e:
+            error = self._write_overloaded_error(request, e)
+            self._log_stats(request, original_options, error)
+            return b"\n"
 
         timeout = render_options.get_timeout()
         pool_d = self._get_render(request, render_options)
+        request.render_stats = render_options.render_stats
         timer = reactor.callLater(timeout, pool_d.cancel)
         request.notifyFinish().addErrback(self._request_failed, pool_d, timer)
 
@@ -139,6 +161,9 @@ class BaseRenderResource(_ValidatingResource):
         pool_d.addCallback(self._write_output, request)
         pool_d.addErrback(self._on_timeout_error, request,
                           timeout=timeout, timer=timer)
+        pool_d.addErrback(self._on_queue_timeout_error, request,
+                          priority=priority)
+        pool_d.addErrback(self._on_render_timeout_error, request)
         pool_d.addErrback(self._on_render_error, request)
         pool_d.addErrback(self._on_bad_request, request)
         pool_d.addErrback(self._on_internal_error, request)
@@ -195,6 +220,11 @@ class BaseRenderResource(_ValidatingResource):
         if isinstance(data, BinaryCapsule):
             return self._write_output(data.data, request, data.content_type)
 
+        if isinstance(data, StreamedJSON):
+            request.setHeader(b"content-type", b"application/json")
+            producer = _ChunkedProducer(request, data.iter_chunks())
+            return producer.start()
+
         if not isinstance(data, bytes):
             data = data.encode('utf8')
 
@@ -209,6 +239,11 @@ class BaseRenderResource(_ValidatingResource):
 
         request.write(data)
 
+    def _write_overloaded_error(self, request, ex):
+        retry_after = str(ex.args[0]['retry_after'])
+        request.setHeader(b'Retry-After', retry_after.encode('ascii'))
+        return self._write_error(request, 503, ex)
+
     def _write_expired_args(self, request, expired_args):
         ex = ExpiredArguments({'expired': expired_args})
         return self._write_error(request, 498, ex)
@@ -219,20 +254,26 @@ class BaseRenderResource(_ValidatingResource):
         return "***"
 
     def _log_stats(self, request, options, error=None):
+        self._update_metrics(request, options)
         options = {
             key: self._value_for_logging(key, value)
             for key, value in options.items()
         }
+        stats = getattr(request, 'render_stats', None)
         msg = {
             # Anything we retrieve from Twisted request object contains bytes.
             # We have to convert it to unicode first for json.dump to succeed.
             "path": request.path.decode('utf-8'),
             "rendertime": time.time() - request.starttime,
+            "queuetime": stats.queue_time if stats else None,
+            "slottime": stats.slot_time if stats else None,
+            "rssdelta": stats.rss_delta if stats else None,
             "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
             "load": os.getloadavg(),
             "fds": get_num_fds(),
             "active": len(self.pool.active),
-            "qsize": len(self.pool.queue.pending),
+            "qsize": len(self.pool.queue),
+            "queue": self.pool.queue.stats(),
             "_id": id(request),
             "method": request.method.decode('ascii'),
             "timestamp": int(time.time()),
@@ -247,6 +288,32 @@ class BaseRenderResource(_ValidatingResource):
         msg = json.dumps(msg).encode("utf8")
         log.msg(msg, system="events")
 
+    def _update_metrics(self, request, options):
+        endpoint = request.prepath[0].decode('utf-8') if request.prepath else ''
+        self.record_metrics(
+            endpoint=endpoint,
+            engine=options.get('engine', 'webkit'),
+            status=request.code,
+            duration=time.time() - request.starttime,
+            stats=getattr(request, 'render_stats', None),
+        )
+
+    def record_metrics(self, endpoint, engine, status, duration, stats):
+        if engine not in {'webkit', 'chromium'}:
+            engine = 'unknown'
+        metrics.REQUESTS.labels(endpoint=endpoint, engine=engine,
+                                status=status).inc()
+        metrics.REQUEST_DURATION.labels(endpoint=endpoint, engine=engine).observe(
+            duration)
+        if stats is None:
+            return
+        if stats.queue_time is not None:
+            metrics.QUEUE_WAIT.labels(endpoint=endpoint, engine=engine).observe(
+                stats.queue_time)
+        if stats.slot_time is not None:
+            metrics.RENDER_DURATION.labels(endpoint=endpoint, engine=engine).observe(
+                stats.slot_time)
+
     def _on_timeout_error(self, failure, request, timeout: float = None,
                           timer: DelayedCall = None):
         failure.trap(defer.CancelledError)
@@ -262,6 +329,16 @@ class BaseRenderResource(_ValidatingResource):
         ex = GlobalTimeoutError(msg)
         return self._write_error(request, 504, ex)
 
+    def _on_queue_timeout_error(self, failure, request, priority):
+        failure.trap(QueueTimeoutError)
+        retry_after = str(self.pool.estimate_retry_after(priority))
+        request.setHeader(b'Retry-After', retry_after.encode('ascii'))
+        return self._write_error(request, 503, failure.value)
+
+    def _on_render_timeout_error(self, failure, request):
+        failure.trap(RenderTimeoutError)
+        return self._write_error(request, 504, failure.value)
+
     def _on_render_error(self, failure, request):
         failure.trap(RenderError)
         # log.msg("_on_render_error: %s" % id(request))
@@ -294,7 +371,9 @@ class BaseRenderResource(_ValidatingResource):
             error = failure
 
         self._log_stats(request, options, error=error)
-        if not request._disconnected:
+        # a failed streamed response must stay incomplete
+        stream_aborted = getattr(request, 'stream_aborted', False)
+        if not request._disconnected and not stream_aborted:
             request.finish()
 
         # log.msg("_finishRequest: %s" % id(request))
@@ -361,8 +440,11 @@ class RenderPngResource(BaseRenderResource):
         params = options.get_common_params(self.js_profiles_path)
         params.update(options.get_png_params())
         engine = options.get_engine(self.browser_engines_enabled)
-        script = PngRender if engine == "webkit" else ChromiumRenderPngScript
-        return self.pool.render(script, options, **params)
+        if engine == "webkit":
+            params.update(options.get_raw_params('png'))
+            return self.pool.render(PngRender, options, **params)
+        _check_raw_not_requested(options)
+        return self.pool.render(ChromiumRenderPngScript, options, **params)
 
 
 class RenderJpegResource(BaseRenderResource):
@@ -373,8 +455,30 @@ class RenderJpegResource(BaseRenderResource):
         params = options.get_common_params(self.js_profiles_path)
         params.update(options.get_jpeg_params())
         engine = options.get_engine(self.browser_engines_enabled)
-        script = JpegRender if engine == "webkit" else ChromiumRenderJpegScript
-        return self.pool.render(script, options, **params)
+        if engine == "webkit":
+            params.update(options.get_raw_params('jpeg'))
+            return self.pool.render(JpegRender, options, **params)
+        _check_raw_not_requested(options)
+        return self.pool.render(ChromiumRenderJpegScript, options, **params)
+
+
+def _check_raw_not_requested(options):
+    if options.get("format", None) == 'raw':
+        raise BadOption("format=raw is not supported by engine=chromium yet")
+
+
+class RenderWebpResource(BaseRenderResource):
+
+    content_type = "image/webp"
+
+    def _get_render(self, request, options):
+        engine = options.get_engine(self.browser_engines_enabled)
+        if engine != 'webkit':
+            raise BadOption("engine=chromium is not supported yet")
+
+        params = options.get_common_params(self.js_profiles_path)
+        params.update(options.get_webp_params())
+        return self.pool.render(WebpRender, options, **params)
 
 
 class RenderJsonResource(BaseRenderResource):
@@ -388,6 +492,7 @@ class RenderJsonResource(BaseRenderResource):
         params = options.get_common_params(self.js_profiles_path)
         params.update(options.get_jpeg_params())
         params.update(options.get_include_params())
+        params['screenshots'] = options.get_screenshots()
         params['request_body'] = options.get_request_body()
         params['response_body'] = options.get_response_body()
         return self.pool.render(JsonRender, options, **params)
@@ -407,6 +512,285 @@ class RenderHarResource(BaseRenderResource):
         return self.pool.render(HarRender, options, **params)
 
 
+@implementer(IPullProducer)
+class _ChunkedProducer:
+    """
+    Write text chunks from an iterator to a request when the connection
+    is ready for more data, so that a large response is never held
+    in memory as a whole.
+
+    If the iterator fails after a part of the response is sent, it is too
+    late to send an error response: the error is logged and the connection
+    is closed, so that the client sees an incomplete response.
+    """
+    buffer_size = 64 * 1024
+
+    def __init__(self, request, chunks):
+        self.request = request
+        self.chunks = chunks
+        self.deferred = defer.Deferred()
+        self.disconnected = False
+        self.started_writing = False
+        request.notifyFinish().addErrback(self._connection_lost)
+
+    def start(self):
+        """ Start writing; return a Deferred fired when all data is written """
+        self.request.registerProducer(self, False)
+        return self.deferred
+
+    def resumeProducing(self):
+        buf = []
+        size = 0
+        finished = False
+        failure = None
+        try:
+            for chunk in self.chunks:
+                buf.append(chunk)
+                size += len(chunk)
+                if size >= self.buffer_size:
+                    break
+            else:
+                finished = True
+        except Exception:
+            finished = True
+            failure = Failure()
+        if buf and not self.disconnected:
+            self.request.write("".join(buf).encode('utf-8'))
+            self.started_writing = True
+        if finished:
+            self._done(failure)
+
+    def stopProducing(self):
+        # connection is lost
+        self.chunks = iter(())
+        self._done()
+
+    def _connection_lost(self, failure):
+        self.disconnected = True
+
+    def _done(self, failure=None):
+        if self.deferred.called:
+            return
+        self.request.unregisterProducer()
+        if failure is not None and self.started_writing:
+            log.err(failure, "Error while streaming a response")
+            self.request.stream_aborted = True
+            if not self.disconnected:
+                self.request.loseConnection()
+            self.deferred.callback(None)
+        elif failure is not None:
+            self.deferred.errback(failure)
+        else:
+            self.deferred.callback(None)
+
+
+class RenderBatchResource(BaseRenderResource):
+    """
+    Render many jobs sent in a single POST request as a JSON array.
+    Each job is an object with render.* endpoint arguments and an
+    ``endpoint`` key (html, png, jpeg, webp, json or har). Jobs are rendered
+    in parallel, up to the number of render slots at a time; results
+    are streamed back as newline-delimited JSON in completion order.
+    """
+    content_type = "application/x-ndjson"
+
+    def __init__(self, endpoints, **kwargs):
+        super().__init__(**kwargs)
+        self.endpoints = endpoints  # endpoint name -> BaseRenderResource
+
+    def render_GET(self, request):
+        raise UnsupportedMethod([b'POST'])
+
+    def render_POST(self, request):
+        request.starttime = time.time()
+        content_type = request.getHeader(b'content-type') or b''
+        if b'application/json' not in content_type:
+            ex = UnsupportedContentType({
+                'supported': ['application/json'],
+                'received': content_type.decode('latin1'),
+            })
+            return self._write_error(request, 415, ex)
+
+        jobs = self._get_jobs(request)
+        request.setHeader(b"content-type", self.content_type.encode('latin1'))
+        batch = _RenderBatch(self, request, jobs)
+        request.notifyFinish().addErrback(batch.cancel)
+        batch.start()
+        return NOT_DONE_YET
+
+    def _get_jobs(self, request):
+        try:
+            jobs = json.loads(request.content.read().decode('utf-8'))
+        except ValueError as e:
+            raise BadOption({
+                'type': 'invalid_json',
+                'description': "Can't decode JSON",
+                'message': str(e),
+            })
+        if not isinstance(jobs, list) or not all(isinstance(job, dict)
+                                                 for job in jobs):
+            raise BadOption({
+                'type': 'bad_argument',
+                'description': "Request body must be a JSON array of objects",
+            })
+        return jobs
+
+    def get_job_options(self, request, index, job):
+        """ Return (job id, endpoint resource, RenderOptions) for a job """
+        # query arguments are defaults for all jobs
+        data = {key.decode('utf-8'): values[0].decode('utf-8')
+                for key, values in request.args.items()}
+        client_id = request.getHeader(b'x-splash-client-id')
+        if client_id:
+            data['client_id'] = client_id.decode('utf-8')
+        data.update(job)
+        job_id = data.pop('id', index)
+        endpoint = str(data.pop('endpoint', 'html'))
+        if not endpoint.startswith('render.'):
+            endpoint = 'render.' + endpoint
+        data['uid'] = "%d.%d" % (id(request), index)
+        options = RenderOptions(data, self.max_timeout)
+        if endpoint not in self.endpoints:
+            options.raise_error('endpoint', 'Unsupported endpoint',
+                                supported=sorted(self.endpoints))
+        return job_id, endpoint, options
+
+    def encode_result(self, endpoint, data):
+        """ Return a render result as a JSON string """
+        if isinstance(data, StreamedJSON):
+            return data.dumps()
+        if isinstance(data, BinaryCapsule):
+            data = data.data
+        if isinstance(data, bytes):
+            data = base64.b64encode(data).decode('ascii')
+        elif isinstance(data, str):
+            if self.endpoints[endpoint].content_type == "application/json":
+                # the result is already serialized
+                return data
+        return json.dumps(data, cls=SplashJSONEncoder)
+
+    def get_error(self, failure, timeout):
+        """ Return (HTTP status code, error dict) for a failed job """
+        if failure.check(defer.CancelledError):
+            code, ex = 504, GlobalTimeoutError({'timeout': timeout})
+        elif failure.check(BadOption):
+            code, ex = 400, failure.value
+        elif failure.check(OverloadedError, QueueTimeoutError):
+            code, ex = 503, failure.value
+        elif failure.check(RenderTimeoutError):
+            code, ex = 504, failure.value
+        elif failure.check(RenderError, InternalError):
+            code, ex = 502, failure.value
+        else:
+            sentry.capture(failure)
+            code, ex = 500, InternalError(str(failure.value))
+        return code, self._format_error(code, ex)
+
+
+class _RenderBatch:
+    """ Rendering state of a single /render.batch request """
+
+    def __init__(self, resource: RenderBatchResource, request, jobs):
+        self.resource = resource
+        self.request = request
+        self.jobs = jobs
+        self.pending = iter(enumerate(jobs))
+        self.running = {}  # pool Deferred -> timeout DelayedCall
+        self.cancelled = False
+        self.done = False
+
+    @property
+    def concurrency(self):
+        return max(1, self.resource.pool.slots)
+
+    def start(self):
+        """ Start new jobs while there are free render slots """
+        while not self.cancelled and len(self.running) < self.concurrency:
+            try:
+                index, job = next(self.pending)
+            except StopIteration:
+                break
+            self._start_job(index, job)
+        if not self.running:
+            self._finish()
+
+    def cancel(self, failure):
+        log.msg("Client disconnected: %s" % failure.value)
+        self.cancelled = True
+        for pool_d, timer in list(self.running.items()):
+            timer.cancel()
+            pool_d.cancel()
+
+    def _start_job(self, index, job):
+        job_id = job.get('id', index)
+        timeout = None
+        try:
+            job_id, endpoint, options = self.resource.get_job_options(
+                self.request, index, job)
+            options.get_filters(self.resource.pool)
+            self.resource.pool.check_queue_limits(options.get_priority())
+            timeout = options.get_timeout()
+            pool_d = self.resource.endpoints[endpoint]._get_render(
+                self.request, options)
+        except Exception:
+            code, error = self.resource.get_error(Failure(), timeout)
+            self._write_line({'id': job_id, 'index': index,
+                              'status': code, 'error': error})
+            return
+
+        timer = reactor.callLater(timeout, pool_d.cancel)
+        self.running[pool_d] = timer
+        pool_d.addCallback(self._on_result, job_id, index, endpoint)
+        pool_d.addErrback(self._on_error, job_id, index, timeout)
+        pool_d.addBoth(self._on_job_finished, pool_d, timer, options, endpoint)
+
+    def _on_result(self, data, job_id, index, endpoint):
+        result = self.resource.encode_result(endpoint, data)
+        line = json.dumps({'id': job_id, 'index': index, 'status': 200})
+        # result is already serialized; add it without decoding
+        self._write(line[:-1] + ', "result": ' + result + '}')
+        return 200
+
+    def _on_error(self, failure, job_id, index, timeout):
+        code, error = self.resource.get_error(failure, timeout)
+        self._write_line({'id': job_id, 'index': index,
+                          'status': code, 'error': error})
+        return code
+
+    def _on_job_finished(self, status, pool_d, timer, options, endpoint):
+        if isinstance(status, Failure):
+            log.err(status, "error writing /render.batch result")
+            status = 500
+        if timer.active():
+            timer.cancel()
+        del self.running[pool_d]
+        stats = options.render_stats
+        self.resource.record_metrics(
+            endpoint=endpoint,
+            engine=options.data.get('engine', 'webkit'),
+            status=status,
+            duration=time.time() - stats.queued_at,
+            stats=stats,
+        )
+        self.start()
+
+    def _write_line(self, data):
+        self._write(json.dumps(data, cls=SplashJSONEncoder))
+
+    def _write(self, line):
+        if self.cancelled or self.request._disconnected:
+            return
+        self.request.write(line.encode('utf-8') + b"\n")
+
+    def _finish(self):
+        if self.done:
+            return
+        self.done = True
+        self.resource._log_stats(self.request, {'jobs': len(self.jobs)})
+        if not self.request._disconnected:
+            self.request.finish()
+
+
 class DebugResource(Resource):
     isLeaf = True
 
@@ -421,10 +805,18 @@ class DebugResource(Resource):
         info = {
             "leaks": get_leaks(),
             "active": [self.get_repr(r) for r in self.pool.active],
-            "qsize": len(self.pool.queue.pending),
+            "qsize": len(self.pool.queue),
+            "queue": self.pool.queue.stats(),
+            "expected_queue_wait": self.pool.estimate_queue_wait(),
             "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "rss": get_rss(),
+            "rss_delta_by_host": self.pool.memory_stats.stats(),
+            "memory_outliers": self.pool.memory_outliers,
             "fds": get_num_fds(),
-            "argcache": len(self.argument_cache)
+            "argcache": len(self.argument_cache),
+            "pid": os.getpid(),
+            "screenshot_cache": get_screenshot_cache().stats(),
+            "tabs": self.pool.tab_stats(),
         }
         if self.warn:
             info['WARNING'] = "/debug endpoint is deprecated. " \
@@ -449,23 +841,57 @@ class ClearCachesResource(Resource):
     def render_POST(self, request):
         argcache_size = len(self.argument_cache)
         self.argument_cache.clear()
+        screenshot_cache = get_screenshot_cache()
+        screenshots_removed = screenshot_cache.stats()['entries']
+        screenshot_cache.clear()
         clear_caches()
         unreachable = gc.collect()
         return json.dumps({
             "status": "ok",
             "pyobjects_collected": unreachable,
             "cached_args_removed": argcache_size,
+            "cached_screenshots_removed": screenshots_removed,
         }, sort_keys=True).encode('utf-8')
 
 
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, pool):
+        Resource.__init__(self)
+        self.pool = pool
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", metrics.CONTENT_TYPE.encode('ascii'))
+        metrics.SLOTS.set(self.pool.slots)
+        metrics.ACTIVE_SLOTS.set(len(self.pool.active))
+        metrics.QUEUE_SIZE.set(len(self.pool.queue))
+        metrics.OPEN_FDS.set(get_num_fds())
+        metrics.RSS.set(get_rss())
+        metrics.MAX_RSS.set(get_ru_maxrss())
+        metrics.CPU_SECONDS.set(get_cpu_time())
+        return metrics.REGISTRY.render().encode('utf-8')
+
+
 class PingResource(Resource):
     isLeaf = True
 
+    def __init__(self, pool):
+        Resource.__init__(self)
+        self.pool = pool
+
     def render_GET(self, request):
         request.setHeader(b"content-type", b"application/json")
+        if self.pool.draining:
+            # tell load balancers this instance shouldn't get new requests
+            request.setResponseCode(503)
+            status = "draining"
+        else:
+            status = "ok"
         return (json.dumps({
-            "status": "ok",
+            "status": status,
             "maxrss": get_ru_maxrss(),
+            "rss": get_rss(),
         }, sort_keys=True)).encode('utf-8')
 
 
@@ -662,12 +1088,22 @@ class Root(Resource):
         self.putChild(b"render.html", RenderHtmlResource(**_kwargs))
         self.putChild(b"render.png", RenderPngResource(**_kwargs))
         self.putChild(b"render.jpeg", RenderJpegResource(**_kwargs))
+        self.putChild(b"render.webp", RenderWebpResource(**_kwargs))
         self.putChild(b"render.json", RenderJsonResource(**_kwargs))
         self.putChild(b"render.har", RenderHarResource(**_kwargs))
+        self.putChild(b"render.batch", RenderBatchResource(
+            endpoints={
+                name.decode('ascii'): self.children[name]
+                for name in [b"render.html", b"render.png", b"render.jpeg",
+                             b"render.webp", b"render.json", b"render.har"]
+            },
+            **_kwargs
+        ))
 
         self.putChild(b"_debug", DebugResource(pool, self.argument_cache))
         self.putChild(b"_gc", ClearCachesResource(self.argument_cache))
-        self.putChild(b"_ping", PingResource())
+        self.putChild(b"_ping", PingResource(pool))
+        self.putChild(b"metrics", MetricsResource(pool))
 
         # backwards compatibility
         self.putChild(b"debug", DebugResource(pool, self.argument_cache,
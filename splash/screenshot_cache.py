@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory LRU cache of encoded screenshots.
+
+Cache keys are computed by screenshot renderers from a fingerprint of
+the rendered page (URL, DOM of all frames, viewport, scroll position and
+webpage options) and image parameters, so a page which didn't change
+is not rendered and encoded again. Entries evicted from memory can optionally be kept on disk.
+"""
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from twisted.python import log
+
+from splash import defaults, metrics
+
+
+class ScreenshotCache:
+    """
+    LRU cache of encoded images; ``max_size`` and ``max_disk_size``
+    limit total size of cached data, in bytes. Entries evicted from
+    memory are written to ``disk_path`` folder if it is set.
+
+    The cache is thread-safe: images may be encoded (and cached)
+    by image encoding threads.
+
+    >>> cache = ScreenshotCache(max_size=10)
+    >>> cache.put('foo', b'12345', (1, 1))
+    >>> cache.get('foo')
+    (b'12345', (1, 1))
+    >>> cache.put('bar', b'123456', (1, 1))
+    >>> cache.get('foo') is None
+    True
+    >>> cache.stats()['entries']
+    1
+    """
+    def __init__(self, max_size=0, disk_path=None,
+                 max_disk_size=defaults.SCREENSHOT_CACHE_DISK_SIZE * 1024 ** 2):
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self.size = 0
+        self.disk_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (data, image_size)
+        self._disk_entries = OrderedDict()  # key -> (path, nbytes, image_size)
+        self._lock = threading.Lock()
+        self.disk_path = None
+        if disk_path is not None and max_size:
+            os.makedirs(disk_path, exist_ok=True)
+            self.disk_path = tempfile.mkdtemp(prefix='screenshots-',
+                                              dir=disk_path)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        """ Return ``(data, image_size)`` tuple or None """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                result = self._entries[key]
+            else:
+                result = self._get_from_disk(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.SCREENSHOT_CACHE_REQUESTS.labels(
+            result="miss" if result is None else "hit").inc()
+        return result
+
+    def put(self, key, data, image_size):
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key)[0])
+            self._entries[key] = (data, image_size)
+            self.size += len(data)
+            while self.size > self.max_size:
+                old_key, (old_data, old_size) = self._entries.popitem(last=False)
+                self.size -= len(old_data)
+                self._put_to_disk(old_key, old_data, old_size)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            while self._disk_entries:
+                self._remove_from_disk(next(iter(self._disk_entries)))
+
+    def close(self):
+        """ Clear the cache and remove its disk folder """
+        self.clear()
+        if self.disk_path is not None:
+            shutil.rmtree(self.disk_path, ignore_errors=True)
+            self.disk_path = None
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "disk_entries": len(self._disk_entries),
+            "disk_size": self.disk_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _get_from_disk(self, key):
+        if key not in self._disk_entries:
+            return None
+        path, nbytes, image_size = self._disk_entries[key]
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            log.msg("Can't read cached screenshot %s: %s" % (path, e))
+            data = None
+        self._remove_from_disk(key)
+        if data is None:
+            return None
+        # move the entry back to memory
+        self._entries[key] = (data, image_size)
+        self.size += len(data)
+        while self.size > self.max_size and len(self._entries) > 1:
+            old_key, (old_data, old_size) = self._entries.popitem(last=False)
+            self.size -= len(old_data)
+            self._put_to_disk(old_key, old_data, old_size)
+        return data, image_size
+
+    def _put_to_disk(self, key, data, image_size):
+        if self.disk_path is None or len(data) > self.max_disk_size:
+            return
+        path = os.path.join(self.disk_path, key)
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            log.msg("Can't write cached screenshot %s: %s" % (path, e))
+            return
+        self._disk_entries[key] = (path, len(data), image_size)
+        self.disk_size += len(data)
+        while self.disk_size > self.max_disk_size:
+            self._remove_from_disk(next(iter(self._disk_entries)))
+
+    def _remove_from_disk(self, key):
+        path, nbytes, _ = self._disk_entries.pop(key)
+        self.disk_size -= nbytes
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+_cache = ScreenshotCache()
+
+
+def get_screenshot_cache():
+    """ Return the global ScreenshotCache """
+    return _cache
+
+
+def setup_screenshot_cache(max_size_mb, disk_path=None):
+    """ Replace the global ScreenshotCache """
+    global _cache
+    _cache.close()
+    _cache = ScreenshotCache(int(max_size_mb * 1024 ** 2), disk_path)
+    if _cache.disk_path is not None:
+        from twisted.internet import reactor
+        reactor.addSystemEventTrigger('after', 'shutdown', _cache.close)
+    log.msg("screenshot cache: %s MB, disk path: %s" % (
+        max_size_mb, _cache.disk_path))
+    return _cache
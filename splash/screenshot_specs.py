@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Specifications of screenshots which are derived from a single rendering
+of a page (see ``splash:screenshots`` and ``images`` argument
+of render.json).
+"""
+from typing import Any, Dict, Optional, Tuple
+
+import attr
+
+from splash import defaults
+from splash.raw_image import RAW_CONTENT_TYPE, RAW_PIXEL_FORMATS
+
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'raw': RAW_CONTENT_TYPE,
+}
+
+
+@attr.s(frozen=True)
+class ScreenshotSpec:
+    """ Parameters of a single screenshot """
+    format = attr.ib(default='png')  # type: str
+    width = attr.ib(default=None)  # type: Optional[int]
+    height = attr.ib(default=None)  # type: Optional[int]
+    region = attr.ib(default=None)  # type: Optional[Tuple[int, int, int, int]]
+    selector = attr.ib(default=None)  # type: Optional[str]
+    pad = attr.ib(default=None)  # type: Optional[Tuple[int, int, int, int]]
+    quality = attr.ib(default=None)  # type: Optional[int]
+    lossless = attr.ib(default=False)  # type: bool
+    method = attr.ib(default=None)  # type: Optional[int]
+    pixel_format = attr.ib(default='RGBA')  # type: str
+    downsample = attr.ib(default=1)  # type: int
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES[self.format]
+
+    @property
+    def is_rgb(self) -> bool:
+        """ True if the image doesn't have an alpha channel """
+        if self.format == 'raw':
+            return self.pixel_format == 'RGB'
+        return self.format != 'png'
+
+    @property
+    def renderer_format(self) -> str:
+        """ Image format for a screenshot renderer """
+        if self.format == 'raw':
+            return 'JPEG' if self.is_rgb else 'PNG'
+        return self.format.upper()
+
+    def encoder_args(self) -> Tuple[str, Dict[str, Any]]:
+        """ Return ``(image_format, options)`` for ``encode_image`` """
+        if self.format == 'png':
+            return 'PNG', {}
+        if self.format == 'jpeg':
+            quality = self.quality
+            if quality is None:
+                quality = defaults.JPEG_QUALITY
+            return 'JPEG', {'quality': quality}
+        if self.format == 'webp':
+            return 'WEBP', {
+                'quality': (defaults.WEBP_QUALITY if self.quality is None
+                            else self.quality),
+                'lossless': self.lossless,
+                'method': (defaults.WEBP_METHOD if self.method is None
+                           else self.method),
+            }
+        return 'RAW', {'pixel_format': self.pixel_format,
+                       'downsample': self.downsample}
+
+    def get_region(self, region):
+        """ Return ``region`` extended by ``pad`` """
+        if region is None or self.pad is None:
+            return region
+        return (region[0] - self.pad[0], region[1] - self.pad[1],
+                region[2] + self.pad[2], region[3] + self.pad[3])
+
+
+def parse_screenshot_spec(data) -> ScreenshotSpec:
+    """
+    Create ScreenshotSpec from a dict, validating the values.
+    ValueError is raised for invalid specs.
+
+    >>> parse_screenshot_spec({'format': 'jpeg', 'width': 320})
+    ScreenshotSpec(format='jpeg', width=320, height=None, region=None, selector=None, pad=None, quality=None, lossless=False, method=None, pixel_format='RGBA', downsample=1)
+    >>> parse_screenshot_spec({'format': 'gif'})
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid image format 'gif': must be png, jpeg, webp or raw
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Image specification must be an object")
+    unknown = set(data) - set(attr.fields_dict(ScreenshotSpec))
+    if unknown:
+        raise ValueError("Unknown image specification keys: %s" %
+                         ", ".join(sorted(map(str, unknown))))
+
+    fmt = data.get('format', 'png')
+    if fmt not in CONTENT_TYPES:
+        raise ValueError("Invalid image format %r: must be png, jpeg, "
+                         "webp or raw" % (fmt,))
+    kwargs = {
+        'format': fmt,
+        'width': _get_int(data, 'width', 1, defaults.MAX_WIDTH),
+        'height': _get_int(data, 'height', 1, defaults.MAX_HEIGTH),
+        'region': _get_rect(data, 'region'),
+        'pad': _get_rect(data, 'pad', allow_number=True),
+        'quality': _get_int(data, 'quality', 0, 100),
+        'method': _get_int(data, 'method', 0, 6),
+        'downsample': _get_int(data, 'downsample', 1,
+                               defaults.MAX_DOWNSAMPLE) or 1,
+        'lossless': bool(data.get('lossless', False)),
+        'pixel_format': data.get('pixel_format', 'RGBA'),
+        'selector': data.get('selector'),
+    }
+    if kwargs['pixel_format'] not in RAW_PIXEL_FORMATS:
+        raise ValueError("Invalid pixel format %r: must be RGBA or RGB" %
+                         (kwargs['pixel_format'],))
+    if kwargs['selector'] is not None:
+        if not isinstance(kwargs['selector'], str):
+            raise ValueError("'selector' must be a string")
+        if kwargs['region'] is not None:
+            raise ValueError("'selector' and 'region' can't be used together")
+    if kwargs['height'] is not None and (kwargs['region'] is not None or
+                                         kwargs['selector'] is not None):
+        raise ValueError("'height' is not supported when 'region' or "
+                         "'selector' is set")
+    return ScreenshotSpec(**kwargs)
+
+
+def _get_int(data, name, min_value, max_value):
+    value = data.get(name)
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError("%r must be an integer" % name)
+    if not min_value <= value <= max_value:
+        raise ValueError("%r must be in %s-%s range" % (
+            name, min_value, max_value))
+    return value
+
+
+def _get_rect(data, name, allow_number=False):
+    """
+    Return a ``(left, top, right, bottom)`` tuple from a list,
+    a Lua-style dict with 1..4 keys, a dict with left/top/right/bottom keys
+    (e.g. ``element:bounds()`` result) or, if ``allow_number`` is True,
+    a single number which is used for all 4 values.
+    """
+    value = data.get(name)
+    if value is None:
+        return None
+    if allow_number and isinstance(value, (int, float)):
+        return (int(value),) * 4
+    try:
+        if isinstance(value, dict):
+            if 'left' in value:
+                value = [value[key] for key in
+                         ('left', 'top', 'right', 'bottom')]
+            else:
+                value = [value[i] for i in range(1, 5)]
+        if len(value) != 4:
+            raise ValueError()
+        return tuple(int(v) for v in value)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("%r must contain 4 numbers "
+                         "{left, top, right, bottom}" % name)
@@ -1,5 +1,6 @@
 import os
 import sys
+import socket
 import optparse
 import resource
 import traceback
@@ -10,7 +11,11 @@ import faulthandler
 from splash import defaults, __version__
 from splash import xvfb
 from splash.qtutils import init_qt_app
-from splash._cmdline_utils import ONOFF, comma_separated_callback
+from splash._cmdline_utils import (
+    ONOFF,
+    comma_separated_callback,
+    client_weights_callback,
+)
 
 
 
@@ -28,7 +33,10 @@ def parse_opts(jupyter=False, argv=None):
     op = optparse.OptionParser()
     op.add_option("-f", "--logfile", help="log file")
     op.add_option("-m", "--maxrss", type=float, default=0,
-        help="exit if max RSS reaches this value (in MB or ratio of physical mem) (default: %default)")
+        help="exit if RSS reaches this value (in MB or ratio of physical mem) (default: %default)")
+    op.add_option("--maxrss-check-interval", type=float,
+        default=defaults.MAXRSS_CHECK_INTERVAL,
+        help="how often to check RSS for --maxrss, in seconds (default: %default)")
     op.add_option("--proxy-profiles-path",
         help="path to a folder with proxy profiles")
     op.add_option("--js-profiles-path",
@@ -48,6 +56,11 @@ def parse_opts(jupyter=False, argv=None):
         help="comma-separated list of allowed URI schemes (default: %default)")
     op.add_option("--filters-path",
         help="path to a folder with network request filters")
+    op.add_option("--reload-interval", type=float,
+        default=defaults.RELOAD_INTERVAL,
+        help="how often to check --filters-path for changed filters, "
+             "in seconds; 0 means filters are reloaded only on "
+             "SIGUSR2 (default: %default)")
     op.add_option('--xvfb-screen-size',
         help="screen size for xvfb (default: %default)", default=defaults.VIEWPORT_SIZE)
     op.add_option("--disable-private-mode", action="store_true", default=not defaults.PRIVATE_MODE,
@@ -58,6 +71,27 @@ def parse_opts(jupyter=False, argv=None):
         help="disable Lua sandbox")
     op.add_option("--disable-browser-caches", action="store_true", default=False,
         help="disables in-memory and network caches used by webkit")
+    op.add_option("--image-encoding-threads", type="int",
+        default=defaults.IMAGE_ENCODING_THREADS,
+        help="number of threads used to compress screenshots, so that "
+             "other renders are not blocked while a large image is "
+             "encoded; 0 means images are encoded in the main "
+             "thread (default: %default)")
+    op.add_option("--screenshot-cache-size", type="float", default=0,
+        help="size of in-memory cache of screenshots, in MB; a screenshot "
+             "is taken from the cache when the same page (URL, DOM, "
+             "viewport and scroll position) is rendered with the same "
+             "image parameters. 0 disables the cache (default: %default)")
+    op.add_option("--screenshot-cache-path",
+        help="folder to keep screenshots evicted from in-memory cache "
+             "(up to %d MB)" % defaults.SCREENSHOT_CACHE_DISK_SIZE)
+    op.add_option("--http-cache-size", type="float",
+        default=defaults.HTTP_CACHE_SIZE,
+        help="size of on-disk HTTP cache shared between renders, in MB; "
+             "responses are cached according to their HTTP caching "
+             "headers. 0 disables the cache (default: %default)")
+    op.add_option("--http-cache-path",
+        help="folder for HTTP cache files (default: a temporary folder)")
     op.add_option("--browser-engines",
         default=defaults.BROWSER_ENGINES_ENABLED,
         action='callback',
@@ -96,8 +130,54 @@ def parse_opts(jupyter=False, argv=None):
             help="binded ip listen to (default: %default)")
         op.add_option("-s", "--slots", type="int", default=defaults.SLOTS,
             help="number of render slots (default: %default)")
+        op.add_option("-w", "--workers", type="int", default=defaults.WORKERS,
+            help="number of Splash processes sharing the listening port; "
+                 "each process has its own render slots. When greater "
+                 "than 1, a supervisor process restarts workers which crash "
+                 "or exceed --maxrss (default: %default)")
+        # internal options used by a supervisor to start workers
+        op.add_option("--listen-fd", type="int", help=optparse.SUPPRESS_HELP)
+        op.add_option("--worker-ready-fd", type="int",
+                      help=optparse.SUPPRESS_HELP)
         op.add_option("--max-timeout", type="float", default=defaults.MAX_TIMEOUT,
             help="maximum allowed value for timeout (default: %default)")
+        op.add_option("--drain-timeout", type="float",
+            default=defaults.DRAIN_TIMEOUT,
+            help="when --maxrss is exceeded, stop accepting new requests and "
+                 "wait up to this many seconds for active and queued "
+                 "renders to finish before exiting (default: %default)")
+        op.add_option("--render-rss-threshold", type="float", default=0,
+            help="when a single render increases RSS by more than this "
+                 "value (in MB), don't reuse its tab and apply "
+                 "--render-rss-action; 0 means no limit (default: %default)")
+        op.add_option("--render-rss-action", type="choice",
+            choices=["gc", "restart"], default=defaults.RENDER_RSS_ACTION,
+            help="what to do when --render-rss-threshold is exceeded: "
+                 "'gc' clears caches and runs garbage collection, "
+                 "'restart' drains and restarts the process, like "
+                 "--maxrss does (default: %default)")
+        op.add_option("--max-queue-size", type="int",
+            default=defaults.MAX_QUEUE_SIZE,
+            help="reject requests with HTTP 503 when there are this many "
+                 "requests in the queue; 0 means no limit (default: %default)")
+        op.add_option("--max-queue-wait", type="float",
+            default=defaults.MAX_QUEUE_WAIT,
+            help="reject requests with HTTP 503 when expected time "
+                 "in the queue exceeds this value (in seconds); "
+                 "0 means no limit (default: %default)")
+        op.add_option("--client-weights",
+            default={},
+            action='callback',
+            type='string',
+            callback=client_weights_callback,
+            help="comma-separated list of client_id:weight pairs; requests "
+                 "of clients with larger weights get a larger share of "
+                 "render slots when there is a queue (default weight is 1). "
+                 "Example: crawler1:3,crawler2:0.5")
+        op.add_option("--reuse-tabs", action="store_true", default=False,
+            help="reset and reuse browser tabs between renders instead of "
+                 "creating a new tab for each request (webkit render "
+                 "endpoints only)")
         op.add_option("--disable-ui", action="store_true", default=False,
             help="disable web UI")
         op.add_option("--disable-lua", action="store_true", default=False,
@@ -116,7 +196,17 @@ def parse_opts(jupyter=False, argv=None):
         opts.disable_lua = False
         opts.port = None
         opts.slots = None
+        opts.workers = 1
+        opts.listen_fd = None
+        opts.worker_ready_fd = None
         opts.max_timeout = None
+        opts.drain_timeout = 0
+        opts.render_rss_threshold = 0
+        opts.render_rss_action = defaults.RENDER_RSS_ACTION
+        opts.reuse_tabs = False
+        opts.client_weights = {}
+        opts.max_queue_size = None
+        opts.max_queue_wait = None
         opts.argument_cache_max_entries = None
 
     return opts, args
@@ -197,6 +287,13 @@ def splash_server(portnum, ip, slots, network_manager_factory, max_timeout,
                   disable_browser_caches=False,
                   browser_engines_enabled=(),
                   dont_log_args=None,
+                  reuse_tabs=False,
+                  client_weights=None,
+                  max_queue_size=None,
+                  max_queue_wait=None,
+                  render_rss_threshold=0,
+                  render_rss_action=defaults.RENDER_RSS_ACTION,
+                  listen_fd=None,
                   verbosity=None):
     from twisted.internet import reactor
     from twisted.web.server import Site
@@ -211,6 +308,11 @@ def splash_server(portnum, ip, slots, network_manager_factory, max_timeout,
     log.msg("verbosity={}, slots={}, argument_cache_max_entries={}, max-timeout={}".format(
         verbosity, slots, argument_cache_max_entries, max_timeout
     ))
+    log.msg("tab reuse: %s, max-queue-size=%s, max-queue-wait=%s" % (
+        ONOFF[reuse_tabs], max_queue_size, max_queue_wait))
+    if render_rss_threshold:
+        log.msg("render-rss-threshold=%s MB, render-rss-action=%s" % (
+            render_rss_threshold, render_rss_action))
 
     pool = RenderPool(
         slots=slots,
@@ -218,6 +320,12 @@ def splash_server(portnum, ip, slots, network_manager_factory, max_timeout,
         splash_proxy_factory_cls=splash_proxy_factory_cls,
         js_profiles_path=js_profiles_path,
         verbosity=verbosity,
+        reuse_tabs=reuse_tabs,
+        client_weights=client_weights,
+        max_queue_size=max_queue_size or 0,
+        max_queue_wait=max_queue_wait or 0,
+        render_rss_threshold=render_rss_threshold or 0,
+        render_rss_action=render_rss_action,
     )
 
     if not lua.is_supported() and lua_enabled:
@@ -248,36 +356,156 @@ def splash_server(portnum, ip, slots, network_manager_factory, max_timeout,
         dont_log_args=dont_log_args,
     )
     factory = Site(root)
-    reactor.listenTCP(portnum, factory, interface=ip)
-    log.msg("Server listening on http://%s:%s" % (ip, portnum))
+    if listen_fd is None:
+        port = reactor.listenTCP(portnum, factory, interface=ip)
+        log.msg("Server listening on http://%s:%s" % (ip, portnum))
+    else:
+        port = _adopt_listening_socket(listen_fd, factory)
+        log.msg("Worker (pid %d) listening on http://%s:%s" % (
+            os.getpid(), ip, portnum))
+    return pool, port
+
+
+def _adopt_listening_socket(fd, factory):
+    """ Accept connections from a socket shared by a supervisor """
+    from twisted.internet import reactor
+    sock = socket.socket(fileno=fd)
+    family = sock.family
+    sock.detach()
+    port = reactor.adoptPort(fd, family, factory)
+    os.close(fd)  # adoptPort uses a duplicate
+    return port
+
+
+def stop_reactor():
+    from twisted.internet import reactor
+    from twisted.python import log
+
+    # XXX: for some reason twisted qt5 reactor can stop without
+    # finishing the Python process. This is a hack to exit anyways.
+    def force_shutdown():
+        log.msg("Reactor didn't stop cleanly, doing unclean shutdown.")
+        os._exit(0)
+    reactor.callLater(2.0, force_shutdown)
+
+    reactor.stop()
+
 
+def drain_and_stop(pool, port, timeout, stop_listening=False):
+    """
+    Stop accepting new requests, wait up to ``timeout`` seconds for
+    active and queued renders to finish, then stop the reactor.
+    When ``stop_listening`` is False the port is kept open, so that
+    load balancers can see the server is draining (/_ping returns 503).
+    """
+    from twisted.internet import reactor
+    from twisted.python import log
+
+    if pool.draining:
+        return
+    log.msg("Draining: %d active renders, %d queued; waiting up to %ds" % (
+        len(pool.active), len(pool.queue), timeout))
+    if stop_listening:
+        port.stopListening()
+
+    def stop(result):
+        if pool.is_idle():
+            log.msg("All renders are finished, shutting down...")
+        else:
+            log.msg("Drain timeout exceeded: %d active renders, %d queued; "
+                    "shutting down..." % (len(pool.active), len(pool.queue)))
+        stop_reactor()
+
+    d = pool.drain()
+    d.addTimeout(timeout, reactor)
+    d.addBoth(stop)
 
-def monitor_maxrss(maxrss):
-    from twisted.internet import reactor, task
+
+def monitor_maxrss(maxrss, check_interval=defaults.MAXRSS_CHECK_INTERVAL,
+                   on_exceeded=stop_reactor):
+    from twisted.internet import task
     from twisted.python import log
-    from splash.utils import get_ru_maxrss, get_total_phymem
+    from splash.utils import get_rss, get_total_phymem
 
     # Support maxrss as a ratio of total physical memory
     if 0.0 < maxrss < 1.0:
         maxrss = get_total_phymem() * maxrss / (1024 ** 2)
 
     def check_maxrss():
-        if get_ru_maxrss() > maxrss * (1024 ** 2):
-            log.msg("maxrss exceeded %d MB, shutting down..." % maxrss)
-
-            # XXX: for some reason twisted qt5 reactor can stop without
-            # finishing the Python process. This is a hack to exit anyways.
-            def force_shutdown():
-                log.msg("Reactor didn't stop cleanly, doing unclean shutdown.")
-                os._exit(0)
-            reactor.callLater(2.0, force_shutdown)
-
-            reactor.stop()
+        rss = get_rss()
+        if rss > maxrss * (1024 ** 2):
+            log.msg("RSS %d MB exceeded maxrss %d MB, shutting down..." % (
+                rss / (1024 ** 2), maxrss))
+            t.stop()
+            on_exceeded()
 
     if maxrss:
         log.msg("maxrss limit: %d MB" % maxrss)
         t = task.LoopingCall(check_maxrss)
-        t.start(60, now=False)
+        t.start(check_interval, now=False)
+
+
+def install_sigterm_handler(shutdown):
+    from twisted.internet import reactor
+    from twisted.python import log
+
+    def handler(signum, frame):
+        log.msg("SIGTERM received")
+        reactor.callFromThread(shutdown)
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+def reload_filters(adblock_rules):
+    """
+    Reload request filters if their files are changed. Files are parsed
+    in a thread; on errors old filters are kept. Renders in progress
+    are not interrupted. Return a Deferred.
+    """
+    from twisted.internet import defer
+    from twisted.python import log
+
+    def on_reloaded(reloaded):
+        if reloaded:
+            log.msg("Request filters are reloaded: %s" % (
+                ", ".join(sorted(adblock_rules.filters)) or "no filters"))
+
+    def on_error(failure):
+        log.msg("Request filters are not reloaded, old filters are "
+                "used: %s" % failure.value)
+
+    if adblock_rules is None:
+        return defer.succeed(None)
+    d = defer.maybeDeferred(adblock_rules.reload)
+    d.addCallbacks(on_reloaded, on_error)
+    return d
+
+
+def reload_profiles(adblock_rules):
+    """ Reload request filters and forget cached proxy and JS profiles """
+    from splash.profiles import profile_cache
+    profile_cache.clear()
+    reload_filters(adblock_rules)
+
+
+def install_reload_handler(adblock_rules):
+    from twisted.internet import reactor
+    from twisted.python import log
+
+    def handler(signum, frame):
+        log.msg("SIGUSR2 received, reloading filters and profiles")
+        reactor.callFromThread(reload_profiles, adblock_rules)
+
+    signal.signal(signal.SIGUSR2, handler)
+
+
+def monitor_filters(adblock_rules, reload_interval):
+    """ Check request filters for changes every ``reload_interval`` seconds """
+    from twisted.internet import task
+
+    if adblock_rules is not None and reload_interval:
+        t = task.LoopingCall(reload_filters, adblock_rules)
+        t.start(reload_interval, now=False)
 
 
 def default_splash_server(portnum, ip, max_timeout, *, slots=None,
@@ -297,6 +525,18 @@ def default_splash_server(portnum, ip, max_timeout, *, slots=None,
                           disable_browser_caches=False,
                           browser_engines_enabled=(),
                           dont_log_args=None,
+                          reuse_tabs=False,
+                          client_weights=None,
+                          max_queue_size=None,
+                          max_queue_wait=None,
+                          render_rss_threshold=0,
+                          render_rss_action=defaults.RENDER_RSS_ACTION,
+                          listen_fd=None,
+                          image_encoding_threads=0,
+                          screenshot_cache_size=0,
+                          screenshot_cache_path=None,
+                          http_cache_size=0,
+                          http_cache_path=None,
                           ):
     from splash import network_manager
     network_manager_factory = network_manager.NetworkManagerFactory(
@@ -304,11 +544,19 @@ def default_splash_server(portnum, ip, max_timeout, *, slots=None,
         verbosity=verbosity,
         allowed_schemes=allowed_schemes,
         disable_browser_caches=disable_browser_caches,
+        http_cache_size=http_cache_size,
+        http_cache_path=http_cache_path,
     )
     splash_proxy_factory_cls = _default_proxy_factory(proxy_profiles_path)
     js_profiles_path = _check_js_profiles_path(js_profiles_path)
     _set_global_render_settings(js_disable_cross_domain_access, private_mode,
                                 disable_browser_caches)
+    if image_encoding_threads:
+        from splash.image_encoding import setup_encoder
+        setup_encoder(image_encoding_threads)
+    if screenshot_cache_size:
+        from splash.screenshot_cache import setup_screenshot_cache
+        setup_screenshot_cache(screenshot_cache_size, screenshot_cache_path)
     return server_factory(
         portnum=portnum,
         ip=ip,
@@ -328,6 +576,13 @@ def default_splash_server(portnum, ip, max_timeout, *, slots=None,
         argument_cache_max_entries=argument_cache_max_entries,
         browser_engines_enabled=browser_engines_enabled,
         dont_log_args=dont_log_args,
+        reuse_tabs=reuse_tabs,
+        client_weights=client_weights,
+        max_queue_size=max_queue_size,
+        max_queue_wait=max_queue_wait,
+        render_rss_threshold=render_rss_threshold,
+        render_rss_action=render_rss_action,
+        listen_fd=listen_fd,
     )
 
 
@@ -399,16 +654,22 @@ def main(jupyter=False, argv=None, server_factory=splash_server):
 
     start_logging(opts)
 
+    if opts.workers > 1:
+        from splash.supervisor import run_supervisor
+        run_supervisor(opts, worker_args=argv[1:])
+        return
+
     with xvfb.autostart(opts.disable_xvfb, opts.xvfb_screen_size) as x:
         xvfb.log_options(x)
         install_qtreactor(opts.verbosity >= 5)
         log_splash_version()
         bump_nofile_limit()
-        monitor_maxrss(opts.maxrss)
+        if jupyter:
+            monitor_maxrss(opts.maxrss, opts.maxrss_check_interval)
 
         ipnum = opts.ip if hasattr(opts, 'ip') else '0.0.0.0'
 
-        default_splash_server(
+        server = default_splash_server(
             portnum=opts.port,
             ip=ipnum,
             slots=opts.slots,
@@ -431,12 +692,44 @@ def main(jupyter=False, argv=None, server_factory=splash_server):
             disable_browser_caches=opts.disable_browser_caches,
             browser_engines_enabled=opts.browser_engines,
             dont_log_args=set(opts.dont_log_args),
+            reuse_tabs=opts.reuse_tabs,
+            client_weights=opts.client_weights,
+            max_queue_size=opts.max_queue_size,
+            max_queue_wait=opts.max_queue_wait,
+            render_rss_threshold=opts.render_rss_threshold,
+            render_rss_action=opts.render_rss_action,
+            listen_fd=opts.listen_fd,
+            image_encoding_threads=opts.image_encoding_threads,
+            screenshot_cache_size=opts.screenshot_cache_size,
+            screenshot_cache_path=opts.screenshot_cache_path,
+            http_cache_size=opts.http_cache_size,
+            http_cache_path=opts.http_cache_path,
         )
         signal.signal(signal.SIGUSR1, lambda s, f: traceback.print_stack(f))
 
         if not jupyter:
             from twisted.internet import reactor
+            shutdown = stop_reactor
+            if server is not None:
+                pool, port = server
+                # in --workers mode other workers take new connections
+                shutdown = functools.partial(
+                    drain_and_stop, pool, port, opts.drain_timeout,
+                    stop_listening=opts.listen_fd is not None)
+                pool.shutdown_callback = shutdown
+            monitor_maxrss(opts.maxrss, opts.maxrss_check_interval,
+                           on_exceeded=shutdown)
+            if server is not None:
+                adblock_rules = pool.network_manager_factory.adblock_rules
+                reactor.callWhenRunning(install_reload_handler, adblock_rules)
+                monitor_filters(adblock_rules, opts.reload_interval)
+            if opts.listen_fd is not None:
+                # supervisor stops workers with SIGTERM
+                reactor.callWhenRunning(install_sigterm_handler, shutdown)
             reactor.callWhenRunning(splash_started, opts, sys.stderr)
+            if opts.worker_ready_fd is not None:
+                from splash.supervisor import notify_ready
+                reactor.callWhenRunning(notify_ready, opts.worker_ready_fd)
             reactor.run()
 
 
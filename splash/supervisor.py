@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+"""
+Supervisor for ``splash --workers N`` mode.
+
+Supervisor binds the listening socket and starts N Splash processes
+("workers") which accept connections from this shared socket, so that
+a single Splash server can use several CPU cores. Supervisor doesn't
+start Qt and doesn't handle requests itself; it only starts workers,
+restarts them when they crash or use too much memory, and stops them.
+
+Workers are restarted one by one, and a new worker is started
+(and becomes ready to accept connections) before an old one is stopped,
+so the capacity of the server never drops to zero during restarts.
+
+Signals:
+
+* SIGTERM, SIGINT - stop all workers and exit;
+* SIGHUP - restart all workers one by one;
+* SIGUSR2 - ask workers to reload request filters and profiles,
+  without a restart.
+"""
+import os
+import sys
+import time
+import select
+import signal
+import socket
+import subprocess
+from collections import deque
+
+import attr
+import psutil
+from twisted.python import log
+
+from splash.utils import get_total_phymem
+
+
+@attr.s
+class Worker:
+    """ A Splash worker process """
+    num = attr.ib()  # type: int
+    proc = attr.ib()  # type: subprocess.Popen
+    ready_fd = attr.ib()  # type: int
+    started_at = attr.ib(factory=time.time)  # type: float
+    ready = attr.ib(default=False)  # type: bool
+    stop_deadline = attr.ib(default=None)
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    @property
+    def uptime(self):
+        return time.time() - self.started_at
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def get_rss(self):
+        """
+        Return current RSS (in bytes) of the worker process
+        and its child processes (e.g. QtWebEngineProcess).
+        """
+        try:
+            proc = psutil.Process(self.pid)
+            procs = [proc] + proc.children(recursive=True)
+        except psutil.Error:
+            return 0
+        rss = 0
+        for p in procs:
+            try:
+                rss += p.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def close_ready_fd(self):
+        if self.ready_fd is not None:
+            os.close(self.ready_fd)
+            self.ready_fd = None
+
+    def stop(self, timeout):
+        """ Ask the worker to exit; it is killed after ``timeout`` """
+        self.close_ready_fd()
+        self.stop_deadline = time.time() + timeout
+        if self.is_alive():
+            self.proc.terminate()
+
+
+class Supervisor:
+    """
+    Start ``num_workers`` Splash processes sharing a listening socket
+    and keep them running.
+    """
+    # how often (in seconds) to check workers
+    check_interval = 0.5
+
+    # how long (in seconds) to wait for a worker to exit before killing it;
+    # workers finish active renders before exiting
+    stop_timeout = 30.0
+
+    # if a worker exits faster than this (in seconds) after start, it is
+    # respawned with an increasing delay, up to max_respawn_delay seconds
+    min_uptime = 10.0
+    max_respawn_delay = 30.0
+
+    def __init__(self, num_workers, worker_args, ip, port, maxrss=0,
+                 logfile=None, stop_timeout=None):
+        self.num_workers = num_workers
+        self.worker_args = list(worker_args)
+        self.ip = ip
+        self.port = port
+        self.maxrss = maxrss  # MB per worker
+        self.logfile = logfile
+        if stop_timeout is not None:
+            self.stop_timeout = stop_timeout
+
+        self.sock = None
+        self.workers = {}  # num -> Worker which handles requests
+        self.replacements = {}  # num -> Worker which is starting to replace
+        self.retiring = []  # workers which are being stopped
+        self.restart_queue = deque()  # nums of workers to restart
+        self.respawn_at = {}  # num -> time to start a crashed worker
+        self.respawn_delays = {}  # num -> current respawn delay
+        self.restart_at = {}  # num -> time to retry a failed replacement
+        self._stopping = False
+        self._restart_requested = False
+        self._reload_requested = False
+
+    def run(self):
+        """ Start workers and supervise them until a stop signal """
+        self.sock = self._bind()
+        log.msg("Supervisor (pid %d) listening on http://%s:%s, "
+                "workers: %d, maxrss per worker: %s" % (
+                    os.getpid(), self.ip, self.port, self.num_workers,
+                    "%d MB" % self.maxrss if self.maxrss else "unlimited"))
+        self._install_signal_handlers()
+        for num in range(self.num_workers):
+            self.workers[num] = self._spawn(num)
+
+        last_rss_check = time.time()
+        while not self._stopping:
+            if self._restart_requested:
+                self._restart_requested = False
+                self._schedule_restart_all()
+            if self._reload_requested:
+                self._reload_requested = False
+                self._reload_all()
+            self._wait_ready(self.check_interval)
+            self._reap()
+            self._respawn_crashed()
+            self._start_next_restart()
+            if self.maxrss and time.time() - last_rss_check >= 1.0:
+                last_rss_check = time.time()
+                self._check_maxrss()
+
+        self._stop_all()
+        self.sock.close()
+        log.msg("Supervisor stopped")
+
+    def _bind(self):
+        family, type_, proto, _, address = socket.getaddrinfo(
+            self.ip, self.port, type=socket.SOCK_STREAM,
+            flags=socket.AI_PASSIVE)[0]
+        sock = socket.socket(family, type_, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(socket.SOMAXCONN)
+        sock.set_inheritable(True)
+        return sock
+
+    def _install_signal_handlers(self):
+        def stop(signum, frame):
+            log.msg("Supervisor received signal %d, stopping workers" % signum)
+            self._stopping = True
+
+        def restart(signum, frame):
+            log.msg("Supervisor received SIGHUP, restarting workers")
+            self._restart_requested = True
+
+        def reload(signum, frame):
+            log.msg("Supervisor received SIGUSR2, reloading workers")
+            self._reload_requested = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, restart)
+        signal.signal(signal.SIGUSR2, reload)
+
+    def _spawn(self, num):
+        ready_r, ready_w = os.pipe()
+        listen_fd = self.sock.fileno()
+        args = self._get_worker_command(num, listen_fd, ready_w)
+        try:
+            proc = subprocess.Popen(args, pass_fds=(listen_fd, ready_w))
+        except Exception:
+            os.close(ready_r)
+            raise
+        finally:
+            os.close(ready_w)
+        log.msg("Started worker #%d (pid %d)" % (num, proc.pid))
+        return Worker(num=num, proc=proc, ready_fd=ready_r)
+
+    def _get_worker_command(self, num, listen_fd, ready_fd):
+        # Options passed later override the original ones.
+        args = [sys.executable, '-m', 'splash.server'] + self.worker_args + [
+            '--workers', '1',
+            '--listen-fd', str(listen_fd),
+            '--worker-ready-fd', str(ready_fd),
+        ]
+        if self.maxrss:
+            # memory limit is handled by supervisor
+            args += ['--maxrss', '0']
+        if self.logfile:
+            args += ['--logfile', '%s.%d' % (self.logfile, num)]
+        return args
+
+    def _wait_ready(self, timeout):
+        """ Wait for readiness notifications from starting workers """
+        starting = {
+            w.ready_fd: w
+            for w in list(self.workers.values()) + list(self.replacements.values())
+            if not w.ready and w.ready_fd is not None
+        }
+        if not starting:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select(list(starting), [], [], timeout)
+        for fd in readable:
+            worker = starting[fd]
+            data = os.read(fd, 1)
+            worker.close_ready_fd()
+            if not data:
+                # the worker exited before it became ready; see _reap
+                continue
+            worker.ready = True
+            log.msg("Worker #%d (pid %d) is ready" % (worker.num, worker.pid))
+            if self.replacements.get(worker.num) is worker:
+                self._replace(worker)
+
+    def _replace(self, new_worker):
+        num = new_worker.num
+        del self.replacements[num]
+        old_worker = self.workers.get(num)
+        self.workers[num] = new_worker
+        self.respawn_delays.pop(num, None)
+        if old_worker is not None:
+            log.msg("Stopping worker #%d (pid %d)" % (num, old_worker.pid))
+            old_worker.stop(self.stop_timeout)
+            self.retiring.append(old_worker)
+
+    def _reap(self):
+        for num, worker in list(self.workers.items()):
+            if worker.is_alive():
+                continue
+            log.msg("Worker #%d (pid %d) exited with code %s" % (
+                num, worker.pid, worker.proc.returncode))
+            worker.close_ready_fd()
+            del self.workers[num]
+            # a respawned worker doesn't need a pending restart
+            self.restart_at.pop(num, None)
+            if num in self.replacements:
+                # replacement is already starting, it'll take this place
+                continue
+            self._schedule_respawn(worker)
+
+        for num, worker in list(self.replacements.items()):
+            if worker.is_alive():
+                continue
+            log.msg("Worker #%d (pid %d) exited with code %s before "
+                    "it became ready" % (num, worker.pid, worker.proc.returncode))
+            worker.close_ready_fd()
+            del self.replacements[num]
+            if num in self.workers:
+                # keep the old worker, try to replace it again later
+                self._schedule_restart_retry(num)
+            else:
+                self._schedule_respawn(worker)
+
+        for worker in list(self.retiring):
+            if not worker.is_alive():
+                self.retiring.remove(worker)
+                log.msg("Worker #%d (pid %d) stopped" % (worker.num, worker.pid))
+            elif time.time() > worker.stop_deadline:
+                log.msg("Worker #%d (pid %d) didn't stop in %ds, killing it" % (
+                    worker.num, worker.pid, self.stop_timeout))
+                worker.proc.kill()
+                worker.stop_deadline = float('inf')
+
+    def _schedule_respawn(self, worker):
+        num = worker.num
+        if worker.uptime >= self.min_uptime:
+            delay = 0
+        else:
+            delay = min(self.respawn_delays.get(num, 0.5) * 2,
+                        self.max_respawn_delay)
+        self.respawn_delays[num] = delay
+        if delay:
+            log.msg("Worker #%d exited too fast, respawning "
+                    "in %0.1fs" % (num, delay))
+        self.respawn_at[num] = time.time() + delay
+
+    def _schedule_restart_retry(self, num):
+        delay = min(self.respawn_delays.get(num, 0.5) * 2,
+                    self.max_respawn_delay)
+        self.respawn_delays[num] = delay
+        log.msg("Retrying to restart worker #%d in %0.1fs" % (num, delay))
+        self.restart_at[num] = time.time() + delay
+
+    def _respawn_crashed(self):
+        now = time.time()
+        for num, respawn_at in list(self.respawn_at.items()):
+            if respawn_at <= now:
+                del self.respawn_at[num]
+                self.workers[num] = self._spawn(num)
+
+    def _schedule_restart_all(self):
+        for num in range(self.num_workers):
+            if num not in self.restart_queue and num not in self.restart_at:
+                self.restart_queue.append(num)
+
+    def _start_next_restart(self):
+        # Only one worker is restarted at a time, and only when other
+        # workers are ready, to keep as much capacity as possible.
+        now = time.time()
+        for num, restart_at in list(self.restart_at.items()):
+            if restart_at <= now:
+                del self.restart_at[num]
+                self.restart_queue.append(num)
+        if self.replacements:
+            return
+        if not all(w.ready for w in self.workers.values()):
+            return
+        while self.restart_queue:
+            num = self.restart_queue.popleft()
+            if num in self.workers:
+                self.replacements[num] = self._spawn(num)
+                return
+
+    def _reload_all(self):
+        # Workers which are not ready yet may have no SIGUSR2 handler,
+        # but they read filters and profiles after the change anyway.
+        for worker in self.workers.values():
+            if worker.ready and worker.is_alive():
+                worker.proc.send_signal(signal.SIGUSR2)
+
+    def _check_maxrss(self):
+        for num, worker in self.workers.items():
+            if not worker.ready or num in self.restart_queue:
+                continue
+            if num in self.restart_at:
+                continue
+            if num in self.replacements:
+                continue
+            rss = worker.get_rss()
+            if rss > self.maxrss * (1024 ** 2):
+                log.msg("Worker #%d (pid %d) RSS %d MB exceeded maxrss %d MB, "
+                        "restarting it" % (num, worker.pid,
+                                           rss / (1024 ** 2), self.maxrss))
+                self.restart_queue.append(num)
+
+    def _stop_all(self):
+        workers = (list(self.workers.values()) +
+                   list(self.replacements.values()))
+        for worker in workers:
+            worker.stop(self.stop_timeout)
+        workers += self.retiring
+        while any(w.is_alive() for w in workers):
+            for worker in workers:
+                if worker.is_alive() and time.time() > worker.stop_deadline:
+                    log.msg("Worker #%d (pid %d) didn't stop, killing it" % (
+                        worker.num, worker.pid))
+                    worker.proc.kill()
+                    worker.stop_deadline = float('inf')
+            time.sleep(0.1)
+        for worker in workers:
+            worker.proc.wait()
+
+
+def get_worker_maxrss(maxrss, num_workers):
+    """
+    Return a memory limit for a single worker (in MB).
+    ``maxrss`` is either a limit in MB (applied to each worker) or a ratio
+    of physical memory (divided between workers).
+    """
+    if 0.0 < maxrss < 1.0:
+        return get_total_phymem() * maxrss / num_workers / (1024 ** 2)
+    return maxrss
+
+
+def run_supervisor(opts, worker_args):
+    """
+    Run Splash in ``--workers`` mode. ``worker_args`` are command-line
+    arguments (without a program name) which are passed to workers.
+    """
+    supervisor = Supervisor(
+        num_workers=opts.workers,
+        worker_args=worker_args,
+        ip=opts.ip,
+        port=opts.port,
+        maxrss=get_worker_maxrss(opts.maxrss, opts.workers),
+        logfile=opts.logfile,
+        # give workers some time to exit after the drain
+        stop_timeout=opts.drain_timeout + 10,
+    )
+    supervisor.run()
+
+
+def notify_ready(ready_fd):
+    """ Tell supervisor that the worker is ready to accept connections """
+    os.write(ready_fd, b"1")
+    os.close(ready_fd)
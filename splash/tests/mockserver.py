@@ -960,16 +960,22 @@ class SubresourcesWithCaching(Resource):
     def getChild(self, name, request):
         if name == b"img.gif":
             return self.Image()
+        if name == b"private.gif":
+            return self.PrivateImage()
         return self
 
     class Image(Resource):
+        cache_control = b"public, max-age=999999, s-maxage=999999"
 
         @use_chunked_encoding
         def render_GET(self, request):
             request.setHeader(b"Content-Type", b"image/gif")
-            request.setHeader(b"Cache-Control", b"public, max-age=999999, s-maxage=999999")
+            request.setHeader(b"Cache-Control", self.cache_control)
             return base64.decodebytes(b'R0lGODlhAQABAAD/ACwAAAAAAQABAAACADs=')
 
+    class PrivateImage(Image):
+        cache_control = b"private, max-age=999999"
+
     @use_chunked_encoding
     def render_GET(self, request):
         return ("""<html>
@@ -1030,6 +1036,56 @@ class RedirectAndHashtagsResource(Resource):
             """
 
 
+class SyntheticPage(Resource):
+    """
+    A deterministic page of a given height with text, gradients and
+    colored blocks, for screenshot benchmarks. Arguments: ``height``
+    (in pixels, default 2000) and ``seed`` (default 0).
+    """
+    isLeaf = True
+
+    WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+             "eiusmod tempor incididunt ut labore et dolore magna").split()
+
+    def render_GET(self, request):
+        height = getarg(request, "height", 2000, type=int)
+        rng = random.Random(getarg(request, "seed", 0, type=int))
+        blocks = []
+        top = 0
+        while top < height:
+            block_height = min(rng.randint(80, 400), height - top)
+            color1, color2 = ["#%06x" % rng.randint(0, 0xFFFFFF)
+                              for _ in range(2)]
+            text = " ".join(rng.choice(self.WORDS)
+                            for _ in range(rng.randint(20, 200)))
+            blocks.append(
+                '<div style="height:%dpx; overflow:hidden; '
+                'background:-webkit-linear-gradient(%ddeg, %s, %s)">'
+                '<p style="width:%d%%; font-size:%dpx">%s</p></div>' % (
+                    block_height, rng.randint(0, 359), color1, color2,
+                    rng.randint(30, 100), rng.randint(10, 24), text))
+            top += block_height
+        return ("""<html>
+<style>* { margin: 0px; padding: 0px }</style>
+<body>%s</body>
+</html>""" % "\n".join(blocks)).encode('utf-8')
+
+
+class CpuHeavyJsPage(Resource):
+    """ A page which runs a busy JS loop for ``ms`` milliseconds on load """
+    isLeaf = True
+
+    def render_GET(self, request):
+        ms = getarg(request, "ms", 200, type=int)
+        return ("""<html><body>
+<script>
+var start = Date.now(), n = 0;
+while (Date.now() - start < %d) { n += Math.sqrt(n + 1); }
+document.write("computed: " + n);
+</script>
+</body></html>""" % ms).encode('utf-8')
+
+
 class HttpVersionResource(Resource):
     """ Endpoint for checking if a client used http2 or not. """
     def render(self, request):
@@ -1160,6 +1216,8 @@ class Root(Resource):
 
         self.putChild(b"do-post", XHRPostPage())
         self.putChild(b"http-version", HttpVersionResource())
+        self.putChild(b"synthetic", SyntheticPage())
+        self.putChild(b"cpu-heavy-js", CpuHeavyJsPage())
 
         self.putChild(b"", Index(self.children))
 
@@ -1,110 +1,345 @@
-import sys, random, optparse, time, json
-from itertools import islice
-from threading import Thread
-from collections import Counter
-from queue import Queue
+"""
+Open-loop load generator for Splash.
+
+Requests are sent at a fixed average rate (``-r``, Poisson or uniform
+arrivals) regardless of how fast Splash responds, so an overloaded server
+shows growing latencies and queue times instead of a lower request rate.
+Requests are drawn from a weighted mix of mock server scenarios::
+
+    python -m splash.tests.mockserver &
+    python -m splash.tests.stress -r 20 -d 60 -m html=5,large-png=1,slow=1
+
+or start Splash with the capacity settings to validate, and a mock
+server, automatically::
+
+    python -m splash.tests.stress --start --splash-args="--slots 10 --maxrss 3000"
+
+The report includes latency percentiles, throughput and status codes or
+errors per scenario, queue wait times and RSS over time (scraped from
+Splash /metrics endpoint). Use ``--json`` to save it.
+"""
+import sys, random, optparse, time, json, shlex
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from urllib.parse import urlencode, urljoin
 
 import requests
+from twisted.internet import defer, task
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
 
+from splash.metrics import parse_samples
 from .utils import SplashServer, MockServer
 
 
-class StressTest():
+# name -> (endpoint, arguments); relative URLs are resolved
+# against the mock server.
+SCENARIOS = {
+    'html': ('render.html', {'url': 'jsrender'}),
+    'json': ('render.json', {'url': 'jsrender', 'html': 1, 'png': 1,
+                             'har': 1}),
+    'slow': ('render.html', {'url': 'delay?n=2', 'timeout': 10}),
+    'timeout': ('render.html', {'url': 'delay?n=10', 'timeout': 0.5}),
+    'error': ('render.html', {'url': 'http://non-existent-host/'}),
+    'heavy-js': ('render.html', {'url': 'cpu-heavy-js?ms=500'}),
+    'large-png': ('render.png', {'url': 'synthetic?height=20000',
+                                 'render_all': 1, 'wait': 0.1}),
+    'redirect': ('render.html', {'url': 'http-redirect?code=302'}),
+    'js-redirect': ('render.html', {'url': 'jsredirect-chain',
+                                    'wait': 0.2}),
+}
+
+
+def parse_mix(mix):
+    """
+    Parse a scenario mix like ``html=5,slow=1``; return a list of
+    ``(scenario, weight)`` tuples.
 
-    def __init__(self, reqs, host="localhost:8050", requests=1000, concurrency=50, shuffle=False, verbose=False):
-        self.reqs = reqs
-        self.host = host
-        self.requests = requests
-        self.concurrency = concurrency
-        self.shuffle = shuffle
-        self.verbose = verbose
+    >>> parse_mix("html=5,slow")
+    [('html', 5.0), ('slow', 1.0)]
+    """
+    res = []
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in SCENARIOS:
+            raise ValueError("Unknown scenario %r; available scenarios: %s" %
+                             (name, ", ".join(sorted(SCENARIOS))))
+        res.append((name, float(weight or 1)))
+    return res
+
+
+def arrival_times(rate, duration, poisson=True, rng=random):
+    """ Return a list of request start times, in seconds """
+    times = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate) if poisson else 1.0 / rate
+        if t >= duration:
+            return times
+        times.append(t)
 
-    def run(self):
-        args = list(islice(self.reqs, self.requests))
-        if self.shuffle:
-            random.shuffle(args)
-        print("Total requests: %d" % len(args))
-        print("Concurrency   : %d" % self.concurrency)
-
-        starttime = time.time()
-        q, p = Queue(), Queue()
-        for _ in range(self.concurrency):
-            t = Thread(target=worker, args=(self.host, q, p, self.verbose))
-            t.daemon = True
-            t.start()
-        for a in args:
-            q.put(a)
-        q.join()
-
-        outputs = []
-        for _ in range(self.requests):
-            outputs.append(p.get())
-
-        elapsed = time.time() - starttime
-        print()
-        print("Total requests: %d" % len(args))
-        print("Concurrency   : %d" % self.concurrency)
-        print("Elapsed time  : %.3fs" % elapsed)
-        print("Avg time p/req: %.3fs" % (elapsed/len(args)))
-        print("Received (per status code or error):")
-        for c, n in Counter(outputs).items():
-            print("  %s: %d" % (c, n))
 
+def percentile(sorted_values, q):
+    """
+    Return q-th percentile (0 <= q <= 100) of a sorted list,
+    using nearest-rank method.
 
-def worker(host, q, p, verbose=False):
-    url = "http://%s/render.html" % host
-    while True:
-        try:
-            args = q.get()
-            t = time.time()
-            r = requests.get(url, params=args)
-            t = time.time() - t
-            p.put(r.status_code)
-            if verbose:
-                print(". %d %.3fs %s" % (r.status_code, t, args))
-            else:
-                sys.stdout.write(".")
-                sys.stdout.flush()
-        except Exception as e:
-            p.put(type(e))
-            if verbose:
-                print("E %.3fs %s" % (t, args))
-            else:
-                sys.stdout.write("E")
-                sys.stdout.flush()
-        finally:
-            q.task_done()
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 99)
+    4
+    """
+    if not sorted_values:
+        return None
+    rank = max(int(-(-q * len(sorted_values) // 100)), 1)
+    return sorted_values[rank - 1]
 
 
-class MockArgs(object):
+def histogram_percentile(buckets, q):
+    """
+    Estimate q-th percentile from cumulative Prometheus histogram
+    ``buckets``: a sorted list of ``(upper_bound, count)`` tuples.
 
-    ok_urls = 0.5
-    error_urls = 0.3
-    timeout_urls = 0.2
+    >>> histogram_percentile([(1.0, 5), (2.0, 10), (float('inf'), 10)], 75)
+    1.5
+    """
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    target = total * q / 100.0
+    index = bisect_left([count for _, count in buckets], target)
+    bound, count = buckets[index]
+    if index == 0:
+        return bound if bound != float('inf') else None
+    prev_bound, prev_count = buckets[index - 1]
+    if bound == float('inf'):
+        return prev_bound
+    return prev_bound + (bound - prev_bound) * (
+        (target - prev_count) / (count - prev_count))
+
+
+class MetricsSampler:
+    """ Scrape Splash /metrics periodically """
+
+    def __init__(self, agent, splash_url, interval):
+        self.agent = agent
+        self.url = splash_url + "metrics"
+        self.interval = interval
+        self.timeline = []
+        self.first = self.last = None
+        self.start_time = None
+        self._loop = task.LoopingCall(self.sample)
+
+    def start(self):
+        self.start_time = time.time()
+        return self._loop.start(self.interval, now=True)
+
+    @defer.inlineCallbacks
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+        yield self.sample()
+
+    @defer.inlineCallbacks
+    def sample(self):
+        try:
+            response = yield self.agent.request(b'GET', self.url.encode())
+            body = yield readBody(response)
+        except Exception as e:
+            print("Can't get metrics: %s" % e, file=sys.stderr)
+            return
+        samples = parse_samples(body.decode('utf-8'))
+        if self.first is None:
+            self.first = samples
+        self.last = samples
+        self.timeline.append({
+            'time': time.time() - self.start_time,
+            'rss': samples.get(('splash_rss_bytes', ())),
+            'max_rss': samples.get(('splash_max_rss_bytes', ())),
+            'queue_size': samples.get(('splash_queue_size', ())),
+            'active_slots': samples.get(('splash_active_slots', ())),
+        })
+
+    def queue_wait(self):
+        """ Return statistics of queue wait time during the test """
+        if self.first is None:
+            return {}
+        buckets = defaultdict(float)
+        total = count = 0.0
+        for (name, labels), value in self.last.items():
+            if not name.startswith('splash_queue_wait_seconds'):
+                continue
+            value -= self.first.get((name, labels), 0.0)
+            if name.endswith('_bucket'):
+                buckets[float(dict(labels)['le'])] += value
+            elif name.endswith('_sum'):
+                total += value
+            elif name.endswith('_count'):
+                count += value
+        buckets = sorted(buckets.items())
+        return {
+            'count': count,
+            'mean': total / count if count else None,
+            'p50': histogram_percentile(buckets, 50),
+            'p90': histogram_percentile(buckets, 90),
+            'p99': histogram_percentile(buckets, 99),
+        }
+
+
+class LoadTest:
+
+    def __init__(self, splash_url, mock_url, mix, rate, duration,
+                 poisson=True, client_timeout=120, metrics_interval=1.0,
+                 urls=None, seed=None, verbose=False):
+        self.splash_url = splash_url
+        self.mock_url = mock_url
+        self.mix = mix
+        self.rate = rate
+        self.duration = duration
+        self.poisson = poisson
+        self.client_timeout = client_timeout
+        self.metrics_interval = metrics_interval
+        self.urls = urls
+        self.rng = random.Random(seed)
+        self.verbose = verbose
+        self.results = []
 
-    def __init__(self, requests=1000):
-        self.requests = requests
+    def get_request(self):
+        """ Return ``(scenario, url)`` for a next request """
+        if self.urls is not None:
+            args = next(self.urls)
+            scenario, endpoint = 'urls', 'render.html'
+        else:
+            names, weights = zip(*self.mix)
+            scenario = self.rng.choices(names, weights)[0]
+            endpoint, args = SCENARIOS[scenario]
+            args = dict(args, url=urljoin(self.mock_url, args['url']))
+        return scenario, self.splash_url + endpoint + "?" + urlencode(args)
+
+    @defer.inlineCallbacks
+    def run(self, reactor):
+        pool = HTTPConnectionPool(reactor)
+        pool.maxPersistentPerHost = 1000
+        agent = Agent(reactor, pool=pool)
+        sampler = MetricsSampler(agent, self.splash_url,
+                                 self.metrics_interval)
+        sampler.start()
+
+        start_time = reactor.seconds()
+        requests_done = []
+        for t in arrival_times(self.rate, self.duration, self.poisson,
+                               self.rng):
+            scenario, url = self.get_request()
+            d = task.deferLater(reactor, t, self.send, reactor, agent,
+                                scenario, url, start_time + t)
+            requests_done.append(d)
+        print("Sending %d requests in %ss" % (len(requests_done),
+                                               self.duration))
+        yield defer.DeferredList(requests_done)
+        self.elapsed = reactor.seconds() - start_time
+        yield sampler.stop()
+        yield pool.closeCachedConnections()
+        return self.get_report(sampler)
+
+    @defer.inlineCallbacks
+    def send(self, reactor, agent, scenario, url, scheduled):
+        sent = reactor.seconds()
+        try:
+            d = agent.request(b'GET', url.encode('utf-8'))
+            d.addTimeout(self.client_timeout, reactor)
+            response = yield d
+            yield readBody(response)
+            status = response.code
+        except Exception as e:
+            status = type(e).__name__
+        finished = reactor.seconds()
+        self.results.append({
+            'scenario': scenario,
+            'status': status,
+            # latency is measured from the scheduled start time,
+            # so that client delays are not hidden
+            'latency': finished - scheduled,
+            'lag': sent - scheduled,
+            'finished': finished,
+        })
+        if self.verbose:
+            print("%s %s %.3fs" % (scenario, status, finished - scheduled))
+        else:
+            sys.stdout.write("." if status == 200 else "E")
+            sys.stdout.flush()
+
+    def get_report(self, sampler):
+        by_scenario = defaultdict(list)
+        for result in self.results:
+            by_scenario[result['scenario']].append(result)
+            by_scenario['total'].append(result)
+        scenarios = {}
+        for name, results in by_scenario.items():
+            latencies = sorted(r['latency'] for r in results)
+            ok = [r for r in results if r['status'] == 200]
+            scenarios[name] = {
+                'requests': len(results),
+                'ok': len(ok),
+                'throughput': len(ok) / self.elapsed,
+                'statuses': dict(Counter(str(r['status'])
+                                         for r in results)),
+                'latency': {
+                    'p50': percentile(latencies, 50),
+                    'p90': percentile(latencies, 90),
+                    'p99': percentile(latencies, 99),
+                    'max': latencies[-1] if latencies else None,
+                },
+            }
+        return {
+            'rate': self.rate,
+            'duration': self.duration,
+            'elapsed': self.elapsed,
+            'max_client_lag': max([r['lag'] for r in self.results] or [0]),
+            'scenarios': scenarios,
+            'queue_wait': sampler.queue_wait(),
+            'server': sampler.timeline,
+        }
+
+
+def print_report(report):
+    print()
+    print("Target rate   : %.1f req/s" % report['rate'])
+    print("Elapsed time  : %.1fs" % report['elapsed'])
+    print("Max client lag: %.3fs" % report['max_client_lag'])
+    print()
+    print("%-12s %6s %6s %8s %8s %8s %8s %8s  %s" % (
+        "scenario", "reqs", "ok", "ok/s", "p50", "p90", "p99", "max",
+        "statuses"))
+    for name, stats in sorted(report['scenarios'].items()):
+        latency = stats['latency']
+        print("%-12s %6d %6d %8.2f %8s %8s %8s %8s  %s" % (
+            name, stats['requests'], stats['ok'], stats['throughput'],
+            _fmt(latency['p50']), _fmt(latency['p90']),
+            _fmt(latency['p99']), _fmt(latency['max']),
+            ", ".join("%s: %d" % kv for kv in sorted(
+                stats['statuses'].items()))))
+    queue_wait = report['queue_wait']
+    if queue_wait:
+        print()
+        print("Queue wait    : mean %s, p50 %s, p90 %s, p99 %s" % (
+            _fmt(queue_wait['mean']), _fmt(queue_wait['p50']),
+            _fmt(queue_wait['p90']), _fmt(queue_wait['p99'])))
+    rss = [s['rss'] for s in report['server'] if s['rss'] is not None]
+    if rss:
+        print("RSS           : start %dMB, max %dMB, end %dMB" % (
+            rss[0] / 2**20, max(rss) / 2**20, rss[-1] / 2**20))
 
-    def _ok_urls(self):
-        url = ["http://localhost:8998/jsrender"]
-        return int(self.requests * self.ok_urls) * url
 
-    def _error_urls(self):
-        url = ["http://non-existent-host/"]
-        return int(self.requests * self.error_urls) * url
+def _fmt(seconds):
+    if seconds is None:
+        return "-"
+    return "%.3fs" % seconds
 
-    def _timeout_urls(self):
-        url = ["http://localhost:8998/delay?n=10&timeout=0.5"]
-        return int(self.requests * self.timeout_urls) * url
 
-    def __iter__(self):
-        ok_urls = self._ok_urls()
-        error_urls = self._error_urls()
-        timeout_urls = self._timeout_urls()
-        print("Expected codes: HTTP200x%d, HTTP502x%d, HTTP504x%d" % (
-            len(ok_urls), len(error_urls), len(timeout_urls)))
-        urls = ok_urls + error_urls + timeout_urls
-        return ({"url": x} for x in urls)
+def cycle(iterable):
+    items = list(iterable)
+    while True:
+        for item in items:
+            yield item
 
 
 class ArgsFromUrlFile(object):
@@ -206,34 +441,84 @@ end
 
 
 def parse_opts():
-    op = optparse.OptionParser()
+    op = optparse.OptionParser(usage="%prog [options]\n" + __doc__)
     op.add_option("-H", dest="host", default="localhost:8050",
             help="splash hostname & port (default: %default)")
+    op.add_option("-M", dest="mock_host", default="localhost:8998",
+            help="mock server hostname & port (default: %default)")
+    op.add_option("--start", action="store_true", default=False,
+            help="start Splash and mock servers instead of using "
+                 "running ones")
+    op.add_option("--splash-args", default="",
+            help="extra arguments for Splash started with --start, "
+                 "e.g. \"--slots 10 --maxrss 3000\"")
+    op.add_option("-m", dest="mix", default="html=4,json=1,slow=1,error=1",
+            help="scenario mix, name=weight pairs (default: %%default); "
+                 "available scenarios: %s" % ", ".join(sorted(SCENARIOS)))
     op.add_option("-u", dest="urlfile", metavar="FILE",
             help="read urls from FILE instead of using mock server ones")
     op.add_option("-l", dest="logfile", metavar="FILE",
             help="read urls from splash log file (useful for replaying)")
-    op.add_option("-s", dest="shuffle", action="store_true", default=False,
-            help="shuffle (randomize) requests (default: %default)")
+    op.add_option("-r", dest="rate", type="float", default=5,
+            help="requests per second (default: %default)")
+    op.add_option("-d", dest="duration", type="float", default=60,
+            help="test duration, in seconds (default: %default)")
+    op.add_option("--uniform", action="store_true", default=False,
+            help="send requests at fixed intervals instead of "
+                 "Poisson arrivals")
+    op.add_option("--client-timeout", type="float", default=120,
+            help="client-side request timeout (default: %default)")
+    op.add_option("--metrics-interval", type="float", default=1.0,
+            help="how often to scrape /metrics (default: %default)")
+    op.add_option("--seed", type="int", help="random seed")
+    op.add_option("--json", metavar="FILE",
+            help="write the report to FILE as JSON")
     op.add_option("-v", dest="verbose", action="store_true", default=False,
             help="verbose mode (default: %default)")
-    op.add_option("-c", dest="concurrency", type="int", default=50,
-            help="concurrency (default: %default)")
-    op.add_option("-n", dest="requests", type="int", default=1000,
-            help="number of requests (default: %default)")
     return op.parse_args()
 
 
 def main():
     opts, _ = parse_opts()
+    urls = None
     if opts.urlfile:
-        urls = ArgsFromUrlFile(opts.urlfile)
+        urls = cycle(ArgsFromUrlFile(opts.urlfile))
     elif opts.logfile:
-        urls = ArgsFromLogfile(opts.logfile)
+        urls = cycle(ArgsFromLogfile(opts.logfile))
+
+    def report_results(report):
+        print_report(report)
+        if opts.json:
+            with open(opts.json, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    def run(splash_host, mock_host):
+        test = LoadTest(
+            splash_url="http://%s/" % splash_host,
+            mock_url="http://%s/" % mock_host,
+            mix=parse_mix(opts.mix),
+            rate=opts.rate,
+            duration=opts.duration,
+            poisson=not opts.uniform,
+            client_timeout=opts.client_timeout,
+            metrics_interval=opts.metrics_interval,
+            urls=urls,
+            seed=opts.seed,
+            verbose=opts.verbose,
+        )
+        # react() stops the reactor and exits when the test is finished
+        task.react(lambda reactor: test.run(reactor).addCallback(
+            report_results))
+
+    if opts.start:
+        with MockServer() as mock, SplashServer(
+                extra_args=shlex.split(opts.splash_args),
+                verbosity=1) as splash:
+            run("localhost:%d" % splash.portnum,
+                "localhost:%d" % mock.http_port)
     else:
-        urls = MockArgs(opts.requests)
-    t = StressTest(urls, opts.host, opts.requests, opts.concurrency, opts.shuffle, opts.verbose)
-    t.run()
+        run(opts.host, opts.mock_host)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import pytest
+from adblockparser import AdblockRule
+
+from splash.adblock import (
+    FilterIndex,
+    get_rule_tokens,
+    load_snapshot,
+    save_snapshot,
+)
+
+
+def make_index(filters):
+    index = FilterIndex()
+    for name, lines in filters.items():
+        for line in lines:
+            index.add_rule(AdblockRule(line), name)
+    return index
+
+
+FILTERS = {
+    'ads': [
+        '||ads.example.com^',
+        '/banner/*/img^',
+        '.swf|',
+        '/ad[0-9]+/',
+        '@@||ads.example.com/allowed/',
+    ],
+    'scripts': [
+        '^script.js|$domain=example.com',
+        '||ads.example.com^',
+    ],
+}
+
+
+@pytest.fixture(params=['parsed', 'snapshot'])
+def index(request, tmpdir):
+    index = make_index(FILTERS)
+    if request.param == 'snapshot':
+        path = str(tmpdir.join('snapshot'))
+        save_snapshot(path, index, {'ads': 5, 'scripts': 2}, key=[1])
+        index, filters = load_snapshot(path, key=[1])
+        assert filters == {'ads': 5, 'scripts': 2}
+    return index
+
+
+@pytest.mark.parametrize(['url', 'filter_names', 'result'], [
+    ('http://ads.example.com/foo', ['ads'], 'ads'),
+    ('http://ads.example.com/foo', ['scripts', 'ads'], 'scripts'),
+    ('http://ADS.example.com/foo', ['ads'], 'ads'),
+    ('http://example.com/foo', ['ads'], None),
+    ('http://badads.example.com/foo', ['ads'], None),
+    ('http://notads.example.com.org/foo', ['ads'], None),
+    ('http://example.com/banner/123/img?x=1', ['ads'], 'ads'),
+    ('http://example.com/banner/123/img.gif', ['ads'], None),
+    ('http://example.com/flash.swf', ['ads'], 'ads'),
+    ('http://example.com/flash.swf?x=1', ['ads'], None),
+    ('http://example.com/ad12/x.gif', ['ads'], 'ads'),
+    # exception rules apply only to rules of the same filter
+    ('http://ads.example.com/allowed/x', ['ads'], None),
+    ('http://ads.example.com/allowed/x', ['ads', 'scripts'], 'scripts'),
+    ('http://example.com/script.js', ['scripts'], 'scripts'),
+    ('http://example.com/script.json', ['scripts'], None),
+])
+def test_blocking_filter(index, url, filter_names, result):
+    options = {'domain': 'www.example.com'}
+    assert index.get_blocking_filter(filter_names, url, options) == result
+
+
+def test_domain_option(index):
+    url = 'http://example.com/script.js'
+    assert index.get_blocking_filter(['scripts'], url,
+                                     {'domain': 'example.org'}) is None
+    assert index.get_blocking_filter(['scripts'], url, {}) is None
+
+
+def test_shared_rules(index):
+    assert index.stats()['rules'] == 6
+
+
+def test_snapshot_invalid(tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    assert load_snapshot(path, key=[1]) is None
+    save_snapshot(path, make_index(FILTERS), {'ads': 5, 'scripts': 2}, key=[1])
+    assert load_snapshot(path, key=[2]) is None
+    with open(path, 'r+b') as f:
+        f.truncate(100)
+    assert load_snapshot(path, key=[1]) is None
+
+
+@pytest.mark.parametrize(['rule_text', 'tokens'], [
+    ('||ads.example.com^', ['ads', 'example', 'com']),
+    ('|http://ads.', ['http', 'ads']),
+    ('ads*', []),
+    ('*/ads/*', ['ads']),
+    ('', []),
+])
+def test_rule_tokens(rule_text, tokens):
+    assert get_rule_tokens(rule_text) == tokens
@@ -17,6 +17,7 @@ from splash.qtutils import has_min_qt_version
 from splash import version_info
 from splash.har_builder import HarBuilder
 from splash.har.utils import get_response_body_bytes
+from splash.raw_image import raw_image_to_pil
 
 from . import test_render
 from .test_jsonpost import JsonPostRequestHandler
@@ -510,6 +511,98 @@ class ImageRenderTest(BaseLuaRenderTest):
         """, {'url': self.mockurl("show-image")})
         self.assertEqual(resp.json()['res'], 50)
 
+    def test_webp(self):
+        resp = self.request_lua("""
+        function main(splash)
+            splash:set_viewport_size(300, 200)
+            splash:go(splash.args.url)
+            return splash:webp{quality=50, method=6}
+        end
+        """, {'url': self.mockurl("jsrender")})
+        self.assertWebp(resp, width=300, height=200)
+
+    def test_raw(self):
+        resp = self.request_lua("""
+        function main(splash)
+            splash:set_viewport_size(300, 200)
+            splash:go(splash.args.url)
+            return {
+                png=splash:png{format='raw'},
+                jpeg=splash:jpeg{format='raw', downsample=2},
+            }
+        end
+        """, {'url': self.mockurl("jsrender")})
+        self.assertStatusCode(resp, 200)
+        data = resp.json()
+        png = raw_image_to_pil(base64.b64decode(data['png']))
+        self.assertEqual((png.mode, png.size), ('RGBA', (300, 200)))
+        jpeg = raw_image_to_pil(base64.b64decode(data['jpeg']))
+        self.assertEqual((jpeg.mode, jpeg.size), ('RGB', (150, 100)))
+
+    def test_raw_bad_arguments(self):
+        for args, argname in [("format='gif'", 'format'),
+                              ("downsample=2", 'downsample'),
+                              ("format='raw', downsample=1.5", 'downsample')]:
+            resp = self.request_lua("""
+            function main(splash)
+                return splash:png{%s}
+            end
+            """ % args)
+            err = self.assertScriptError(resp, ScriptError.SPLASH_LUA_ERROR)
+            self.assertEqual(err['info']['argument'], argname)
+
+    def test_screenshots(self):
+        resp = self.request_lua("""
+        function main(splash)
+            splash:set_viewport_size(300, 200)
+            splash:go(splash.args.url)
+            local images = splash:screenshots{images={
+                {format='png'},
+                {format='jpeg', width=150},
+                {format='raw', pixel_format='RGB', downsample=2},
+            }}
+            local named = splash:screenshots{images={
+                full={format='webp'},
+                missing={selector='#no-such-element'},
+            }}
+            return {
+                png=images[1], jpeg=images[2], raw=images[3],
+                webp=named.full, missing=named.missing == nil,
+            }
+        end
+        """, {'url': self.mockurl("jsrender")})
+        self.assertStatusCode(resp, 200)
+        data = resp.json()
+        self.assertTrue(data['missing'])
+        for key, fmt, size in [('png', 'PNG', (300, 200)),
+                               ('jpeg', 'JPEG', (150, 100)),
+                               ('webp', 'WEBP', (300, 200))]:
+            img = Image.open(BytesIO(base64.b64decode(data[key])))
+            self.assertEqual((img.format, img.size), (fmt, size))
+        raw = raw_image_to_pil(base64.b64decode(data['raw']))
+        self.assertEqual((raw.mode, raw.size), ('RGB', (150, 100)))
+
+    def test_screenshots_bad_arguments(self):
+        for images in ["{}", "{{format='gif'}}",
+                       "{{quality=200}}", "{{foo=1}}"]:
+            resp = self.request_lua("""
+            function main(splash)
+                return splash:screenshots{images=%s}
+            end
+            """ % images)
+            err = self.assertScriptError(resp, ScriptError.SPLASH_LUA_ERROR)
+            self.assertEqual(err['info']['argument'], 'images')
+
+    def test_webp_bad_quality(self):
+        resp = self.request_lua("""
+        function main(splash)
+            return splash:webp{quality=200}
+        end
+        """)
+        err = self.assertScriptError(resp, ScriptError.SPLASH_LUA_ERROR,
+                                     "quality must be in 0-100 range")
+        self.assertEqual(err['info']['argument'], 'quality')
+
 
 class EvaljsTest(BaseLuaRenderTest):
     def _evaljs_request(self, js):
@@ -202,6 +202,25 @@ class OnRequestTest(BaseLuaRenderTest, BaseHtmlProxyTest):
         self.assertScriptError(resp, ScriptError.SPLASH_LUA_ERROR,
                                message="request is used outside a callback")
 
+    def test_set_cache_policy(self):
+        resp = self.request_lua("""
+        function main(splash)
+            local valid, invalid
+            splash:on_request(function(request)
+                valid = pcall(function()
+                    request:set_cache_policy("prefer_cache")
+                end)
+                invalid = pcall(function()
+                    request:set_cache_policy("foo")
+                end)
+            end)
+            assert(splash:go(splash.args.url))
+            return {valid=valid, invalid=invalid}
+        end
+        """, {'url': self.mockurl("jsrender")})
+        self.assertStatusCode(resp, 200)
+        self.assertEqual(resp.json(), {'valid': True, 'invalid': False})
+
     def test_set_header(self):
         resp = self.request_lua("""
         function main(splash)
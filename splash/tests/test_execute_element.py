@@ -886,6 +886,23 @@ class HTMLElementTest(BaseLuaRenderTest):
         self.assertStatusCode(resp, 200)
         self.assertJpeg(resp, 1024 // 2, 768)
 
+    def test_webp(self):
+        resp = self.request_lua("""
+        function main(splash)
+            local args = splash.args
+
+            splash:set_viewport_size(1024, 768)
+            splash:go(args.url)
+            splash:wait(0.1)
+
+            local left = splash:select('#left')
+            return left:webp{lossless=true}
+        end
+        """, {"url": self.mockurl("red-green")})
+
+        self.assertStatusCode(resp, 200)
+        self.assertWebp(resp, 1024 // 2, 768)
+
     def test_jpeg_non_existing_element(self):
         resp = self.request_lua("""
         function main(splash)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import base64
+import threading
+
+from twisted.internet import reactor
+from twisted.trial import unittest
+
+from splash.image_encoding import ImageEncoder, encode_image
+
+
+class FakeImage:
+    def to_png(self):
+        return b"png"
+
+    def to_jpeg(self, quality=None):
+        return b"jpeg%s" % str(quality).encode('ascii')
+
+    def to_webp(self, quality=80, lossless=False, method=4):
+        return b"webp%d%d%d" % (quality, lossless, method)
+
+    def to_raw(self, pixel_format='RGBA', downsample=1):
+        return b"raw%s%d" % (pixel_format.encode('ascii'), downsample)
+
+
+def current_thread(*args):
+    return threading.current_thread()
+
+
+class EncodeImageTest(unittest.TestCase):
+
+    def test_formats(self):
+        img = FakeImage()
+        self.assertEqual(encode_image(img, 'PNG'), b"png")
+        self.assertEqual(encode_image(img, 'JPEG', quality=50), b"jpeg50")
+        self.assertEqual(encode_image(img, 'WEBP'), b"webp8004")
+        self.assertEqual(encode_image(img, 'WEBP', quality=90,
+                                      lossless=True, method=6), b"webp9016")
+        self.assertEqual(encode_image(img, 'RAW'), b"rawRGBA1")
+        self.assertEqual(encode_image(img, 'RAW', pixel_format='RGB',
+                                      downsample=2), b"rawRGB2")
+        self.assertEqual(encode_image(img, 'PNG', b64=True),
+                         base64.b64encode(b"png").decode('ascii'))
+        with self.assertRaises(ValueError):
+            encode_image(img, 'GIF')
+
+
+class ImageEncoderTest(unittest.TestCase):
+
+    def test_inline(self):
+        encoder = ImageEncoder(0)
+        encoder.start(reactor)
+        self.assertFalse(encoder.is_threaded)
+        d = encoder.encode(current_thread)
+        # result is available right away
+        self.assertIs(self.successResultOf(d), threading.current_thread())
+
+    def test_inline_error(self):
+        encoder = ImageEncoder(0)
+        d = encoder.encode(encode_image, FakeImage(), 'GIF')
+        self.failureResultOf(d, ValueError)
+
+    def test_threaded(self):
+        encoder = ImageEncoder(2)
+        encoder.start(reactor)
+        self.addCleanup(encoder.stop)
+        self.assertTrue(encoder.is_threaded)
+
+        d1 = encoder.encode(current_thread)
+        d1.addCallback(self.assertIsNot, threading.current_thread())
+        d2 = encoder.encode(encode_image, FakeImage(), 'PNG', b64=True)
+        d2.addCallback(self.assertEqual,
+                       base64.b64encode(b"png").decode('ascii'))
+        d3 = encoder.encode(encode_image, FakeImage(), 'GIF')
+        self.assertFailure(d3, ValueError)
+        return d1.addCallback(lambda _: d2).addCallback(lambda _: d3)
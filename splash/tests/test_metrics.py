@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+
+from splash.metrics import (
+    Counter, Gauge, Histogram, Registry, parse_samples,
+)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        c = Counter("requests_total", "Requests", ["status"],
+                    registry=self.registry)
+        c.labels(status=200).inc()
+        c.labels(status=200).inc(2)
+        c.labels(status=504).inc()
+        self.assertEqual(self.registry.render(), "\n".join([
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{status="200"} 3.0',
+            'requests_total{status="504"} 1.0',
+        ]) + "\n")
+        with self.assertRaises(ValueError):
+            c.labels(status=200).inc(-1)
+        with self.assertRaises(ValueError):
+            c.inc()
+
+    def test_gauge(self):
+        g = Gauge("queue_size", "Queue size", registry=self.registry)
+        self.assertIn("queue_size 0.0\n", self.registry.render())
+        g.set(5)
+        g.dec()
+        self.assertIn("queue_size 4.0\n", self.registry.render())
+
+    def test_histogram(self):
+        h = Histogram("render_seconds", "Render time", buckets=[1, 0.1],
+                      registry=self.registry)
+        for value in [0.05, 0.5, 0.7, 3]:
+            h.observe(value)
+        self.assertEqual(self.registry.render(), "\n".join([
+            '# HELP render_seconds Render time',
+            '# TYPE render_seconds histogram',
+            'render_seconds_bucket{le="0.1"} 1.0',
+            'render_seconds_bucket{le="1.0"} 3.0',
+            'render_seconds_bucket{le="+Inf"} 4.0',
+            'render_seconds_sum 4.25',
+            'render_seconds_count 4.0',
+        ]) + "\n")
+
+    def test_threads(self):
+        h = Histogram("encode_seconds", "Encode time", ["format"],
+                      buckets=[1], registry=self.registry)
+
+        def observe():
+            for i in range(1000):
+                h.labels(format=i % 10).observe(0.5)
+
+        threads = [threading.Thread(target=observe) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        samples = parse_samples(self.registry.render())
+        for i in range(10):
+            key = ('encode_seconds_count', (('format', str(i)),))
+            self.assertEqual(samples[key], 800)
+
+    def test_label_escaping(self):
+        c = Counter("blocked_total", "Blocked", ["filter"],
+                    registry=self.registry)
+        c.labels(filter='a"b\\c\n').inc()
+        self.assertIn('blocked_total{filter="a\\"b\\\\c\\n"} 1.0',
+                      self.registry.render())
+
+    def test_parse_samples(self):
+        c = Counter("blocked_total", "Blocked", ["filter"],
+                    registry=self.registry)
+        c.labels(filter='a"b\\c\n').inc()
+        h = Histogram("render_seconds", "Render time", buckets=[1],
+                      registry=self.registry)
+        h.observe(2)
+        self.assertEqual(parse_samples(self.registry.render()), {
+            ('blocked_total', (('filter', 'a"b\\c\n'),)): 1.0,
+            ('render_seconds_bucket', (('le', '1.0'),)): 0.0,
+            ('render_seconds_bucket', (('le', '+Inf'),)): 1.0,
+            ('render_seconds_sum', ()): 2.0,
+            ('render_seconds_count', ()): 1.0,
+        })
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw
+
+from splash import png_stream
+from splash.png_stream import PngStreamWriter
+
+
+def _sample_image(mode, size):
+    img = Image.new(mode, size, color=(255, 255, 255, 255)[:len(mode)])
+    draw = ImageDraw.Draw(img)
+    for y in range(0, size[1], 7):
+        draw.line([(0, y), (size[0], size[1] - y)],
+                  fill=(y % 256, 100, 200, 128)[:len(mode)])
+    return img
+
+
+def _assert_same(png_data, expected):
+    img = Image.open(BytesIO(png_data))
+    assert img.format == 'PNG'
+    assert img.mode == expected.mode
+    assert img.size == expected.size
+    assert ImageChops.difference(img, expected).getbbox() is None
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA'])
+def test_bands(mode):
+    img = _sample_image(mode, (130, 101))
+    writer = PngStreamWriter(130, 101, mode)
+    for top in range(0, 101, 30):
+        writer.write(img.crop((0, top, 130, min(top + 30, 101))))
+    _assert_same(writer.close(), img)
+
+
+def test_many_idat_chunks(monkeypatch):
+    monkeypatch.setattr(png_stream, '_IDAT_SIZE', 100)
+    img = _sample_image('RGBA', (50, 200))
+    writer = PngStreamWriter(50, 200, complevel=0)
+    writer.write(img)
+    data = writer.close()
+    assert data.count(b'IDAT') > 10
+    _assert_same(data, img)
+
+
+def test_write_blank():
+    img = _sample_image('RGBA', (20, 10))
+    expected = Image.new('RGBA', (20, 1000))
+    expected.paste(img, (0, 0))
+    writer = PngStreamWriter(20, 1000)
+    writer.write(img)
+    writer.write_blank(990)
+    _assert_same(writer.close(), expected)
+
+
+def test_invalid_bands():
+    writer = PngStreamWriter(20, 10)
+    with pytest.raises(ValueError):
+        writer.write(Image.new('RGB', (20, 5)))
+    with pytest.raises(ValueError):
+        writer.write(Image.new('RGBA', (21, 5)))
+    with pytest.raises(ValueError):
+        writer.write(Image.new('RGBA', (20, 11)))
+    writer.write(Image.new('RGBA', (20, 5)))
+    with pytest.raises(ValueError):
+        writer.close()
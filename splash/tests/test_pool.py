@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from twisted.internet import defer
+
+from splash.errors import OverloadedError
+from splash.pool import FairQueue, HostMemoryStats, RenderPool, RenderStats
+from splash.render_options import RenderOptions
+
+
+def drain(queue):
+    items = []
+    for _ in range(len(queue)):
+        queue.get().addCallback(items.append)
+    return items
+
+
+class FairQueueTest(unittest.TestCase):
+
+    def test_fifo(self):
+        q = FairQueue()
+        for i in range(5):
+            q.put(i)
+        self.assertEqual(len(q), 5)
+        self.assertEqual(drain(q), [0, 1, 2, 3, 4])
+        self.assertEqual(len(q), 0)
+
+    def test_get_before_put(self):
+        q = FairQueue()
+        items = []
+        q.get().addCallback(items.append)
+        q.get().addCallback(items.append)
+        q.put("foo")
+        q.put("bar", priority=10)
+        self.assertEqual(items, ["foo", "bar"])
+        self.assertEqual(len(q), 0)
+
+    def test_cancel_get(self):
+        q = FairQueue()
+        d = q.get()
+        d.addErrback(lambda failure: None)
+        d.cancel()
+        q.put("foo")
+        self.assertEqual(q.pending, ["foo"])
+
+    def test_priority(self):
+        q = FairQueue()
+        q.put("low", priority=-1)
+        q.put("normal")
+        q.put("high", priority=5)
+        q.put("normal2")
+        self.assertEqual(drain(q), ["high", "normal", "normal2", "low"])
+
+    def test_clients_are_interleaved(self):
+        q = FairQueue()
+        for i in range(4):
+            q.put(("bulk", i), client_id="bulk")
+        q.put(("other", 0), client_id="other")
+        q.put(("other", 1), client_id="other")
+        self.assertEqual(drain(q), [
+            ("bulk", 0), ("other", 0), ("bulk", 1), ("other", 1),
+            ("bulk", 2), ("bulk", 3),
+        ])
+
+    def test_client_weights(self):
+        q = FairQueue({"heavy": 3})
+        for i in range(6):
+            q.put("light", client_id="light")
+            q.put("heavy", client_id="heavy")
+        self.assertEqual(drain(q)[:8], [
+            "light", "heavy", "heavy", "heavy",
+            "light", "heavy", "heavy", "heavy",
+        ])
+
+    def test_idle_client_does_not_save_up_time(self):
+        q = FairQueue()
+        q.put("a", client_id="a")
+        q.put("b", client_id="b")
+        drain(q)
+        for i in range(3):
+            q.put(("a", i), client_id="a")
+        self.assertEqual(drain(q)[:1], [("a", 0)])
+        for i in range(3):
+            q.put(("a", i), client_id="a")
+        q.put(("b", 0), client_id="b")
+        self.assertEqual(drain(q)[:2], [("a", 0), ("b", 0)])
+
+    def test_remove(self):
+        q = FairQueue()
+        q.put("a1", client_id="a")
+        q.put("a2", client_id="a")
+        q.put("b1", client_id="b")
+        q.put("c1", client_id="c", priority=1)
+        self.assertTrue(q.remove("a1", client_id="a"))
+        self.assertFalse(q.remove("a1", client_id="a"))
+        self.assertFalse(q.remove("a2", client_id="b"))
+        self.assertTrue(q.remove("b1", client_id="b"))
+        self.assertTrue(q.remove("c1", client_id="c", priority=1))
+        self.assertEqual(len(q), 1)
+        self.assertEqual(set(q.stats().keys()), {"0"})
+        q.put("b2", client_id="b")
+        self.assertEqual(drain(q), ["a2", "b2"])
+
+    def test_remove_last_item_of_a_client(self):
+        q = FairQueue()
+        q.put("a1", client_id="a")
+        q.put("b1", client_id="b")
+        q.remove("a1", client_id="a")
+        q.put("a2", client_id="a")
+        q.put("a3", client_id="a")
+        self.assertEqual(drain(q), ["b1", "a2", "a3"])
+
+    def test_count_ahead(self):
+        q = FairQueue()
+        self.assertEqual(q.count_ahead(0), 0)
+        q.put(1, priority=-1)
+        q.put(2)
+        q.put(3, priority=1)
+        q.put(4, priority=1)
+        self.assertEqual(q.count_ahead(0), 3)
+        self.assertEqual(q.count_ahead(1), 2)
+        self.assertEqual(q.count_ahead(-10), 4)
+        self.assertEqual(q.count_ahead(10), 0)
+
+    def test_stats(self):
+        q = FairQueue()
+        self.assertEqual(q.stats(), {})
+        q.put(1, client_id="a")
+        q.put(2, client_id="b")
+        q.put(3, priority=1)
+        stats = q.stats()
+        self.assertEqual(set(stats.keys()), {"0", "1"})
+        self.assertEqual(stats["0"]["size"], 2)
+        self.assertEqual(stats["0"]["clients"], 2)
+        self.assertEqual(stats["1"]["size"], 1)
+        self.assertGreaterEqual(stats["1"]["max_wait"], 0)
+
+
+class RenderStatsTest(unittest.TestCase):
+
+    def test_times(self):
+        stats = RenderStats()
+        self.assertIsNone(stats.queue_time)
+        self.assertIsNone(stats.slot_time)
+        stats = RenderStats(queued_at=10.0, started_at=12.5, finished_at=20.0)
+        self.assertEqual(stats.queue_time, 2.5)
+        self.assertEqual(stats.slot_time, 7.5)
+
+    def test_rss_delta(self):
+        stats = RenderStats(rss_before=1000)
+        self.assertIsNone(stats.rss_delta)
+        stats.rss_after = 1500
+        self.assertEqual(stats.rss_delta, 500)
+
+    def test_not_started(self):
+        stats = RenderStats(queued_at=10.0, finished_at=11.0)
+        self.assertEqual(stats.queue_time, 1.0)
+        self.assertIsNone(stats.slot_time)
+
+
+class HostMemoryStatsTest(unittest.TestCase):
+
+    def test_stats(self):
+        stats = HostMemoryStats()
+        stats.add('example.com', 100)
+        stats.add('example.com', 300)
+        stats.add('example.org', -50)
+        self.assertEqual(stats.stats(), {
+            'example.com': {
+                'renders': 2, 'rss_delta_avg': 200, 'rss_delta_max': 300},
+            'example.org': {
+                'renders': 1, 'rss_delta_avg': -50, 'rss_delta_max': -50},
+        })
+        self.assertEqual(list(stats.stats(limit=1)), ['example.com'])
+
+    def test_max_hosts(self):
+        stats = HostMemoryStats()
+        stats.max_hosts = 2
+        stats.add('a', 1)
+        stats.add('b', 1)
+        stats.add('a', 1)
+        stats.add('c', 1)
+        self.assertEqual(set(stats.stats()), {'a', 'c'})
+
+
+class RenderPoolDrainTest(unittest.TestCase):
+
+    def _pool(self):
+        # no slots: requests stay in the queue
+        return RenderPool(slots=0, network_manager_factory=None,
+                          splash_proxy_factory_cls=None,
+                          js_profiles_path=None)
+
+    def test_drain_idle(self):
+        pool = self._pool()
+        drained = []
+        pool.drain().addCallback(drained.append)
+        self.assertEqual(drained, [None])
+        self.assertTrue(pool.draining)
+        with self.assertRaises(OverloadedError) as e:
+            pool.check_queue_limits()
+        self.assertEqual(e.exception.args[0]['reason'], 'draining')
+
+    def test_drain_waits_for_queue(self):
+        pool = self._pool()
+        pool_d = pool.render(None, RenderOptions({'uid': 1}, 60), None)
+        pool_d.addErrback(lambda f: f.trap(defer.CancelledError))
+        drained = []
+        pool.drain().addCallback(drained.append)
+        self.assertEqual(drained, [])
+        pool_d.cancel()
+        self.assertEqual(drained, [None])
+
+
+class FakeRender(object):
+    def __init__(self, render_options, **kwargs):
+        self.render_options = render_options
+        self.deferred = defer.Deferred()
+
+    def start(self, **kwargs):
+        pass
+
+
+class RenderPoolQueueTimeoutTest(unittest.TestCase):
+
+    def test_timer_is_cancelled_when_render_starts(self):
+        from twisted.internet import reactor
+        pool = RenderPool(slots=1, network_manager_factory=lambda: None,
+                          splash_proxy_factory_cls=None,
+                          js_profiles_path=None)
+        options = RenderOptions({'uid': 1, 'queue_timeout': 10}, 60)
+        pool.render(FakeRender, options, None)
+        self.assertEqual(len(pool.active), 1)
+        pending = [call for call in reactor.getDelayedCalls()
+                   if call.func == pool._on_queue_timeout]
+        self.assertEqual(pending, [])
+
+    def test_retry_after(self):
+        pool = RenderPool(slots=1, network_manager_factory=lambda: None,
+                          splash_proxy_factory_cls=None,
+                          js_profiles_path=None)
+        self.assertEqual(pool.estimate_retry_after(), 1)
+        pool.avg_render_time = 2.5
+        pool.render(FakeRender, RenderOptions({'uid': 1}, 60), None)
+        self.assertEqual(pool.estimate_retry_after(), 3)
+        pool_d = pool.render(FakeRender, RenderOptions({'uid': 2}, 60), None)
+        pool_d.addErrback(lambda f: f.trap(defer.CancelledError))
+        self.assertEqual(pool.estimate_retry_after(), 5)
+        pool_d.cancel()
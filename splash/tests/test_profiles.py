@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import os
+
+from splash.profiles import FileCache
+
+
+def test_file_cache(tmpdir):
+    path = tmpdir.join('profile.ini')
+    path.write('foo')
+    loads = []
+
+    def load(path):
+        loads.append(path)
+        with open(path) as f:
+            return f.read()
+
+    cache = FileCache()
+    assert cache.get(str(path), load) == 'foo'
+    assert cache.get(str(path), load) == 'foo'
+    assert len(loads) == 1
+
+    path.write('bar!')
+    assert cache.get(str(path), load) == 'bar!'
+    assert len(loads) == 2
+
+    cache.clear()
+    assert cache.get(str(path), load) == 'bar!'
+    assert len(loads) == 3
+
+
+def test_file_cache_missing(tmpdir):
+    path = str(tmpdir.join('missing.ini'))
+    cache = FileCache()
+    assert cache.get(path, os.path.exists) is False
+    assert len(cache) == 0
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import pytest
+from PyQt5.QtCore import QSize
+from PyQt5.QtWebKitWidgets import QWebPage
+
+from splash.engines.webkit.screenshot import QtWebkitScreenshotRenderer
+from splash.image_encoding import encode_image
+from splash.log import DummyLogger
+from splash.qtrender_image import EncodedImage
+from splash.qtutils import init_qt_app
+from splash.raw_image import raw_image_to_pil
+
+
+TALL_PAGE_HEIGHT = 40000
+
+
+@pytest.fixture(scope='module')
+def tall_page():
+    app = init_qt_app(verbose=False)
+    page = QWebPage()
+    page.setViewportSize(QSize(100, 100))
+    page.mainFrame().setHtml(
+        '<html><body style="margin: 0">'
+        '<div style="width: 100px; height: %dpx; background: red"></div>'
+        '</body></html>' % TALL_PAGE_HEIGHT)
+    app.processEvents()
+    # the same as render_all=1
+    page.setViewportSize(page.mainFrame().contentsSize())
+    return page
+
+
+def _renderer(page, image_format='PNG'):
+    return QtWebkitScreenshotRenderer(page, DummyLogger(), image_format)
+
+
+def test_tall_png_is_streamed(tall_page):
+    image = _renderer(tall_page).render_qwebpage()
+    assert isinstance(image, EncodedImage)
+
+
+@pytest.mark.parametrize(['image_format', 'pixel_format'], [
+    ('PNG', 'RGBA'),
+    ('JPEG', 'RGB'),
+])
+def test_tall_raw_is_not_encoded(tall_page, monkeypatch, image_format,
+                                 pixel_format):
+    def to_raw(*args, **kwargs):
+        raise AssertionError("raw screenshot went through PNG encoder")
+    monkeypatch.setattr(EncodedImage, 'to_raw', to_raw)
+
+    image = _renderer(tall_page, image_format).render_qwebpage(stream=False)
+    data = encode_image(image, 'RAW', pixel_format=pixel_format)
+    img = raw_image_to_pil(data)
+    assert img.mode == pixel_format
+    assert img.size == (100, TALL_PAGE_HEIGHT)
+    assert img.getpixel((50, TALL_PAGE_HEIGHT - 1))[:3] == (255, 0, 0)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import pytest
+from PIL import Image, ImageChops
+
+from splash.raw_image import (
+    RAW_HEADER,
+    encode_raw_image,
+    raw_image_to_pil,
+    unpack_raw_image,
+)
+
+
+def _sample_image(mode, size):
+    img = Image.new(mode, size)
+    img.putdata([
+        (x * 7 % 256, y * 5 % 256, (x + y) % 256, 200)[:len(mode)]
+        for y in range(size[1]) for x in range(size[0])
+    ])
+    return img
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA'])
+def test_roundtrip(mode):
+    img = _sample_image(mode, (13, 7))
+    data = encode_raw_image(img, mode)
+    assert len(data) == RAW_HEADER.size + 13 * 7 * len(mode)
+    width, height, stride, pixel_format, pixels = unpack_raw_image(data)
+    assert (width, height, stride) == (13, 7, 13 * len(mode))
+    assert pixel_format == mode
+    assert bytes(pixels[:len(mode)]) == bytes(img.getpixel((0, 0)))
+    assert ImageChops.difference(raw_image_to_pil(data), img).getbbox() is None
+
+
+def test_convert():
+    img = _sample_image('RGBA', (4, 3))
+    res = raw_image_to_pil(encode_raw_image(img, 'RGB'))
+    assert res.mode == 'RGB'
+    assert ImageChops.difference(res, img.convert('RGB')).getbbox() is None
+
+
+def test_downsample():
+    img = Image.new('RGB', (10, 5), (255, 255, 255))
+    img.paste((0, 0, 0), (0, 0, 2, 2))
+    res = raw_image_to_pil(encode_raw_image(img, 'RGB', downsample=2))
+    assert res.size == (5, 3)
+    assert res.getpixel((0, 0)) == (0, 0, 0)
+    assert res.getpixel((1, 0)) == (255, 255, 255)
+
+
+def test_invalid():
+    img = _sample_image('RGB', (2, 2))
+    with pytest.raises(ValueError):
+        encode_raw_image(img, 'L')
+    with pytest.raises(ValueError):
+        encode_raw_image(img, 'RGB', downsample=0)
+    data = encode_raw_image(img, 'RGB')
+    with pytest.raises(ValueError):
+        unpack_raw_image(data[:-1])
+    with pytest.raises(ValueError):
+        unpack_raw_image(b"PNG" + data[3:])
+    with pytest.raises(ValueError):
+        unpack_raw_image(data[:10])
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from array import array
+import json
+import time
+import signal
 import unittest
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from io import BytesIO
 from urllib.parse import urlencode, urljoin
@@ -11,7 +15,9 @@ import requests
 from PIL import Image, ImageChops
 
 from splash import defaults
+from splash.metrics import parse_samples
 from splash.qtutils import has_min_qt_version
+from splash.raw_image import RAW_CONTENT_TYPE, raw_image_to_pil
 from splash.utils import truncated
 from splash.tests.utils import NON_EXISTING_RESOLVABLE, SplashServer
 
@@ -120,6 +126,17 @@ class BaseRenderTest(unittest.TestCase):
             self.assertEqual(img.size[1], height)
         return img
 
+    def assertWebp(self, response, width=None, height=None):
+        self.assertStatusCode(response, 200)
+        self.assertEqual(response.headers["content-type"], "image/webp")
+        img = Image.open(BytesIO(response.content))
+        self.assertEqual(img.format, "WEBP")
+        if width is not None:
+            self.assertEqual(img.size[0], width)
+        if height is not None:
+            self.assertEqual(img.size[1], height)
+        return img
+
     def assertPixelColor(self, response, x, y, color):
         img = Image.open(BytesIO(response.content))
         self.assertEqual(color, img.getpixel((x, y)))
@@ -164,10 +181,37 @@ class Base(object):
             r = self.request({"url": self.mockurl("delay?n=10"), "timeout": "0.5"})
             self.assertStatusCode(r, 504)
 
+        def test_render_timeout(self):
+            r = self.request({"url": self.mockurl("delay?n=10"),
+                              "render_timeout": "0.5"})
+            self.assertJsonError(r, 504, "RenderTimeoutError")
+
+        def test_queue_and_render_timeout_out_of_range(self):
+            for name in ["queue_timeout", "render_timeout"]:
+                r = self.request({"url": self.mockurl("jsrender"),
+                                  "timeout": "5", name: "10"})
+                self.assertBadArgument(r, name)
+
         def test_timeout_out_of_range(self):
             r = self.request({"url": self.mockurl("delay?n=10"), "timeout": "999"})
             self.assertStatusCode(r, 400)
 
+        def test_priority(self):
+            for priority in ["-5", "10"]:
+                r = self.request({"url": self.mockurl("jsrender"),
+                                  "priority": priority,
+                                  "client_id": "test"})
+                self.assertStatusCode(r, 200)
+
+            r = self.request({"url": self.mockurl("jsrender")},
+                             headers={"X-Splash-Client-Id": "test"})
+            self.assertStatusCode(r, 200)
+
+            for priority in ["foo", "1000"]:
+                r = self.request({"url": self.mockurl("jsrender"),
+                                  "priority": priority})
+                self.assertBadArgument(r, "priority")
+
         def test_missing_url(self):
             r = self.request({})
             self.assertStatusCode(r, 400)
@@ -593,6 +637,23 @@ Tiling is enabled in raster mode when any dimension of the viewport reaches
             img = self.assertPng(r, width=99, height=height)
             self.assertImagesEqual(full_img.crop((0, 0, 99, height)), img)
 
+    def test_height_parameter_is_equivalent_to_cropping_downscale(self):
+        # integer (box reduction) and fractional scale factors
+        for width in (320, 300):
+            query0 = {'url': self.mockurl('rgb-stripes'), 'width': width,
+                      'viewport': '1280x960'}
+            r = self.request(query0)
+            full_height = round(960 * width / 1280)
+            full_img = self.assertPng(r, width=width, height=full_height)
+
+            for height in (1, 7, 100, full_height - 1, full_height + 10):
+                query = query0.copy()
+                query['height'] = height
+                r = self.request(query)
+                img = self.assertPng(r, width=width, height=height)
+                self.assertImagesEqual(
+                    full_img.crop((0, 0, width, height)), img)
+
 
 class RenderJsonTest(Base.RenderTest):
 
@@ -658,6 +719,49 @@ class RenderJsonTest(Base.RenderTest):
                            {"viewport": "100x100", "width": 200,
                             "scale_method": "vector"})
 
+    def test_screenshots(self):
+        screenshots = [
+            {'format': 'png'},
+            {'format': 'jpeg', 'width': 100},
+            {'format': 'webp', 'region': [0, 0, 50, 40], 'lossless': True},
+            {'format': 'png', 'selector': '#no-such-element'},
+        ]
+        res = self.request({'url': self.mockurl("jsrender"),
+                            'viewport': '400x300', 'png': 1,
+                            'screenshots': json.dumps(screenshots)}).json()
+        png, jpeg, webp, missing = res['screenshots']
+        self.assertIsNone(missing)
+        for info, fmt, size in [(png, 'PNG', (400, 300)),
+                                (jpeg, 'JPEG', (100, 75)),
+                                (webp, 'WEBP', (50, 40))]:
+            img = Image.open(BytesIO(base64.b64decode(info['data'])))
+            self.assertEqual((img.format, img.size), (fmt, size))
+            self.assertEqual((info['width'], info['height']), size)
+
+        # screenshots are the same as images rendered separately
+        png_img = Image.open(BytesIO(base64.b64decode(png['data'])))
+        full_png = Image.open(BytesIO(base64.b64decode(res['png'])))
+        self.assertIsNone(ImageChops.difference(png_img, full_png).getbbox())
+
+    def test_screenshots_png_jpeg(self):
+        # png and jpeg are derived from a single rendering
+        query = {'url': self.mockurl("jsrender"), 'width': 100}
+        res = self.request(dict(query, png=1, jpeg=1)).json()
+        jpeg = Image.open(BytesIO(base64.b64decode(res['jpeg'])))
+        self.assertEqual((jpeg.format, jpeg.size[0]), ('JPEG', 100))
+        png = Image.open(BytesIO(base64.b64decode(res['png'])))
+        r = self.request(query, endpoint='render.png')
+        expected = self.assertPng(r, width=100)
+        self.assertIsNone(ImageChops.difference(png, expected).getbbox())
+
+    def test_screenshots_bad_arguments(self):
+        for screenshots in ['{}', '[]', 'foo', '[{"format": "gif"}]',
+                            '[{"width": -1}]',
+                            '[{"selector": "div", "region": [0, 0, 1, 1]}]']:
+            r = self.request({'url': self.mockurl("jsrender"),
+                              'screenshots': screenshots})
+            self.assertBadArgument(r, 'screenshots')
+
     @https_only
     def test_fields_all(self):
         query = {'url': self.ts.mockserver.https_url("iframes"),
@@ -920,6 +1024,86 @@ class IframesRenderTest(BaseRenderTest):
         return self.request(query).json()
 
 
+class RenderBatchTest(BaseRenderTest):
+    endpoint = "render.batch"
+
+    def batch_items(self, jobs, **query):
+        """ Return results in the order they were received """
+        resp = self.post(query, payload=json.dumps(jobs),
+                         headers={'content-type': 'application/json'})
+        self.assertStatusCode(resp, 200)
+        self.assertEqual(resp.headers['content-type'], 'application/x-ndjson')
+        lines = resp.text.splitlines()
+        self.assertEqual(len(lines), len(jobs))
+        return [json.loads(line) for line in lines]
+
+    def batch(self, jobs, **query):
+        return {item['id']: item for item in self.batch_items(jobs, **query)}
+
+    def test_endpoints(self):
+        results = self.batch([
+            {'id': 'html', 'url': self.mockurl("jsrender")},
+            {'id': 'png', 'endpoint': 'png', 'url': self.mockurl("jsrender"),
+             'width': 100},
+            {'id': 'jpeg', 'endpoint': 'render.jpeg',
+             'url': self.mockurl("jsrender")},
+            {'id': 'json', 'endpoint': 'json', 'url': self.mockurl("jsrender"),
+             'html': 1},
+            {'id': 'har', 'endpoint': 'har', 'url': self.mockurl("jsrender")},
+        ])
+        for item in results.values():
+            self.assertEqual(item['status'], 200, item)
+        self.assertIn("After", results['html']['result'])
+        png = Image.open(BytesIO(base64.b64decode(results['png']['result'])))
+        self.assertEqual(png.format, "PNG")
+        self.assertEqual(png.size[0], 100)
+        jpeg = Image.open(BytesIO(base64.b64decode(results['jpeg']['result'])))
+        self.assertEqual(jpeg.format, "JPEG")
+        self.assertIn("After", results['json']['result']['html'])
+        self.assertEqual(len(results['har']['result']['log']['entries']), 1)
+
+    def test_completion_order_and_errors(self):
+        items = self.batch_items([
+            {'url': self.mockurl("delay?n=1")},
+            {'url': self.mockurl("jsrender")},
+            {'url': self.mockurl("delay?n=2"), 'timeout': 0.5},
+            {'endpoint': 'foo', 'url': self.mockurl("jsrender")},
+            {'wait': 'bar', 'url': self.mockurl("jsrender")},
+        ])
+        order = [item['id'] for item in items]
+        # results are streamed as they complete, not in the job order
+        self.assertLess(order.index(1), order.index(0))
+        self.assertLess(order.index(2), order.index(0))
+        self.assertEqual(order[-1], 0)
+        results = {item['id']: item for item in items}
+        self.assertEqual(results[0]['status'], 200)
+        self.assertEqual(results[1]['status'], 200)
+        self.assertEqual(results[2]['status'], 504)
+        self.assertEqual(results[2]['error']['type'], 'GlobalTimeoutError')
+        self.assertEqual(results[3]['status'], 400)
+        self.assertEqual(results[3]['error']['info']['argument'], 'endpoint')
+        self.assertEqual(results[4]['status'], 400)
+        self.assertEqual(results[4]['error']['info']['argument'], 'wait')
+
+    def test_query_defaults(self):
+        results = self.batch([
+            {'id': 1, 'url': self.mockurl("delay?n=2")},
+            {'id': 2, 'url': self.mockurl("delay?n=2"), 'timeout': 5},
+        ], timeout=0.5)
+        self.assertEqual(results[1]['status'], 504)
+        self.assertEqual(results[2]['status'], 200)
+
+    def test_invalid_body(self):
+        headers = {'content-type': 'application/json'}
+        resp = self.post({}, payload='{"url": "http://example.com"}',
+                         headers=headers)
+        self.assertJsonError(resp, 400, "BadOption")
+        resp = self.post({}, payload='[{', headers=headers)
+        self.assertJsonError(resp, 400, "BadOption")
+        resp = self.request({'url': self.mockurl("jsrender")})
+        self.assertStatusCode(resp, 405)
+
+
 class CommandLineOptionsTest(BaseRenderTest):
 
     def test_max_timeout(self):
@@ -967,6 +1151,300 @@ class CommandLineOptionsTest(BaseRenderTest):
             )
             self.assertStatusCode(resp, 200)
 
+    def _wait_for_spare_tab(self, splash):
+        # tabs are reset asynchronously after a response is sent
+        for _ in range(50):
+            tabs = requests.get(splash.url("_debug")).json()['tabs']
+            if tabs['spare']:
+                return tabs
+            time.sleep(0.1)
+        self.fail("tab is not reset")
+
+    def test_reuse_tabs(self):
+        with SplashServer(extra_args=['--reuse-tabs', '--slots', '1']) as splash:
+            def render_json(url, **params):
+                self._wait_for_spare_tab(splash)
+                params.update(url=url, html=1, har=1)
+                resp = requests.get(splash.url("render.json"), params=params)
+                self.assertStatusCode(resp, 200)
+                return resp.json()
+
+            resp = requests.get(splash.url("render.html"),
+                                params={'url': self.mockurl("jsrender")})
+            self.assertStatusCode(resp, 200)
+            for i in range(3):
+                data = render_json(
+                    self.mockurl("set-cookie?key=foo&value=bar"),
+                    viewport="300x400",
+                )
+                self.assertEqual(len(data['har']['log']['entries']), 1)
+                self.assertEqual(data['geometry'], [0, 0, 300, 400])
+
+                data = render_json(self.mockurl("get-cookie?key=foo"))
+                self.assertNotIn("bar", data['html'])
+                self.assertEqual(len(data['har']['log']['entries']), 1)
+                self.assertEqual(data['geometry'], [0, 0, 1024, 768])
+
+            tabs = requests.get(splash.url("_debug")).json()['tabs']
+            self.assertEqual(tabs['reused'], 6)
+
+    def test_reuse_tabs_storage(self):
+        extra_args = ['--reuse-tabs', '--slots', '1', '--disable-private-mode']
+        with SplashServer(extra_args=extra_args) as splash:
+            def render_json(js_source):
+                resp = requests.get(splash.url("render.json"), params={
+                    'url': self.mockurl("jsrender"),
+                    'js_source': js_source,
+                    'script': 1,
+                })
+                self.assertStatusCode(resp, 200)
+                return resp.json()
+
+            render_json("sessionStorage.setItem('foo', 'session'); "
+                        "localStorage.setItem('foo', 'local');")
+            reused = self._wait_for_spare_tab(splash)['reused']
+            data = render_json("[sessionStorage.getItem('foo'), "
+                               "localStorage.getItem('foo')]")
+            self.assertEqual(data['script'], [None, None])
+            tabs = requests.get(splash.url("_debug")).json()['tabs']
+            self.assertEqual(tabs['reused'], reused + 1)
+
+    def test_max_queue_size(self):
+        extra_args = ['--slots', '1', '--max-queue-size', '1']
+        with SplashServer(extra_args=extra_args) as splash:
+            def render(n):
+                return requests.get(
+                    url=splash.url("render.html"),
+                    params={'url': self.mockurl("delay?n=%s" % n)},
+                )
+
+            with ThreadPoolExecutor(2) as executor:
+                rendering = executor.submit(render, 2)
+                time.sleep(0.5)
+                queued = executor.submit(render, 0.1)
+                time.sleep(0.5)
+                resp = render(0.1)
+                data = self.assertJsonError(resp, 503, "OverloadedError")
+                self.assertEqual(data['info']['reason'], 'max_queue_size')
+                self.assertGreaterEqual(int(resp.headers['Retry-After']), 1)
+                self.assertStatusCode(rendering.result(), 200)
+                self.assertStatusCode(queued.result(), 200)
+
+            self.assertStatusCode(render(0.1), 200)
+
+    def test_queue_timeout(self):
+        with SplashServer(extra_args=['--slots', '1']) as splash:
+            def render(n, **params):
+                params['url'] = self.mockurl("delay?n=%s" % n)
+                return requests.get(splash.url("render.html"), params=params)
+
+            with ThreadPoolExecutor(1) as executor:
+                rendering = executor.submit(render, 2, render_timeout=5)
+                time.sleep(0.5)
+                resp = render(0.1, queue_timeout=0.5, render_timeout=1)
+                self.assertJsonError(resp, 503, "QueueTimeoutError")
+                self.assertGreaterEqual(int(resp.headers['Retry-After']), 1)
+                self.assertStatusCode(rendering.result(), 200)
+
+            resp = render(0.1, queue_timeout=0.5, render_timeout=1)
+            self.assertStatusCode(resp, 200)
+
+    def test_workers(self):
+        with SplashServer(extra_args=['--workers', '2', '--slots', '1']) as splash:
+            def render(n):
+                return requests.get(
+                    url=splash.url("render.html"),
+                    params={'url': self.mockurl("delay?n=%s" % n)},
+                )
+
+            def get_pid():
+                return requests.get(splash.url("_debug")).json()['pid']
+
+            self.assertNotIn(splash.proc.pid, {get_pid() for _ in range(10)})
+            with ThreadPoolExecutor(4) as executor:
+                results = list(executor.map(render, [0.5] * 4))
+            for resp in results:
+                self.assertStatusCode(resp, 200)
+
+            # workers are restarted one by one on SIGHUP;
+            # requests shouldn't fail meanwhile
+            pids = {get_pid() for _ in range(10)}
+            splash.proc.send_signal(signal.SIGHUP)
+            start_time = time.time()
+            while time.time() - start_time < 5:
+                self.assertStatusCode(render(0.1), 200)
+            self.assertFalse(pids & {get_pid() for _ in range(10)})
+
+    # keeps ~80MB allocated until the tab is closed
+    ALLOCATE_JS = "window.allocated = new Array(10 * 1024 * 1024).fill(1.5);"
+
+    def test_render_rss_threshold(self):
+        extra_args = ['--render-rss-threshold', '10', '--reuse-tabs']
+        with SplashServer(extra_args=extra_args) as splash:
+            for _ in range(2):
+                resp = requests.get(
+                    url=splash.url("render.html"),
+                    params={'url': self.mockurl("jsrender"),
+                            'js_source': self.ALLOCATE_JS},
+                )
+                self.assertStatusCode(resp, 200)
+            time.sleep(0.5)
+            debug = requests.get(splash.url("_debug")).json()
+            self.assertEqual(
+                debug['rss_delta_by_host']['localhost']['renders'], 2)
+            self.assertEqual(debug['memory_outliers'], 2)
+            # tabs of outliers are closed instead of being reused
+            self.assertEqual(debug['tabs']['spare'], 0)
+            self.assertEqual(debug['tabs']['reused'], 0)
+
+            resp = requests.get(
+                url=splash.url("render.html"),
+                params={'url': self.mockurl("jsrender")},
+            )
+            self.assertStatusCode(resp, 200)
+            debug = requests.get(splash.url("_debug")).json()
+            self.assertEqual(debug['memory_outliers'], 2)
+
+    def test_render_rss_action_restart(self):
+        extra_args = ['--render-rss-threshold', '10',
+                      '--render-rss-action', 'restart']
+        with SplashServer(extra_args=extra_args) as splash:
+            resp = requests.get(
+                url=splash.url("render.html"),
+                params={'url': self.mockurl("jsrender"),
+                        'js_source': self.ALLOCATE_JS},
+            )
+            self.assertStatusCode(resp, 200)
+            # the server drains and exits, like when --maxrss is exceeded
+            self.assertEqual(splash.proc.wait(timeout=10), 0)
+
+    def test_image_encoding_threads(self):
+        extra_args = ['--image-encoding-threads', '2']
+        with SplashServer(extra_args=extra_args) as splash:
+            resp = requests.get(
+                url=splash.url("render.png"),
+                params={'url': self.mockurl("jsrender"), 'width': 100},
+            )
+            self.assertStatusCode(resp, 200)
+            self.assertEqual(Image.open(BytesIO(resp.content)).size[0], 100)
+
+            resp = requests.get(
+                url=splash.url("render.json"),
+                params={'url': self.mockurl("jsrender"),
+                        'png': 1, 'jpeg': 1, 'html': 1},
+            )
+            self.assertStatusCode(resp, 200)
+            data = resp.json()
+            self.assertIn('html', data)
+            for key, fmt in [('png', 'PNG'), ('jpeg', 'JPEG')]:
+                img = Image.open(BytesIO(base64.b64decode(data[key])))
+                self.assertEqual(img.format, fmt)
+
+            resp = requests.post(
+                url=splash.url("execute"),
+                json={
+                    'url': self.mockurl("jsrender"),
+                    'lua_source': """
+                    function main(splash)
+                        assert(splash:go(splash.args.url))
+                        local png = splash:png()
+                        local el = splash:select('p')
+                        return {png=png, el=el:jpeg(), len=#png}
+                    end
+                    """
+                },
+            )
+            self.assertStatusCode(resp, 200)
+            data = resp.json()
+            self.assertGreater(data['len'], 0)
+            self.assertEqual(Image.open(BytesIO(
+                base64.b64decode(data['el']))).format, 'JPEG')
+
+    def test_screenshot_cache(self):
+        extra_args = ['--screenshot-cache-size', '10']
+        with SplashServer(extra_args=extra_args) as splash:
+            def get_png(**params):
+                params.setdefault('url', self.mockurl("jsrender"))
+                resp = requests.get(splash.url("render.png"), params=params)
+                self.assertStatusCode(resp, 200)
+                return resp.content
+
+            def cache_stats():
+                return requests.get(splash.url("_debug")).json()['screenshot_cache']
+
+            png1 = get_png()
+            self.assertEqual(cache_stats()['entries'], 1)
+            png2 = get_png()
+            self.assertEqual(png1, png2)
+            self.assertEqual(cache_stats()['hits'], 1)
+
+            # different image parameters or page content
+            get_png(width=100)
+            get_png(url=self.mockurl("iframes"))
+            stats = cache_stats()
+            self.assertEqual(stats['hits'], 1)
+            self.assertEqual(stats['entries'], 3)
+
+            # the same page rendered with different webpage options
+            url = self.mockurl("subresources-with-caching")
+            get_png(url=url, images=1)
+            get_png(url=url, images=0)
+            stats = cache_stats()
+            self.assertEqual(stats['hits'], 1)
+            self.assertEqual(stats['entries'], 5)
+
+            resp = requests.post(splash.url("_gc"))
+            self.assertEqual(resp.json()['cached_screenshots_removed'], 5)
+
+    def test_http_cache(self):
+        extra_args = ['--http-cache-size', '10']
+        with SplashServer(extra_args=extra_args) as splash:
+            def fetch_image(http_cache=1, name="img.gif", headers=None):
+                resp = requests.post(splash.url("execute"), json={
+                    'lua_source': """
+                    function main(splash, args)
+                        splash.http_cache_enabled = args.http_cache == 1
+                        local resp = splash:http_get{args.url,
+                                                     headers=args.headers}
+                        return resp.status
+                    end
+                    """,
+                    'url': self.mockurl("subresources-with-caching/" + name),
+                    'http_cache': http_cache,
+                    'headers': headers or {},
+                })
+                self.assertStatusCode(resp, 200)
+
+            def cache_requests():
+                samples = parse_samples(
+                    requests.get(splash.url("metrics")).text)
+                return {
+                    result: samples.get(
+                        ("splash_http_cache_requests_total",
+                         (("result", result),)), 0)
+                    for result in ("hit", "miss")
+                }
+
+            fetch_image()
+            self.assertEqual(cache_requests(), {"hit": 0, "miss": 1})
+            fetch_image()
+            self.assertEqual(cache_requests(), {"hit": 1, "miss": 1})
+
+            # the cache is not used when it is disabled for a render
+            fetch_image(http_cache=0)
+            self.assertEqual(cache_requests(), {"hit": 1, "miss": 1})
+
+            # private responses are not shared between renders
+            fetch_image(name="private.gif")
+            fetch_image(name="private.gif")
+            self.assertEqual(cache_requests(), {"hit": 1, "miss": 3})
+
+            # responses to requests with credentials are not stored
+            url = "img.gif?auth=1"
+            fetch_image(name=url, headers={'Authorization': 'Basic Zm9vOmJhcg=='})
+            fetch_image(name=url)
+            self.assertEqual(cache_requests(), {"hit": 1, "miss": 5})
+
     def test_browser_engines_invalid(self):
         with pytest.raises(RuntimeError) as e:
             with SplashServer(extra_args=['--browser-engines', 'foo']) as splash:
@@ -992,6 +1470,19 @@ class TestTestSetup(unittest.TestCase):
         r = requests.get('http://localhost:%s/_ping' % self.ts.splashserver.portnum)
         self.assertEqual(r.status_code, 200)
 
+    def test_splashserver_metrics(self):
+        port = self.ts.splashserver.portnum
+        requests.get('http://localhost:%s/render.html' % port,
+                     params={'url': self.ts.mockserver.url("jsrender")})
+        r = requests.get('http://localhost:%s/metrics' % port)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.headers['content-type'].startswith('text/plain'))
+        self.assertIn('splash_requests_total{endpoint="render.html",'
+                      'engine="webkit",status="200"}', r.text)
+        self.assertIn('splash_render_duration_seconds_count{'
+                      'endpoint="render.html",engine="webkit"}', r.text)
+        self.assertIn('splash_active_slots ', r.text)
+
 
 class RenderJpegTest(Base.RenderTest):
 
@@ -1140,6 +1631,94 @@ class RenderJpegTest(Base.RenderTest):
             self.assertStatusCode(r, 400)
 
 
+class RenderWebpTest(BaseRenderTest):
+
+    endpoint = "render.webp"
+
+    def test_ok(self):
+        r = self.request({"url": self.mockurl("jsrender")})
+        w, h = map(int, defaults.VIEWPORT_SIZE.split('x'))
+        self.assertWebp(r, width=w, height=h)
+
+    def test_width_height(self):
+        r = self.request({"url": self.mockurl("jsrender"), "width": "300",
+                          "height": "100"})
+        self.assertWebp(r, width=300, height=100)
+
+    def test_lossless(self):
+        r = self.request({'url': self.mockurl("show-image"),
+                          'viewport': '100x100', 'lossless': 1})
+        self.assertWebp(r, width=100, height=100)
+        img = Image.open(BytesIO(r.content)).convert('RGB')
+        self.assertEqual(img.getpixel((30, 30)), (0, 0, 0))
+        self.assertEqual(img.getpixel((99, 99)), (255, 255, 255))
+
+    def test_smaller_than_lossless(self):
+        url = self.mockurl("jsrender")
+        lossy = self.request({"url": url, "quality": 30})
+        lossless = self.request({"url": url, "lossless": 1})
+        self.assertWebp(lossy)
+        self.assertWebp(lossless)
+        self.assertLess(len(lossy.content), len(lossless.content))
+
+    def test_range_checks(self):
+        for arg, val in [('quality', -1), ('quality', 101), ('method', 7),
+                         ('method', -1)]:
+            r = self.request({"url": self.mockurl("jsrender"), arg: val})
+            self.assertBadArgument(r, arg)
+
+
+class RenderRawTest(BaseRenderTest):
+
+    def assertRaw(self, response, mode, width=None, height=None):
+        self.assertStatusCode(response, 200)
+        self.assertEqual(response.headers["content-type"], RAW_CONTENT_TYPE)
+        img = raw_image_to_pil(response.content)
+        self.assertEqual(img.mode, mode)
+        if width is not None:
+            self.assertEqual(img.size[0], width)
+        if height is not None:
+            self.assertEqual(img.size[1], height)
+        return img
+
+    def test_png(self):
+        url = self.mockurl("show-image")
+        r = self.request({'url': url, 'viewport': '100x100'},
+                         endpoint="render.png")
+        png = self.assertPng(r)
+        r = self.request({'url': url, 'viewport': '100x100',
+                          'format': 'raw'}, endpoint="render.png")
+        img = self.assertRaw(r, 'RGBA', 100, 100)
+        self.assertIsNone(
+            ImageChops.difference(img, png.convert("RGBA")).getbbox())
+
+    def test_jpeg(self):
+        r = self.request({'url': self.mockurl("show-image"),
+                          'viewport': '100x100', 'format': 'raw'},
+                         endpoint="render.jpeg")
+        img = self.assertRaw(r, 'RGB', 100, 100)
+        self.assertEqual(img.getpixel((30, 30)), (0, 0, 0))
+        self.assertEqual(img.getpixel((99, 99)), (255, 255, 255))
+
+    def test_downsample(self):
+        r = self.request({'url': self.mockurl("jsrender"), 'width': 300,
+                          'height': 100, 'format': 'raw', 'downsample': 4},
+                         endpoint="render.png")
+        self.assertRaw(r, 'RGBA', 75, 25)
+
+    def test_invalid_arguments(self):
+        url = self.mockurl("jsrender")
+        for endpoint, query, argname in [
+            ("render.png", {'format': 'jpeg'}, 'format'),
+            ("render.jpeg", {'format': 'png'}, 'format'),
+            ("render.png", {'downsample': 2}, 'downsample'),
+            ("render.png", {'format': 'raw', 'downsample': 0}, 'downsample'),
+        ]:
+            query['url'] = url
+            r = self.request(query, endpoint=endpoint)
+            self.assertBadArgument(r, argname)
+
+
 class InvalidEngineNameRequestHandler(DirectRequestHandler):
     engine = 'invalid'
 
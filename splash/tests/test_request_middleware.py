@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from splash.request_middleware import (
+    AdblockRulesRegistry,
+    HostMatcher,
+    get_host_matcher,
+)
+
+
+@pytest.mark.parametrize(['host', 'allow_subdomains', 'match'], [
+    ('example.com', True, True),
+    ('EXAMPLE.com', True, True),
+    ('www.example.com', True, True),
+    ('a.b.example.com', True, True),
+    ('foo.org', True, True),
+    ('badexample.com', True, False),
+    ('example.com.evil.org', True, False),
+    ('com', True, False),
+    ('', True, False),
+    ('example.com', False, True),
+    ('www.example.com', False, False),
+])
+def test_host_matcher(host, allow_subdomains, match):
+    matcher = HostMatcher(['example.com', 'foo.org'], allow_subdomains)
+    assert matcher.match(host) is match
+
+
+def test_host_matcher_cached():
+    matcher = get_host_matcher(('example.com', 'foo.org'))
+    assert get_host_matcher(('example.com', 'foo.org')) is matcher
+    assert get_host_matcher(('example.com',)) is not matcher
+
+
+class AdblockRulesReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import adblockparser
+        except ImportError:
+            raise unittest.SkipTest("adblockparser is not installed")
+        self.path = self.mktemp()
+        os.mkdir(self.path)
+
+    def write(self, fname, text, mtime=None):
+        fpath = os.path.join(self.path, fname)
+        with open(fpath, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(fpath, (mtime, mtime))
+
+    @defer.inlineCallbacks
+    def test_reload(self):
+        self.write('ads.txt', '||ads.example.com^\n')
+        rules = AdblockRulesRegistry(self.path)
+        url = 'http://ads.example.com/foo'
+        self.assertEqual(rules.get_blocking_filter(['ads'], url, {}), 'ads')
+        reloaded = yield rules.reload()
+        self.assertFalse(reloaded)
+
+        self.write('ads.txt', '||ads.example.org^\n', mtime=time.time() + 10)
+        self.write('scripts.txt', '/script.js\n')
+        d = rules.reload()
+        # old filters are used until new ones are loaded
+        self.assertEqual(rules.get_blocking_filter(['ads'], url, {}), 'ads')
+        reloaded = yield d
+        self.assertTrue(reloaded)
+        self.assertEqual(rules.filters, {'ads': 1, 'scripts': 1})
+        self.assertIsNone(rules.get_blocking_filter(['ads'], url, {}))
+        self.assertEqual(rules.get_blocking_filter(
+            ['ads'], 'http://ads.example.org/foo', {}), 'ads')
+
+        os.remove(os.path.join(self.path, 'scripts.txt'))
+        reloaded = yield rules.reload()
+        self.assertTrue(reloaded)
+        self.assertEqual(rules.filters, {'ads': 1})
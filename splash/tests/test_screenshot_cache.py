@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+
+from splash.screenshot_cache import ScreenshotCache
+
+
+def test_lru():
+    cache = ScreenshotCache(max_size=10)
+    assert cache.enabled
+    cache.put('a', b'1234', (1, 2))
+    cache.put('b', b'1234', (1, 2))
+    assert cache.get('a') == (b'1234', (1, 2))
+    cache.put('c', b'1234', (1, 2))  # 'b' is evicted
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    stats = cache.stats()
+    assert stats['entries'] == 2
+    assert stats['size'] == 8
+    assert stats['hits'] == 3
+    assert stats['misses'] == 1
+
+
+def test_disabled():
+    cache = ScreenshotCache()
+    assert not cache.enabled
+    cache.put('a', b'1', (1, 1))
+    assert cache.get('a') is None
+
+
+def test_too_large():
+    cache = ScreenshotCache(max_size=3)
+    cache.put('a', b'1234', (1, 1))
+    assert cache.get('a') is None
+
+
+def test_disk(tmpdir):
+    cache = ScreenshotCache(max_size=10, disk_path=str(tmpdir),
+                            max_disk_size=10)
+    try:
+        cache.put('a', b'12345', (1, 1))
+        cache.put('b', b'12345', (2, 2))
+        cache.put('c', b'12345', (3, 3))  # 'a' is moved to disk
+        stats = cache.stats()
+        assert stats['entries'] == 2
+        assert stats['disk_entries'] == 1
+        assert len(os.listdir(cache.disk_path)) == 1
+
+        # 'a' is moved back to memory, 'b' is moved to disk
+        assert cache.get('a') == (b'12345', (1, 1))
+        assert cache.get('b') == (b'12345', (2, 2))
+        assert cache.get('c') == (b'12345', (3, 3))
+
+        cache.put('d', b'12345', (4, 4))
+        cache.put('e', b'12345', (5, 5))
+        cache.put('f', b'12345', (6, 6))
+        # disk limit is exceeded, the oldest entries are removed
+        assert cache.stats()['disk_size'] <= 10
+        assert cache.get('b') is None
+
+        cache.clear()
+        assert cache.stats()['disk_entries'] == 0
+        assert os.listdir(cache.disk_path) == []
+    finally:
+        path = cache.disk_path
+        cache.close()
+    assert not os.path.exists(path)
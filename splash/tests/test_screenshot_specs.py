@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from splash.screenshot_specs import ScreenshotSpec, parse_screenshot_spec
+
+
+def test_defaults():
+    spec = parse_screenshot_spec({})
+    assert spec == ScreenshotSpec()
+    assert spec.content_type == 'image/png'
+    assert spec.encoder_args() == ('PNG', {})
+    assert not spec.is_rgb
+
+
+@pytest.mark.parametrize(['data', 'renderer_format', 'encoder_args'], [
+    ({'format': 'jpeg', 'quality': 50}, 'JPEG', ('JPEG', {'quality': 50})),
+    ({'format': 'webp', 'lossless': True}, 'WEBP',
+     ('WEBP', {'quality': 80, 'lossless': True, 'method': 4})),
+    ({'format': 'raw', 'pixel_format': 'RGB', 'downsample': 2}, 'JPEG',
+     ('RAW', {'pixel_format': 'RGB', 'downsample': 2})),
+    ({'format': 'raw'}, 'PNG',
+     ('RAW', {'pixel_format': 'RGBA', 'downsample': 1})),
+])
+def test_formats(data, renderer_format, encoder_args):
+    spec = parse_screenshot_spec(data)
+    assert spec.renderer_format == renderer_format
+    assert spec.encoder_args() == encoder_args
+
+
+@pytest.mark.parametrize('region', [
+    [10, 20, 30, 40],
+    {1: 10, 2: 20, 3: 30, 4: 40},
+    {'left': 10, 'top': 20, 'right': 30, 'bottom': 40, 'width': 20},
+])
+def test_region(region):
+    spec = parse_screenshot_spec({'region': region, 'pad': 5})
+    assert spec.region == (10, 20, 30, 40)
+    assert spec.get_region(spec.region) == (5, 15, 35, 45)
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    {'format': 'gif'},
+    {'width': 0},
+    {'width': 'wide'},
+    {'quality': 101},
+    {'method': 7},
+    {'downsample': 100},
+    {'pixel_format': 'L'},
+    {'region': [1, 2, 3]},
+    {'selector': 5},
+    {'selector': 'div', 'region': [0, 0, 10, 10]},
+    {'selector': 'div', 'height': 100},
+    {'foo': 'bar'},
+])
+def test_invalid(data):
+    with pytest.raises(ValueError):
+        parse_screenshot_spec(data)
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
+import json
 import unittest
 
 import pytest
 
 from splash.utils import to_bytes, to_unicode
 from splash.utils import swap_byte_order_i32
+from splash.utils import BinaryCapsule, SplashJSONEncoder, iter_json
 
 
 class ToUnicodeTest(unittest.TestCase):
@@ -56,3 +58,34 @@ def test_swap_byte_order_i32():
         swap_byte_order_i32(b"abcdef")
     with pytest.raises(ValueError):
         swap_byte_order_i32(b"abc")
+
+
+@pytest.mark.parametrize("obj", [
+    {},
+    [],
+    {"a": [1, 2.5, None, True, "\u044f\n\""], "b": {"c": {}, "d": []}},
+    [[], [{}], "foo"],
+    {"png": BinaryCapsule(bytes(range(256)) * 1000, "image/png")},
+    BinaryCapsule(b"", "image/png"),
+    {True: 1, False: 2, None: 3, 4: 5, -6: 7, 1.5: 8, 1e20: 9,
+     float('nan'): 10, float('-inf'): 11},
+])
+def test_iter_json(obj):
+    chunks = list(iter_json(obj))
+    assert "".join(chunks) == json.dumps(obj, cls=SplashJSONEncoder)
+
+
+def test_iter_json_bad_keys():
+    with pytest.raises(TypeError):
+        json.dumps({b"key": 1}, cls=SplashJSONEncoder)
+    with pytest.raises(TypeError):
+        list(iter_json({b"key": 1}))
+    with pytest.raises(TypeError):
+        list(iter_json({(1, 2): 1}))
+
+
+def test_iter_json_is_incremental():
+    obj = {"png": BinaryCapsule(b"x" * 500000, "image/png"),
+           "entries": [{"n": i} for i in range(100)]}
+    chunks = list(iter_json(obj))
+    assert max(len(chunk) for chunk in chunks) <= 64 * 1024
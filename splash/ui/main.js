@@ -183,7 +183,7 @@ function renderString(s, $cnt) {
     // Block of text or image
     // Test if it can be loaded as a PNG or JPG image
     var rendered = false;
-    var pending = 2;
+    var pending = 3;
 
     function try_load(ext) {
         var i = new Image();
@@ -219,6 +219,7 @@ function renderString(s, $cnt) {
 
     try_load('png');
     try_load('jpeg');
+    try_load('webp');
 }
 
 /**
@@ -226,7 +227,7 @@ function renderString(s, $cnt) {
  * alphanumeric sort order and are sorted at the begining
  */
 function getProperties(obj) {
-    var special = ['png', 'jpeg', 'jpg', 'har', 'html'];
+    var special = ['png', 'jpeg', 'jpg', 'webp', 'har', 'html'];
     var props = [];
 
     for (var k in obj) {
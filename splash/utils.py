@@ -41,6 +41,78 @@ class SplashJSONEncoder(json.JSONEncoder):
         return super(SplashJSONEncoder, self).default(o)
 
 
+class StreamedJSON(object):
+    """
+    A wrapper for results which should be serialized to JSON
+    incrementally, without building the whole JSON string in memory.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def iter_chunks(self):
+        return iter_json(self.data)
+
+    def dumps(self):
+        return "".join(self.iter_chunks())
+
+
+# 48KB of binary data are encoded to 64KB of base64 data
+_B64_CHUNK_SIZE = 3 * 16 * 1024
+
+
+def _json_key(key):
+    """ Convert a dict key to str the same way as json.dumps does """
+    if isinstance(key, str):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, float):
+        return json.dumps(key)
+    if isinstance(key, int):
+        return int.__repr__(key)
+    raise TypeError("keys must be str, int, float, bool or None, "
+                    "not %s" % type(key).__name__)
+
+
+def iter_json(obj, encoder=None):
+    """
+    Serialize ``obj`` to JSON, yielding the result in chunks.
+    Output is the same as of ``json.dumps(obj, cls=SplashJSONEncoder)``,
+    but dicts and lists are serialized item by item, and BinaryCapsule
+    data is base64-encoded in chunks.
+    """
+    if encoder is None:
+        encoder = SplashJSONEncoder()
+    if isinstance(obj, dict):
+        yield '{'
+        for i, (key, value) in enumerate(obj.items()):
+            if i:
+                yield ', '
+            yield encoder.encode(_json_key(key)) + ': '
+            yield from iter_json(value, encoder)
+        yield '}'
+    elif isinstance(obj, (list, tuple)):
+        yield '['
+        for i, value in enumerate(obj):
+            if i:
+                yield ', '
+            yield from iter_json(value, encoder)
+        yield ']'
+    elif isinstance(obj, BinaryCapsule):
+        data = memoryview(obj.data)
+        yield '"'
+        for start in range(0, len(data), _B64_CHUNK_SIZE):
+            chunk = data[start:start + _B64_CHUNK_SIZE]
+            yield base64.b64encode(chunk).decode('ascii')
+        yield '"'
+    else:
+        yield encoder.encode(obj)
+
+
 def to_unicode(text, encoding=None, errors='strict'):
     """Return the unicode representation of a bytes object `text`. If `text`
     is already an unicode object, return it as-is."""
@@ -141,6 +213,17 @@ def get_ru_maxrss():
     return size
 
 
+def get_cpu_time():
+    """ Return user and system CPU time of the process, in seconds """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def get_rss():
+    """ Return current RSS usage (in bytes) """
+    return psutil.Process(PID).memory_info().rss
+
+
 def get_total_phymem():
     """ Return the total amount of physical memory available. """
     try: